@@ -2,6 +2,9 @@ import ctypes as ct
 import MDAnalysis as mda
 from MDAnalysis.coordinates import core
 import numpy as np
+import backends
+import metrics
+import numpy_backend
 
 # %%
 class t_residue(ct.Structure):
@@ -32,63 +35,127 @@ class t_align(ct.Structure):
                 ("velSys", ct.POINTER(ct.c_float)),
                 ("nResSys", ct.c_int32),
                 ("resSys", ct.POINTER(t_residue)),
-                ("box", ct.c_float*9)
+                ("box", ct.c_float*9),
+                ("fitMethod", ct.c_int32),
+                ("rmsd", ct.c_float),
+                ("fused", ct.c_int32)
                 )
 
-# %%
-#load the shared library with C routines
-alignLib = ct.cdll.LoadLibrary("ctypes/libalign.so")
+# methods to determine the rotation matrix
+# - 'jacobi': Jacobi diagonalization (reference implementation)
+# - 'qcp': closed-form quaternion characteristic polynomial (fast, no heap allocation)
+fitMethods = {'jacobi': 0, 'qcp': 1}
 
 # %%
-alignLib.setup.argtypes = [
-    # alignment settings
-    ct.POINTER(t_align),
-    # number of atoms in reference group
-    ct.c_int32,
-    # masses of atoms in reference group
-    np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS'),
-    # referece coordinates
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    # number of atoms in system
-    ct.c_int32,
-    # masses of atoms in system
-    np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS'),
-    # number of residues in system
-    ct.c_int32,
-    # array with number of atoms per residue in system
-    np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
-    # box vectors
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
-]
-alignLib.setup.restype = ct.c_int32
-
-alignLib.alignCrd.argtypes = [
-    # alignment settings
-    ct.POINTER(t_align),
-    # coordinates of reference group
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    # coordinates of system
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    # box vectors
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
-]
-alignLib.alignCrd.restype = ct.c_int32
-
-alignLib.alignCrdVel.argtypes = [
-    # alignment settings
-    ct.POINTER(t_align),
-    # coordinates of reference group
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    # velocities of reference group
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    # coordinates of system
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    # velocities of system
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    # box vectors
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
-]
-alignLib.alignCrdVel.restype = ct.c_int32
+#shared library with C routines, loaded (and compiled if needed) on first use
+alignLib = None
+
+def _load():
+    """load libalign (see backends.native) and define argument types of its functions"""
+    global alignLib
+    if alignLib is not None:
+        return alignLib
+    lib = backends.native('align')
+
+    lib.setup.argtypes = [
+        # alignment settings
+        ct.POINTER(t_align),
+        # number of atoms in reference group
+        ct.c_int32,
+        # masses of atoms in reference group
+        np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS'),
+        # referece coordinates
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # number of atoms in system
+        ct.c_int32,
+        # masses of atoms in system
+        np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS'),
+        # number of residues in system
+        ct.c_int32,
+        # array with number of atoms per residue in system
+        np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
+        # box vectors
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
+    ]
+    lib.setup.restype = ct.c_int32
+
+    lib.alignCrd.argtypes = [
+        # alignment settings
+        ct.POINTER(t_align),
+        # coordinates of reference group
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # coordinates of system
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # box vectors
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
+    ]
+    lib.alignCrd.restype = ct.c_int32
+
+    lib.alignCrdVel.argtypes = [
+        # alignment settings
+        ct.POINTER(t_align),
+        # coordinates of reference group
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # velocities of reference group
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # coordinates of system
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # velocities of system
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # box vectors
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
+    ]
+    lib.alignCrdVel.restype = ct.c_int32
+
+    lib.alignFused.argtypes = [
+        # alignment settings
+        ct.POINTER(t_align),
+        # coordinates of reference group
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # velocities of reference group
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # coordinates of system
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # velocities of system
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        # process velocities (0/1)
+        ct.c_int32,
+        # box vectors
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
+    ]
+    lib.alignFused.restype = ct.c_int32
+
+    lib.alignFrames.argtypes = [
+        # alignment settings
+        ct.POINTER(t_align),
+        # number of frames
+        ct.c_int32,
+        # indices of reference group atoms in system
+        np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
+        # coordinates of system for all frames
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=3, flags='C_CONTIGUOUS'),
+        # velocities of system for all frames
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=3, flags='C_CONTIGUOUS'),
+        # process velocities (0/1)
+        ct.c_int32,
+        # box vectors for all frames
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=3, flags='C_CONTIGUOUS'),
+        # RMSD of reference group after fitting for all frames
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags='C_CONTIGUOUS'),
+        # error details
+        ct.POINTER(metrics.t_error)
+    ]
+    lib.alignFrames.restype = ct.c_int32
+
+    alignLib = lib
+    return alignLib
+
+def box_vectors(boxes):
+    """triclinic box vectors [nFrames, 3, 3] for box dimensions [nFrames, 6]"""
+    # boxes rarely change between frames, convert each distinct box only once
+    dims, inverse = np.unique(np.asarray(boxes, dtype=np.float32).reshape(-1, 6), axis=0, return_inverse=True)
+    vectors = np.array([core.triclinic_vectors(d) for d in dims], dtype=np.float32)
+    return np.ascontiguousarray(vectors[inverse.ravel()])
 
 # %%
 class align:
@@ -101,9 +168,16 @@ class align:
                  placeCOMInBox=1,
                  rotate=1,
                  rotVel=0,
-                 altRefPos=None
+                 altRefPos=None,
+                 fitMethod='jacobi',
+                 fused=1,
+                 backend=None
                  ):
         self.u = u
+        # 'native' (C kernels), 'numpy' (numpy_backend, fitMethod and fused are ignored)
+        # or 'auto' (default: FRESEAN_BACKEND, see backends.select)
+        self.backend = backends.select(backend, 'align')
+        self.alignLib = _load() if self.backend == 'native' else None
         self.refSel = refSel
         self.align = t_align()
         self.align.align = align
@@ -112,6 +186,13 @@ class align:
         self.align.placeCOMInBox = placeCOMInBox
         self.align.rotate = rotate
         self.align.rotVel = rotVel
+        if fitMethod not in fitMethods:
+            raise ValueError(f"align: fitMethod must be one of {list(fitMethods)}")
+        self.align.fitMethod = fitMethods[fitMethod]
+        # single-pass kernel (fused=1) or multi-pass reference implementation (fused=0)
+        self.align.fused = fused
+        # mass-weighted RMSD of reference group after fitting (nan if not rotated)
+        self.rmsd = np.nan
         self.altRefPos = altRefPos
         if self.u.dimensions is None:
             print('align: WARNING:')
@@ -119,6 +200,8 @@ class align:
             print(' -> using cubic (100 A)**3 box as dummy')
             self.u.dimensions = [100.0, 100.0, 100.0, 90.0, 90.0, 90.0]
         self.box = core.triclinic_vectors(self.u.dimensions)
+        # indices of reference atoms in system (for multi-frame alignment)
+        self.refIndices = np.ascontiguousarray(self.refSel.atoms.indices, dtype=np.int32)
         self.prep()
 
     def prep(self):
@@ -127,7 +210,13 @@ class align:
             nAtomsPerRes[i] = len(res.atoms)
         if self.altRefPos is None:
             self.altRefPos = self.refSel.atoms.positions
-        error = alignLib.setup(ct.byref(self.align),
+        if self.backend == 'numpy':
+            self.reference = numpy_backend.reference(self.refSel.atoms.masses,
+                                                     self.altRefPos,
+                                                     self.u.atoms.masses,
+                                                     nAtomsPerRes)
+            return
+        error = self.alignLib.setup(ct.byref(self.align),
                        self.refSel.n_atoms,
                        self.refSel.atoms.masses,
                        self.altRefPos,
@@ -136,20 +225,106 @@ class align:
                        len(self.u.residues),
                        nAtomsPerRes,
                        core.triclinic_vectors(self.u.dimensions))
+        metrics.check('setup', error)
 
     def single_frame(self):
         if self.u.dimensions is None:
             self.u.dimensions = [100.0, 100.0, 100.0, 90.0, 90.0, 90.0]
-        if self.align.subCOMvel ==1 or self.align.rotVel == 1:
-            alignLib.alignCrdVel(ct.byref(self.align),
-                        self.refSel.atoms.positions,
-                        self.refSel.atoms.velocities,
-                        self.u.trajectory.ts._pos,
-                        self.u.trajectory.ts._velocities,
-                        core.triclinic_vectors(self.u.trajectory.ts._unitcell))
+        with metrics.timer('align', frames=1):
+            doVel = self.align.subCOMvel ==1 or self.align.rotVel == 1
+            refPos = self.refSel.atoms.positions
+            refVel = self.refSel.atoms.velocities if doVel else refPos
+            box = core.triclinic_vectors(self.u.trajectory.ts._unitcell)
+            with metrics.kernel('align'):
+                if self.backend == 'numpy':
+                    error, boxes, rmsd = numpy_backend.align_frames(self.align,
+                                self.reference,
+                                refPos[None],
+                                refVel[None],
+                                self.u.trajectory.ts._pos[None],
+                                self.u.trajectory.ts._velocities[None] if doVel else None,
+                                doVel,
+                                box)
+                    self.align.box[:] = boxes[0].ravel().tolist()
+                    self.align.rmsd = rmsd[0]
+                elif self.align.fused == 1:
+                    error = self.alignLib.alignFused(ct.byref(self.align),
+                                refPos,
+                                refVel,
+                                self.u.trajectory.ts._pos,
+                                self.u.trajectory.ts._velocities if doVel else self.u.trajectory.ts._pos,
+                                int(doVel),
+                                box)
+                elif doVel:
+                    error = self.alignLib.alignCrdVel(ct.byref(self.align),
+                                refPos,
+                                refVel,
+                                self.u.trajectory.ts._pos,
+                                self.u.trajectory.ts._velocities,
+                                box)
+                else:
+                    error = self.alignLib.alignCrd(ct.byref(self.align),
+                                refPos,
+                                self.u.trajectory.ts._pos,
+                                box)
+            metrics.check('align', error)
+            self.box = np.array(self.align.box[0:9]).reshape(3,3)
+            self.rmsd = self.align.rmsd if self.align.rmsd >= 0.0 else np.nan
+
+    def frames(self, coords, vels=None, boxes=None):
+        """
+        align a block of frames in place with a single C call
+        coords: float32 array [nFrames, nAtoms, 3] (C-contiguous, all atoms in u)
+        vels: float32 array [nFrames, nAtoms, 3], required if subCOMvel or rotVel
+        boxes: box dimensions [nFrames, 6] or [6] (default: current box of u)
+        returns: (rotated) box vectors [nFrames, 3, 3]
+        the RMSD of the reference group for each frame is stored in self.rmsd
+        """
+        if coords.dtype != np.float32 or coords.ndim != 3 or not coords.flags['C_CONTIGUOUS']:
+            raise ValueError("align: coords must be a C-contiguous float32 array [nFrames, nAtoms, 3]")
+        nFrames, nAtoms = coords.shape[0], coords.shape[1]
+        if nAtoms != len(self.u.atoms):
+            raise ValueError(f"align: coords contain {nAtoms} atoms, expected {len(self.u.atoms)}")
+        doVel = int(self.align.subCOMvel == 1 or self.align.rotVel == 1)
+        if doVel:
+            if vels is None or vels.shape != coords.shape or vels.dtype != np.float32 \
+                    or not vels.flags['C_CONTIGUOUS']:
+                raise ValueError("align: vels must be a C-contiguous float32 array with the shape of coords")
         else:
-            alignLib.alignCrd(ct.byref(self.align),
-                        self.refSel.atoms.positions,
-                        self.u.trajectory.ts._pos,
-                        core.triclinic_vectors(self.u.trajectory.ts._unitcell))
-        self.box = np.array(self.align.box[0:9]).reshape(3,3)
\ No newline at end of file
+            vels = np.empty((0, 0, 3), dtype=np.float32)
+        if boxes is None:
+            if self.u.dimensions is None:
+                self.u.dimensions = [100.0, 100.0, 100.0, 90.0, 90.0, 90.0]
+            boxes = self.u.dimensions
+        with metrics.timer('align', frames=nFrames):
+            boxVectors = box_vectors(np.broadcast_to(np.asarray(boxes).reshape(-1, 6), (nFrames, 6)))
+            rmsd = np.empty(nFrames, dtype=np.float32)
+            details = metrics.t_error()
+            with metrics.kernel('align'):
+                if self.backend == 'numpy':
+                    error, boxVectors, rmsd = numpy_backend.align_frames(self.align,
+                                             self.reference,
+                                             coords[:, self.refIndices],
+                                             vels[:, self.refIndices] if doVel else None,
+                                             coords,
+                                             vels,
+                                             doVel,
+                                             boxVectors)
+                    if error != 0:
+                        # all frames fail alike in the vectorized version
+                        metrics.set_error(details, error, 0, -1, 0, nFrames)
+                else:
+                    error = self.alignLib.alignFrames(ct.byref(self.align),
+                                             nFrames,
+                                             self.refIndices,
+                                             coords,
+                                             vels,
+                                             doVel,
+                                             boxVectors,
+                                             rmsd,
+                                             ct.byref(details))
+            self.rmsd = np.where(rmsd >= 0.0, rmsd, np.nan)
+        metrics.check('alignFrames', error, details)
+        if nFrames > 0:
+            self.box = boxVectors[-1].astype(np.float64)
+        return boxVectors
@@ -0,0 +1,164 @@
+import ctypes as ct
+import hashlib
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+
+# C sources of the native kernels, relative to this module
+sourceDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ctypes')
+# compiler and flags for the native build (override with FRESEAN_CC / FRESEAN_CFLAGS)
+compiler = os.environ.get('FRESEAN_CC', os.environ.get('CC', 'gcc'))
+cflags = os.environ.get('FRESEAN_CFLAGS', '-O3 -march=native -fopenmp -fpic').split()
+ldflags = ['-shared', '-lgomp']
+
+# interface version of the C sources (abiVersion() in ctypes/*.c)
+abiVersion = 1
+# functions of each library used by unwrap.py and align.py
+symbols = dict(unwrap=('buildTrees', 'freeTrees', 'unwrap', 'unwrapFrames'),
+               align=('setup', 'alignCrd', 'alignCrdVel', 'alignFused', 'alignFrames'))
+
+_libraries = {}
+_failed = {}
+
+def cache_dir():
+    """directory of compiled libraries (FRESEAN_CACHE or ~/.cache/fresean)"""
+    default = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'fresean')
+    return os.environ.get('FRESEAN_CACHE', default)
+
+def _cpu():
+    """CPU model, libraries built with -march=native are only valid for the same CPU"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+def build_key(name):
+    """hash of source, compiler, flags and CPU that identifies a native build"""
+    with open(os.path.join(sourceDir, f"{name}.c"), 'rb') as f:
+        source = f.read()
+    identity = [source, compiler.encode(), ' '.join(cflags + ldflags).encode(),
+                platform.machine().encode(), _cpu().encode()]
+    return hashlib.sha256(b'\0'.join(identity)).hexdigest()[:16]
+
+def _compile(name, target):
+    """compile ctypes/<name>.c into target (written atomically), retry without OpenMP"""
+    source = os.path.join(sourceDir, f"{name}.c")
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix='.so', dir=os.path.dirname(target))
+    os.close(fd)
+    attempts = [cflags + [source, '-o', tmp] + ldflags,
+                [f for f in cflags if f != '-fopenmp'] + [source, '-o', tmp, '-shared']]
+    try:
+        for args in attempts:
+            result = subprocess.run([compiler] + args, capture_output=True, text=True)
+            if result.returncode == 0:
+                os.replace(tmp, target)
+                return
+        raise OSError(f"compiling {source} failed:\n{result.stderr}")
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _check(lib, name, filename):
+    """raise OSError if a library lacks functions or was built from incompatible sources"""
+    missing = [symbol for symbol in ('abiVersion',) + symbols.get(name, ()) if not hasattr(lib, symbol)]
+    if missing:
+        raise OSError(f"{filename} does not export {', '.join(missing)} (outdated build)")
+    version = lib.abiVersion()
+    if version != abiVersion:
+        raise OSError(f"{filename} has interface version {version}, expected {abiVersion} (outdated build)")
+
+def native(name):
+    """
+    native library ctypes/<name>.c, compiled on first use and cached per CPU and compiler flags
+    falls back to a library built with ctypes/compile.sh if no compiler is available,
+    libraries that lack a function or have another abiVersion are rejected
+    raises OSError if neither is available
+    """
+    if name in _libraries:
+        return _libraries[name]
+    if name in _failed:
+        raise OSError(_failed[name])
+    target = os.path.join(cache_dir(), build_key(name), f"lib{name}.so")
+    try:
+        if not os.path.exists(target):
+            if shutil.which(compiler) is None:
+                raise OSError(f"compiler {compiler} not found")
+            _compile(name, target)
+        lib = ct.cdll.LoadLibrary(target)
+        _check(lib, name, target)
+    except OSError as error:
+        prebuilt = os.path.join(sourceDir, f"lib{name}.so")
+        try:
+            lib = ct.cdll.LoadLibrary(prebuilt)
+            _check(lib, name, prebuilt)
+        except OSError as prebuiltError:
+            _failed[name] = f"no native {name} library: {error}; {prebuiltError}"
+            raise OSError(_failed[name])
+    _libraries[name] = lib
+    return lib
+
+def available(name):
+    """True if the native library can be loaded (or built)"""
+    try:
+        native(name)
+        return True
+    except OSError:
+        return False
+
+def select(backend=None, name='unwrap'):
+    """
+    backend used by unwrap/align: 'native' (C kernels), 'numpy' (numpy_backend) or 'auto'
+    the default is taken from FRESEAN_BACKEND ('auto': native if it can be built, numpy otherwise)
+    """
+    if backend is None:
+        backend = os.environ.get('FRESEAN_BACKEND', 'auto')
+    if backend not in ('auto', 'native', 'numpy'):
+        raise ValueError("backend must be 'auto', 'native' or 'numpy'")
+    if backend == 'auto':
+        return 'native' if available(name) else 'numpy'
+    if backend == 'native':
+        native(name)
+    return backend
+
+def equivalence_check(nAtoms=3000, nFrames=5, system='water', rotVel=1, fitMethod='jacobi', tol=1e-4):
+    """
+    compare unwrap and align results of the native and the numpy backend on a synthetic system
+    (the native Jacobi fit works in single precision, expect relative deviations around 1e-5)
+    returns: dict with the maximum deviations relative to the largest value (coordinates, velocities, box vectors, RMSD)
+             and 'passed' (all deviations <= tol), see tests/test_backends.py for the test suite
+    """
+    import numpy as np
+    import benchmark
+    import unwrap as pbc
+    import align as fit
+    results = {}
+    for backend in ('native', 'numpy'):
+        u = benchmark.systems[system](nAtoms, nFrames=nFrames, triclinic=False)
+        sel = u.atoms[:min(300, len(u.atoms))]
+        unwrap = pbc.unwrap(u, backend=backend)
+        align = fit.align(u, sel, rotVel=rotVel, fitMethod=fitMethod, backend=backend)
+        crd = []
+        vel = []
+        boxes = []
+        rmsd = []
+        for ts in u.trajectory:
+            unwrap.single_frame()
+            align.single_frame()
+            crd.append(u.atoms.positions)
+            vel.append(u.atoms.velocities)
+            boxes.append(align.box)
+            rmsd.append(align.rmsd)
+        results[backend] = [np.array(x, dtype=np.float64) for x in (crd, vel, boxes, rmsd)]
+        unwrap.close()
+    deviations = {key: float(np.max(np.abs(a - b)) / max(np.max(np.abs(a)), 1.0))
+                  for key, a, b in zip(('coordinates', 'velocities', 'box', 'rmsd'),
+                                       results['native'], results['numpy'])}
+    deviations['passed'] = all(d <= tol for d in deviations.values())
+    return deviations
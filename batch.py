@@ -0,0 +1,316 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent import futures
+import numpy as np
+import MDAnalysis as mda
+import cache
+import clustering
+import fresean
+import pipeline
+import segmentation
+import store
+
+# job settings, missing entries of a job are taken from here (or from "defaults" in the job file)
+defaults = dict(selection='all',
+                reference=None,
+                refSelection=None,
+                unwrap=True,
+                alignKwargs=dict(rotVel=1, placeCOMInBox=0),
+                segment=None,
+                nCorr=None,
+                sigma=None,
+                dt=None,
+                nConstraints=6,
+                nModes=None,
+                clusterModes=5,
+                fMax=201.0,
+                cutoff=0.3,
+                rigidBody=False)
+
+# settings that determine the preprocessed frames, jobs that share them share one frame store
+_preprocessing = ('topology', 'trajectory', 'selection', 'reference', 'refSelection', 'unwrap', 'alignKwargs')
+
+def load_jobs(filename):
+    """
+    job list from a JSON file, either a list of jobs or {"defaults": {...}, "jobs": [...]}
+    each job is a dict with at least name, topology, trajectory, nCorr and sigma, e.g.
+    {"name": "water-300K", "topology": "data/MD-water-300K/topol.tpr", "trajectory": "data/MD-water-300K/traj.trr",
+     "reference": "data/MD-water-300K/conformation-1.xyz", "nCorr": 200, "sigma": 10.0,
+     "segment": {"dihedrals": ["phi 1", "psi 1"], "basins": [[[-180, 0], [100, -150]]], "basin": 0}}
+    """
+    with open(filename) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = dict(jobs=data)
+    common = dict(defaults, **data.get('defaults', {}))
+    jobs = []
+    for job in data['jobs']:
+        job = dict(common, **job)
+        for key in ('name', 'topology', 'trajectory', 'nCorr', 'sigma'):
+            if job.get(key) is None:
+                raise ValueError(f"{filename}: job {job.get('name', len(jobs))} has no {key}")
+        jobs.append(job)
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{filename}: job names are not unique")
+    return jobs
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(cache.canonical(value), sort_keys=True).encode()).hexdigest()[:16]
+
+def _dihedral_atoms(u, names):
+    """
+    atom indices [nDihedrals, 4] of dihedrals given as index quadruplets or
+    '<phi|psi|omega|chi1> <residue index>' (e.g. 'phi 1' for the notebooks' sel.residues[1].phi_selection())
+    """
+    groups = []
+    for name in names:
+        if isinstance(name, str):
+            angle, residue = name.split()
+            group = getattr(u.residues[int(residue)], f"{angle}_selection")()
+            if group is None:
+                raise ValueError(f"dihedral {name} is not defined in the topology")
+            groups.append(group)
+        else:
+            groups.append(name)
+    return segmentation.dihedral_indices(groups)
+
+def _segment_frames(frames, segment, nCorr, u):
+    """
+    trajectory frame indices of a job's segment
+    segment: None (all frames), {"frames": [...]}, {"start", "stop", "step"} or a basin of dihedrals
+             {"dihedrals": [...], "basins": [...], "basin": 0, "minLength": 2 * nCorr}
+             (longest segment of the basin, see segmentation.label_frames)
+    """
+    allFrames = frames['frames']
+    if segment is None:
+        return np.asarray(allFrames)
+    if 'frames' in segment:
+        return np.asarray(segment['frames'], dtype=np.int64)
+    if 'dihedrals' not in segment:
+        return np.asarray(allFrames)[slice(segment.get('start'), segment.get('stop'), segment.get('step'))]
+    # dihedrals are stored in the order of the frame store, pick the ones of this segment
+    stored = [tuple(d) for d in frames.meta['dihedrals']]
+    columns = [stored.index(tuple(d)) for d in _dihedral_atoms(u, segment['dihedrals'])]
+    labels = segmentation.label_frames(frames.dihedrals()[:, columns], segment['basins'])
+    starts, stops, values = segmentation.segments(labels,
+                                                  minLength=segment.get('minLength', 2 * nCorr),
+                                                  label=segment.get('basin', 0))
+    if len(starts) == 0:
+        raise ValueError(f"no segment of basin {segment.get('basin', 0)} with at least "
+                         f"{segment.get('minLength', 2 * nCorr)} frames")
+    i = np.argmax(stops - starts)
+    return np.asarray(allFrames[starts[i]:stops[i]])
+
+def preprocess(jobs, output, nWorkers=4, chunkSize=250, skip=()):
+    """
+    one frame store per trajectory (and preprocessing settings) shared by all its jobs,
+    with all dihedrals needed by the segment definitions computed in the same pass
+    skip: names of finished jobs, their dihedrals are still stored (so the store is the same
+          as for the full job list), but trajectories with only finished jobs are not preprocessed
+    returns: {job name: frame store directory} of the jobs that are not skipped
+    """
+    groups = {}
+    for job in jobs:
+        key = _digest({k: job[k] for k in _preprocessing})
+        groups.setdefault(key, []).append(job)
+    directories = {}
+    for key, group in groups.items():
+        if all(j['name'] in skip for j in group):
+            continue
+        job = group[0]
+        u = mda.Universe(job['topology'], job['trajectory'])
+        dihedrals = sorted({tuple(d) for j in group if j['segment'] and 'dihedrals' in j['segment']
+                            for d in _dihedral_atoms(u, j['segment']['dihedrals']).tolist()})
+        alignKwargs = None if job['alignKwargs'] is None else dict(job['alignKwargs'])
+        if alignKwargs is not None and job['reference'] is not None:
+            alignKwargs['altRefPos'] = mda.Universe(job['reference']).atoms.positions
+        directory = os.path.join(output, 'frames', key)
+        print(f"preprocessing {job['trajectory']} ({len(group)} jobs)")
+        pipeline.extract(job['topology'],
+                         job['trajectory'],
+                         directory,
+                         selection=job['selection'],
+                         nWorkers=nWorkers,
+                         chunkSize=chunkSize,
+                         unwrap=job['unwrap'],
+                         refSelection=job['refSelection'],
+                         alignKwargs=alignKwargs,
+                         dihedrals=dihedrals or None,
+                         dtype=np.float64)
+        for j in group:
+            if j['name'] not in skip:
+                directories[j['name']] = directory
+    return directories
+
+def _inputs(job, frames):
+    """inputs that determine the results of a job (results with the same inputs are complete)"""
+    return cache.canonical(dict({k: v for k, v in job.items() if k != 'name'},
+                                topology=cache.file_identity(job['topology']),
+                                trajectory=cache.file_identity(job['trajectory']),
+                                reference=None if job['reference'] is None else cache.file_identity(job['reference']),
+                                frames=frames))
+
+def complete(job, output, frames=None):
+    """
+    True if the results of a job exist for the same inputs (metadata is written last)
+    frames: segment frames of the job, default: the frames saved with the results
+            (no frame store or trajectory is needed to check a finished job)
+    """
+    directory = os.path.join(output, job['name'])
+    if not os.path.exists(os.path.join(directory, 'meta.json')):
+        return False
+    if frames is None:
+        if not os.path.exists(os.path.join(directory, 'frames.npy')):
+            return False
+        frames = np.load(os.path.join(directory, 'frames.npy'))
+    with open(os.path.join(directory, 'meta.json')) as f:
+        return json.load(f)['inputs'] == json.loads(json.dumps(_inputs(job, frames)))
+
+def _block_size(nFrames, nDOF, maxMemory):
+    """DOFs per correlation tile so that the FFT tiles use about a quarter of maxMemory"""
+    if maxMemory is None:
+        return 64
+    return int(np.clip(np.sqrt(maxMemory / 4 / (32 * nFrames)), 8, max(nDOF, 8)))
+
+def _traces(corrMatrix):
+    """sum of all eigenvalues at each frequency"""
+    if isinstance(corrMatrix, np.ndarray):
+        return np.einsum('kii->k', corrMatrix)
+    return np.array([np.trace(corrMatrix.data[k]) for k in range(len(corrMatrix))])
+
+def run_job(job, frameDirectory, output, maxMemory=None):
+    """
+    FRESEAN analysis of one job on its preprocessed frames, results in output/<name>/:
+    freqs, vdos (total VDoS), eigenvalues, eigenvectors (normalized as in the notebooks),
+    clusterModes, clusterEigenvalues, clusterFrequencies and meta.json (inputs, avgTemp)
+    maxMemory: bytes per worker, larger correlation matrices are kept on disk (store.corrStore)
+    returns: (name, 'done' or 'skipped', seconds)
+    """
+    start = time.time()
+    directory = os.path.join(output, job['name'])
+    frames = store.frameStore(frameDirectory)
+    u = mda.Universe(job['topology'])
+    segment = _segment_frames(frames, job['segment'], job['nCorr'], u)
+    inputs = _inputs(job, segment)
+    if complete(job, output, segment):
+        return job['name'], 'skipped', time.time() - start
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        os.remove(os.path.join(directory, 'meta.json'))
+    os.makedirs(directory, exist_ok=True)
+    nCorr = job['nCorr']
+    dt = job['dt']
+    if dt is None:
+        dt = float(np.median(np.diff(frames.times(segment))))
+    velocities = frames.velocities(segment)
+    nDOF, nFrames = velocities.shape
+    freqs, winTime = fresean.gaussian_window(nCorr, dt, job['sigma'])
+    out = None
+    if maxMemory is not None and nCorr * nDOF * nDOF * 8 > maxMemory / 2:
+        out = store.corrStore(os.path.join(directory, 'corr.tmp.npy'), nCorr, nDOF)
+    corrMatrix = fresean.correlation_matrix(velocities, nCorr, winTime,
+                                            blockSize=_block_size(nFrames, nDOF, maxMemory),
+                                            out=out, transform='real')
+    nModes = nDOF if job['nModes'] is None else min(job['nModes'], nDOF)
+    eigenvectors = np.lib.format.open_memmap(os.path.join(directory, 'eigenvectors.npy'), mode='w+',
+                                             shape=(nCorr, nModes, nDOF))
+    eigenvalues, eigenvectors = fresean.eigenmodes(corrMatrix, nModes=nModes, out=eigenvectors)
+    # average temperature and VDoS normalization as in the notebooks (from the full trace)
+    traces = _traces(corrMatrix)
+    nFree = nDOF - job['nConstraints']
+    avgTemp = (traces[0] + 2 * np.sum(traces[1:])) / (2 * nCorr - 1) / winTime[0] / (8.3145 * 0.1) / nFree
+    VDoSnorm = nCorr * winTime[0] * (8.3145 * 0.1 * avgTemp)
+    eigenvalues /= VDoSnorm
+    vdos = traces / VDoSnorm
+    # cluster modes (Eq. 12) of the leading eigenvectors below fMax
+    freqIndices = np.flatnonzero((freqs > 0) & (freqs < job['fMax']))
+    valuesSel, vectorsSel = clustering.select_modes(eigenvalues, eigenvectors, freqIndices, job['clusterModes'])
+    rigidBody = eigenvectors[0, :job['nConstraints']] if job['rigidBody'] else None
+    centers = np.asarray(clustering.cluster_centers(clustering.similarity_matrix(valuesSel, vectorsSel, rigidBody),
+                                                    job['cutoff']), dtype=np.int64)
+    nSelModes = min(job['clusterModes'], nModes)
+    results = dict(freqs=freqs,
+                   vdos=vdos,
+                   eigenvalues=eigenvalues,
+                   clusterModes=vectorsSel[centers],
+                   clusterEigenvalues=valuesSel[centers],
+                   clusterFrequencies=freqs[freqIndices[centers // nSelModes]],
+                   frames=segment)
+    for name, array in results.items():
+        np.save(os.path.join(directory, f"{name}.npy"), array)
+    eigenvectors.flush()
+    del eigenvectors
+    if out is not None:
+        del out, corrMatrix
+        os.remove(os.path.join(directory, 'corr.tmp.npy'))
+    meta = dict(inputs=inputs, avgTemp=float(avgTemp), dt=dt, nFrames=nFrames, nClusters=len(centers))
+    with open(os.path.join(directory, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(directory, 'meta.json.tmp'), os.path.join(directory, 'meta.json'))
+    return job['name'], 'done', time.time() - start
+
+def _run_task(job, frameDirectory, output, maxMemory):
+    try:
+        return run_job(job, frameDirectory, output, maxMemory)
+    except Exception:
+        return job['name'], 'failed:\n' + traceback.format_exc(), 0.0
+
+def run(jobs, output='fresean-results', nWorkers=2, maxMemory=None, blasThreads=1, chunkSize=250):
+    """
+    run all jobs: shared preprocessing per trajectory, then the analyses in a pool of nWorkers
+    processes (blasThreads BLAS threads each), jobs with complete results are skipped
+    and only trajectories with unfinished jobs are preprocessed
+    no graphics are imported, runs without a display
+    returns: {job name: status}
+    """
+    if isinstance(jobs, str):
+        jobs = load_jobs(jobs)
+    else:
+        jobs = [dict(defaults, **job) for job in jobs]
+    os.makedirs(output, exist_ok=True)
+    # finished jobs are skipped before any trajectory is preprocessed
+    status = {job['name']: 'skipped' for job in jobs if complete(job, output)}
+    for name in status:
+        print(f"{name}: skipped")
+    if len(status) == len(jobs):
+        return status
+    # the dihedrals of finished jobs are kept in the shared frame stores, so they are reused
+    frameDirectories = preprocess(jobs, output, nWorkers=nWorkers, chunkSize=chunkSize, skip=status)
+    jobs = [job for job in jobs if job['name'] not in status]
+    with fresean.pinned_env(blasThreads), \
+         futures.ProcessPoolExecutor(max_workers=nWorkers,
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=fresean.init_worker,
+                                     initargs=(blasThreads,)) as executor:
+        tasks = [executor.submit(_run_task, job, frameDirectories[job['name']], output, maxMemory) for job in jobs]
+        for task in futures.as_completed(tasks):
+            name, result, seconds = task.result()
+            status[name] = result
+            print(f"{name}: {result} ({seconds:.1f} s)")
+    return status
+
+def _bytes(text):
+    """size such as 4G, 512M or 1000000 in bytes"""
+    units = dict(K=1024, M=1024**2, G=1024**3, T=1024**4)
+    text = text.strip().upper().rstrip('B')
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+if __name__ == '__main__':
+    # python batch.py jobs.json --output results --workers 4 --max-memory 8G
+    parser = argparse.ArgumentParser(description="run FRESEAN analyses of a job list")
+    parser.add_argument('jobs', help="JSON job file (see batch.load_jobs)")
+    parser.add_argument('--output', default='fresean-results')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-memory', type=_bytes, default=None, help="memory per worker, e.g. 4G")
+    parser.add_argument('--blas-threads', type=int, default=1)
+    args = parser.parse_args()
+    status = run(args.jobs, args.output, args.workers, args.max_memory, args.blas_threads)
+    sys.exit(0 if all(s in ('done', 'skipped') for s in status.values()) else 1)
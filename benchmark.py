@@ -0,0 +1,303 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import MDAnalysis as mda
+from MDAnalysis.coordinates.memory import MemoryReader
+
+# box angles of synthetic systems with triclinic=True
+triclinicAngles = [70.0, 80.0, 90.0]
+
+def _load(u, pos, vel, L, triclinic):
+    """positions, velocities and boxes of all frames as an in-memory trajectory"""
+    angles = triclinicAngles if triclinic else [90.0, 90.0, 90.0]
+    u.load_new(pos,
+               format=MemoryReader,
+               velocities=vel,
+               dimensions=np.tile([L, L, L] + angles, (len(pos), 1)))
+    return u
+
+def water_box(nAtoms, nFrames=1, seed=0, triclinic=False):
+    """
+    synthetic box of (flexible) water molecules with about nAtoms atoms
+    bonds are shuffled to avoid any benefit from a pre-sorted topology
+    """
+    rng = np.random.default_rng(seed)
+    nWater = max(1, nAtoms // 3)
+    n = 3 * nWater
+    u = mda.Universe.empty(n,
+                           n_residues=nWater,
+                           atom_resindex=np.repeat(np.arange(nWater), 3),
+                           trajectory=True,
+                           velocities=True)
+    u.add_TopologyAttr('masses', np.tile([15.999, 1.008, 1.008], nWater))
+    u.add_TopologyAttr('names', np.tile(['OW', 'HW1', 'HW2'], nWater))
+    u.add_TopologyAttr('resnames', ['SOL'] * nWater)
+    oxygens = 3 * np.arange(nWater)
+    bonds = np.concatenate((np.c_[oxygens, oxygens + 1], np.c_[oxygens + 2, oxygens]))
+    rng.shuffle(bonds)
+    u.add_TopologyAttr('bonds', bonds)
+    # box size for liquid water density (~30 A**3 per molecule)
+    L = (30.0 * nWater)**(1.0 / 3.0)
+    pos = np.empty((nFrames, n, 3), dtype=np.float32)
+    for f in range(nFrames):
+        O = rng.uniform(0.0, L, (nWater, 3))
+        pos[f, 0::3] = O
+        pos[f, 1::3] = O + [0.96, 0.0, 0.0]
+        pos[f, 2::3] = O + [-0.24, 0.93, 0.0]
+    # wrap into the box, molecules are broken across boundaries
+    pos %= L
+    vel = rng.standard_normal(pos.shape).astype(np.float32)
+    return _load(u, pos, vel, L, triclinic)
+
+def alkane_chains(nAtoms, nFrames=1, chainLength=16, seed=0, triclinic=True):
+    """
+    synthetic liquid of united-atom alkane chains (CH3-(CH2)n-CH3) with about nAtoms atoms
+    chains are random walks with 1.53 A bonds, bonds are shuffled as in water_box
+    """
+    rng = np.random.default_rng(seed)
+    nChains = max(1, nAtoms // chainLength)
+    n = nChains * chainLength
+    u = mda.Universe.empty(n,
+                           n_residues=nChains,
+                           atom_resindex=np.repeat(np.arange(nChains), chainLength),
+                           trajectory=True,
+                           velocities=True)
+    masses = np.full(chainLength, 14.027)
+    masses[[0, -1]] = 15.035
+    names = np.array(['C2'] * chainLength)
+    names[[0, -1]] = 'C3'
+    u.add_TopologyAttr('masses', np.tile(masses, nChains))
+    u.add_TopologyAttr('names', np.tile(names, nChains))
+    u.add_TopologyAttr('resnames', ['ALK'] * nChains)
+    first = chainLength * np.repeat(np.arange(nChains), chainLength - 1)
+    links = np.tile(np.arange(chainLength - 1), nChains)
+    bonds = np.c_[first + links, first + links + 1]
+    rng.shuffle(bonds)
+    u.add_TopologyAttr('bonds', bonds)
+    # box size for liquid alkane density (~27 A**3 per united atom)
+    L = (27.0 * n)**(1.0 / 3.0)
+    pos = np.empty((nFrames, n, 3), dtype=np.float32)
+    for f in range(nFrames):
+        steps = rng.standard_normal((nChains, chainLength, 3))
+        steps *= 1.53 / np.linalg.norm(steps, axis=2)[..., None]
+        steps[:, 0] = rng.uniform(0.0, L, (nChains, 3))
+        pos[f] = np.cumsum(steps, axis=1).reshape(n, 3)
+    # wrap into the box, chains are broken across boundaries
+    pos %= L
+    vel = rng.standard_normal(pos.shape).astype(np.float32)
+    return _load(u, pos, vel, L, triclinic)
+
+systems = dict(water=water_box, alkane=alkane_chains)
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def tree_setup(sizes=(1000, 10000, 100000, 1000000), system='water'):
+    """time building unwrap bond trees for synthetic systems of different sizes"""
+    import unwrap as pbc
+    results = []
+    for nAtoms in sizes:
+        u = systems[system](nAtoms)
+        unwrap, seconds = _timed(pbc.unwrap, u)
+        results.append(dict(stage='tree_setup',
+                            system=system,
+                            nAtoms=len(u.atoms),
+                            nTrees=unwrap.trees.nTrees,
+                            seconds=seconds,
+                            atomsPerSecond=len(u.atoms) / seconds))
+        unwrap.close()
+        print(f"tree setup ({system}): {len(u.atoms):>8d} atoms {seconds:8.3f} s")
+    return results
+
+def unwrap_frames(nAtoms=100000, nFrames=20, system='water'):
+    """time unwrapping frame by frame (single_frame) and in blocks (frames)"""
+    import unwrap as pbc
+    u = systems[system](nAtoms, nFrames=nFrames)
+    unwrap = pbc.unwrap(u)
+    results = []
+    def per_frame():
+        for ts in u.trajectory:
+            unwrap.single_frame()
+    crd = np.ascontiguousarray(u.trajectory.coordinate_array).copy()
+    for kernel, function, args in (('single_frame', per_frame, ()),
+                                   ('frames', unwrap.frames, (crd, u.trajectory.dimensions_array))):
+        _, seconds = _timed(function, *args)
+        results.append(dict(stage='unwrap',
+                            kernel=kernel,
+                            system=system,
+                            nAtoms=len(u.atoms),
+                            nFrames=nFrames,
+                            seconds=seconds,
+                            framesPerSecond=nFrames / seconds))
+        print(f"unwrap {kernel:>12s} ({system}): {len(u.atoms):>8d} atoms {nFrames / seconds:10.1f} frames/s")
+    unwrap.close()
+    return results
+
+def align_kernels(nAtoms=100000, nFrames=20, refAtoms=300, system='water'):
+    """time fused single-pass vs. multi-pass reference align kernels (align.frames)"""
+    import align as fit
+    results = []
+    u = systems[system](nAtoms, nFrames=nFrames)
+    crd0 = np.ascontiguousarray(u.trajectory.coordinate_array)
+    vel0 = np.ascontiguousarray(u.trajectory.velocity_array)
+    boxes = u.trajectory.dimensions_array
+    for rotVel in (0, 1):
+        for fused in (0, 1):
+            a = fit.align(u, u.atoms[:refAtoms], rotVel=rotVel, fused=fused)
+            crd = crd0.copy()
+            vel = vel0.copy()
+            _, seconds = _timed(a.frames, crd, vel, boxes)
+            kernel = 'fused' if fused else 'reference'
+            results.append(dict(stage='align',
+                                kernel=kernel,
+                                system=system,
+                                velocities=bool(rotVel),
+                                nAtoms=len(u.atoms),
+                                nFrames=nFrames,
+                                seconds=seconds,
+                                framesPerSecond=nFrames / seconds))
+            print(f"align {kernel:>9s} (velocities: {bool(rotVel)!s:>5s}): "
+                  f"{len(u.atoms):>8d} atoms {nFrames / seconds:10.1f} frames/s")
+    return results
+
+def velocity_extraction(nAtoms=1000, nFrames=200, system='alkane'):
+    """time the per-frame loop of the notebooks (unwrap, align, mass-weighted velocities)"""
+    import unwrap as pbc
+    import align as fit
+    u = systems[system](nAtoms, nFrames=nFrames, triclinic=False)
+    sel = u.select_atoms('all')
+    unwrap = pbc.unwrap(u)
+    align = fit.align(u, sel, rotVel=1, placeCOMInBox=0)
+    sqm = np.repeat(np.sqrt(sel.atoms.masses), 3)
+    velocities = np.empty((3 * sel.n_atoms, nFrames))
+    def extract():
+        for t, ts in enumerate(u.trajectory):
+            unwrap.single_frame()
+            align.single_frame()
+            velocities[:, t] = sqm * sel.velocities.flatten()
+    _, seconds = _timed(extract)
+    unwrap.close()
+    print(f"velocity extraction ({system}): {sel.n_atoms:>8d} atoms {nFrames / seconds:10.1f} frames/s")
+    return [dict(stage='velocities',
+                 system=system,
+                 nAtoms=sel.n_atoms,
+                 nFrames=nFrames,
+                 seconds=seconds,
+                 framesPerSecond=nFrames / seconds)]
+
+def spectral(nDOF=300, nFrames=4000, nCorr=500, nModes=20, seed=0):
+    """time correlation build (complex and real FFTs), eigendecomposition and mode projection"""
+    import fresean
+    rng = np.random.default_rng(seed)
+    velocities = rng.standard_normal((nDOF, nFrames))
+    freqs, winTime = fresean.gaussian_window(nCorr, 0.004, 10.0)
+    nPairs = nDOF * (nDOF + 1) // 2
+    results = []
+    for transform in ('complex', 'real'):
+        corrMatrix, seconds = _timed(fresean.correlation_matrix, velocities, nCorr, winTime, transform=transform)
+        results.append(dict(stage='correlation',
+                            kernel=transform,
+                            nDOF=nDOF,
+                            nFrames=nFrames,
+                            nCorr=nCorr,
+                            seconds=seconds,
+                            pairsPerSecond=nPairs / seconds))
+        print(f"correlation matrix ({transform:>7s} FFTs): {nDOF:>6d} DOF {nPairs / seconds:12.1f} DOF pairs/s")
+    for k in (None, nModes):
+        (eigenvalues, eigenvectors), seconds = _timed(fresean.eigenmodes, corrMatrix, nModes=k)
+        kernel = 'full' if k is None else f'top{k}'
+        results.append(dict(stage='eigenmodes',
+                            kernel=kernel,
+                            nDOF=nDOF,
+                            nCorr=nCorr,
+                            seconds=seconds,
+                            frequenciesPerSecond=nCorr / seconds))
+        print(f"eigenmodes ({kernel:>5s}): {nDOF:>6d} DOF {nCorr / seconds:10.1f} frequencies/s")
+    modes = eigenvectors[1]
+    _, seconds = _timed(fresean.project_modes, corrMatrix, modes)
+    results.append(dict(stage='projection',
+                        nDOF=nDOF,
+                        nCorr=nCorr,
+                        nModes=len(modes),
+                        seconds=seconds,
+                        modePairsPerSecond=len(modes)**2 * nCorr / seconds))
+    print(f"mode projection: {len(modes)}x{len(modes)} modes {len(modes)**2 * nCorr / seconds:12.1f} mode pairs/s")
+    return results
+
+def _version():
+    """git commit of the benchmarked code (None outside of a git repository)"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes=(100, 1000, 10000, 100000, 1000000), nFrames=20, nDOF=300, output=None):
+    """run all stages, results are written to output (JSON) if given"""
+    results = []
+    for system in systems:
+        results += tree_setup(sizes, system=system)
+        for nAtoms in sizes:
+            results += unwrap_frames(nAtoms, nFrames=nFrames, system=system)
+            results += align_kernels(nAtoms, nFrames=nFrames, refAtoms=min(300, nAtoms), system=system)
+    results += velocity_extraction(nDOF // 3)
+    results += spectral(nDOF)
+    report = dict(version=_version(),
+                  date=datetime.datetime.now().isoformat(timespec='seconds'),
+                  machine=platform.machine(),
+                  python=platform.python_version(),
+                  numpy=np.__version__,
+                  cpus=os.cpu_count(),
+                  results=results)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"results written to {output}")
+    return report
+
+def _key(record):
+    """identifies the same measurement in two reports"""
+    return tuple((k, record[k]) for k in ('stage', 'kernel', 'system', 'velocities', 'nAtoms', 'nDOF', 'nFrames', 'nCorr', 'nModes')
+                 if k in record)
+
+def compare(old, new):
+    """
+    compare two JSON reports of run(), ratio > 1 means the new version is faster
+    returns: list of (measurement, old seconds, new seconds, speedup)
+    """
+    with open(old) as f:
+        oldResults = {_key(r): r for r in json.load(f)['results']}
+    with open(new) as f:
+        newResults = {_key(r): r for r in json.load(f)['results']}
+    comparison = []
+    for key, record in newResults.items():
+        if key not in oldResults:
+            continue
+        speedup = oldResults[key]['seconds'] / record['seconds']
+        comparison.append((dict(key), oldResults[key]['seconds'], record['seconds'], speedup))
+        label = ' '.join(f"{v}" for k, v in key)
+        flag = '  <- slower' if speedup < 0.9 else ''
+        print(f"{label:<50s} {oldResults[key]['seconds']:10.4f} s {record['seconds']:10.4f} s {speedup:6.2f}x{flag}")
+    return comparison
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FRESEAN performance benchmarks on synthetic systems')
+    parser.add_argument('sizes', nargs='*', type=int, default=[100, 1000, 10000, 100000, 1000000],
+                        help='system sizes (atoms) for tree setup, unwrap and align')
+    parser.add_argument('--frames', type=int, default=20, help='frames for unwrap and align')
+    parser.add_argument('--dof', type=int, default=300, help='DOF for velocity extraction and spectral stages')
+    parser.add_argument('--output', default=None, help='JSON file for results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON reports')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args.sizes, nFrames=args.frames, nDOF=args.dof, output=args.output)
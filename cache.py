@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+def canonical(value):
+    """JSON-serializable form of an input, arrays are replaced by a digest of their content"""
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return dict(shape=list(value.shape),
+                    dtype=str(value.dtype),
+                    sha256=hashlib.sha256(value.tobytes()).hexdigest())
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple, range)):
+        return [canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def file_identity(filename):
+    """identity of an input file: absolute path, size and modification time"""
+    stat = os.stat(filename)
+    return dict(path=os.path.abspath(filename), size=stat.st_size, mtime=stat.st_mtime_ns)
+
+def align_settings(align):
+    """alignment flags and reference coordinates of an align.align instance (None: no alignment)"""
+    if align is None:
+        return None
+    settings = {name: getattr(align.align, name)
+                for name in ('align', 'centerCOM', 'subCOMvel', 'placeCOMInBox', 'rotate', 'rotVel', 'fitMethod')}
+    settings['refIndices'] = align.refIndices
+    settings['refPos'] = np.asarray(align.altRefPos, dtype=np.float32)
+    return settings
+
+def analysis_inputs(u, sel, frames=None, nCorr=None, dt=None, sigma=None, align=None, unwrap=True, **extra):
+    """
+    inputs that determine the FRESEAN results of a trajectory (see cache.key)
+    u: MDAnalysis Universe, sel: analyzed atoms, align: align.align instance or None
+    """
+    trajectory = u.trajectory.filename
+    return dict(topology=file_identity(u.filename) if isinstance(u.filename, str) else None,
+                trajectory=file_identity(trajectory) if isinstance(trajectory, str) else None,
+                nFrames=len(u.trajectory),
+                frames=None if frames is None else np.asarray(frames, dtype=np.int64),
+                selection=np.asarray(sel.atoms.indices, dtype=np.int64),
+                nCorr=nCorr,
+                dt=dt,
+                sigma=sigma,
+                align=align_settings(align),
+                unwrap=bool(unwrap),
+                **extra)
+
+class cache:
+    """
+    content-addressed on-disk cache for intermediate results
+    (mass-weighted velocities, correlation matrix, eigenpairs, ...)
+    - each entry is a directory named by the hash of its inputs (see key)
+      with one .npy file per result, loaded memory-mapped
+    - least recently used entries are removed when the total size exceeds maxBytes
+
+    example:
+        c = cache.cache('fresean-cache', maxBytes=20e9)
+        key = c.key(cache.analysis_inputs(u, sel, nCorr=nCorr, dt=dt, sigma=sigma, align=align))
+        corrMatrix = c.get_or_compute(key, 'corrMatrix', lambda: fresean.correlation_matrix(...))
+    """
+    def __init__(self, directory='fresean-cache', maxBytes=10 * 1024**3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, inputs):
+        """hash of all inputs (dict of numbers, strings, arrays, nested dicts/lists)"""
+        text = json.dumps(canonical(inputs), sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def path(self, key, name):
+        """file of result name, e.g. for store.corrStore(filename=...) written in place"""
+        os.makedirs(self._entry(key), exist_ok=True)
+        return os.path.join(self._entry(key), f"{name}.npy")
+
+    def _touch(self, key):
+        # the modification time of the entry directory records the last access
+        os.utime(self._entry(key))
+
+    def get(self, key, name, mmap_mode='r'):
+        """cached result (memory-mapped) or None"""
+        filename = os.path.join(self._entry(key), f"{name}.npy")
+        if not os.path.exists(filename):
+            return None
+        self._touch(key)
+        return np.load(filename, mmap_mode=mmap_mode)
+
+    def put(self, key, name, array):
+        """store a result, written to a temporary file first so that readers never see partial files"""
+        filename = self.path(key, name)
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.lib.format.write_array(f, np.asarray(array))
+        os.replace(tmp, filename)
+        self._touch(key)
+        self.evict(keep=key)
+
+    def get_or_compute(self, key, name, compute):
+        """cached result, compute() is only called (and its result stored) if it is missing"""
+        result = self.get(key, name)
+        if result is None:
+            self.put(key, name, compute())
+            result = self.get(key, name)
+        return result
+
+    def entries(self):
+        """(last access, size in bytes, key) of all entries"""
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.stat(entry).st_mtime_ns, size, key))
+        return entries
+
+    def evict(self, keep=None):
+        """remove least recently used entries until the cache fits into maxBytes"""
+        entries = sorted(self.entries())
+        total = sum(size for access, size, key in entries)
+        for access, size, key in entries:
+            if total <= self.maxBytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+    def clear(self, key=None):
+        """remove one entry or the whole cache"""
+        if key is not None:
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            return
+        for key in os.listdir(self.directory):
+            shutil.rmtree(self._entry(key), ignore_errors=True)
@@ -0,0 +1,107 @@
+import numpy as np
+import scipy.sparse as sparse
+
+def select_modes(eigenvalues, eigenvectors, freqIndices, nModes=5):
+    """
+    candidate modes: the nModes leading eigenvectors at each selected frequency
+    (same order as the selection loops in the notebooks)
+    returns: (eigenvaluesSel [nSel], eigenvectorsSel [nSel, 3N])
+    """
+    freqIndices = np.asarray(freqIndices)
+    eigenvaluesSel = eigenvalues[freqIndices, :nModes].reshape(-1)
+    eigenvectorsSel = eigenvectors[freqIndices, :nModes].reshape(-1, eigenvectors.shape[-1])
+    return eigenvaluesSel, eigenvectorsSel
+
+def remove_subspace(vectors, basis):
+    """
+    subtract the overlap with each basis vector (e.g. the 6 rigid-body modes
+    eigenvectors[0][0:6]) from all vectors at once, in the same order as the notebook
+    returns: new array [nVectors, 3N]
+    """
+    vectors = np.array(vectors, dtype=np.float64)
+    for b in np.atleast_2d(basis):
+        vectors -= np.outer(vectors @ b, b)
+    return vectors
+
+def _amplitudes(eigenvalues):
+    # square root of eigenvalues, negative eigenvalues do not contribute
+    return np.sqrt(np.maximum(eigenvalues, 0.0))
+
+def similarity_matrix(eigenvalues, eigenvectors, rigidBody=None):
+    """
+    weighted mode similarity matrix of Eq. 12 as a single matrix product
+
+    eigenvalues: [nSel] eigenvalues of candidate modes
+    eigenvectors: [nSel, 3N] candidate modes
+    rigidBody: optional basis [6, 3N] projected out of all modes first
+    returns: [nSel, nSel]
+    """
+    if rigidBody is not None:
+        eigenvectors = remove_subspace(eigenvectors, rigidBody)
+    a = _amplitudes(eigenvalues)
+    maxEigenvalue = np.max(eigenvalues)
+    return np.outer(a, a) / maxEigenvalue * np.abs(eigenvectors @ eigenvectors.T)
+
+def similarity_graph(eigenvalues, eigenvectors, cutoff, rigidBody=None, blockSize=1024):
+    """
+    sparse thresholded similarity graph, only elements of Eq. 12 above cutoff are kept
+    the matrix is built in row blocks, the dense nSel x nSel matrix is never stored
+    returns: scipy.sparse.csr_matrix [nSel, nSel]
+    """
+    if rigidBody is not None:
+        eigenvectors = remove_subspace(eigenvectors, rigidBody)
+    a = _amplitudes(eigenvalues)
+    maxEigenvalue = np.max(eigenvalues)
+    nSel = len(a)
+    rows = []
+    cols = []
+    values = []
+    for i0 in range(0, nSel, blockSize):
+        i1 = min(i0 + blockSize, nSel)
+        block = np.outer(a[i0:i1], a) / maxEigenvalue * np.abs(eigenvectors[i0:i1] @ eigenvectors.T)
+        r, c = np.nonzero(block > cutoff)
+        rows.append(r + i0)
+        cols.append(c)
+        values.append(block[r, c])
+    return sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(nSel, nSel))
+
+def cluster_centers(matrix, cutoff=0.3):
+    """
+    greedy selection of cluster centers (same result as the loop in the notebooks)
+    - the row with the most elements above cutoff is the next center
+      (ties are resolved by the last index to emulate the Mathematica implementation)
+    - all members of the cluster are removed (rows and columns)
+    row counts are updated from the removed members only, instead of rescanning the matrix
+
+    matrix: dense similarity matrix or sparse graph (see similarity_graph)
+    returns: indices of cluster centers in order of selection
+    """
+    if sparse.issparse(matrix):
+        graph = sparse.csr_matrix(matrix)
+        graph = sparse.csr_matrix((graph.data > cutoff, graph.indices, graph.indptr), shape=graph.shape)
+    else:
+        graph = sparse.csr_matrix(np.asarray(matrix) > cutoff)
+    graph.eliminate_zeros()
+    # columns are removed as well, the transpose gives the rows affected by each column
+    graphT = graph.T.tocsr()
+    nSel = graph.shape[0]
+    rowCounts = np.diff(graph.indptr).astype(np.int64)
+    active = np.ones(nSel, dtype=bool)
+    clusterIndices = []
+    while True:
+        maxCount = np.max(rowCounts) if nSel > 0 else 0
+        if maxCount == 0:
+            break
+        # last index with the maximum count
+        center = nSel - 1 - np.argmax(rowCounts[::-1] == maxCount)
+        clusterIndices.append(center)
+        members = graph.indices[graph.indptr[center]:graph.indptr[center + 1]]
+        members = members[active[members]]
+        active[members] = False
+        rowCounts[members] = 0
+        # remaining rows lose one count for each removed column they contain
+        affected = np.concatenate([graphT.indices[graphT.indptr[m]:graphT.indptr[m + 1]] for m in members])
+        affected = affected[active[affected]]
+        np.subtract.at(rowCounts, affected, 1)
+    return np.array(clusterIndices, dtype=np.int64)
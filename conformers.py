@@ -0,0 +1,110 @@
+from concurrent import futures
+import numpy as np
+import store
+
+def load_frames(u, sel, frames=None, unwrap=None):
+    """
+    read frames once into a contiguous coordinate block [nFrames, nAtoms, 3] (float64)
+    unwrap: optional unwrap.unwrap instance to make molecules whole in each frame
+    u can also be a store.frameStore (see pipeline.extract), sel are then atom indices
+    within the store (None: all) and frames trajectory frame indices, no trajectory is read
+    """
+    if isinstance(u, store.frameStore):
+        return np.asarray(u.positions(frames, sel), dtype=np.float64)
+    traj = u.trajectory if frames is None else u.trajectory[frames]
+    coords = np.empty((len(traj), sel.n_atoms, 3))
+    for i, ts in enumerate(traj):
+        if unwrap is not None:
+            unwrap.single_frame()
+        coords[i] = sel.positions
+    return coords
+
+def _rmsd_tile(X, G, iSlice, jSlice, totWeight):
+    """superposition RMSD for all pairs of frames in one tile (QCP, Theobald 2005)"""
+    # inner product matrices S[i, j] = sum_n w_n x_i,n x_j,n^T for all pairs in tile
+    S = np.einsum('ina,jnb->ijab', X[iSlice], X[jSlice], optimize=True)
+    Sxx, Sxy, Sxz = S[..., 0, 0], S[..., 0, 1], S[..., 0, 2]
+    Syx, Syy, Syz = S[..., 1, 0], S[..., 1, 1], S[..., 1, 2]
+    Szx, Szy, Szz = S[..., 2, 0], S[..., 2, 1], S[..., 2, 2]
+    # symmetric 4x4 key matrices, the largest eigenvalue gives the optimal superposition
+    K = np.empty(S.shape[:2] + (4, 4))
+    K[..., 0, 0] = Sxx + Syy + Szz
+    K[..., 1, 1] = Sxx - Syy - Szz
+    K[..., 2, 2] = -Sxx + Syy - Szz
+    K[..., 3, 3] = -Sxx - Syy + Szz
+    K[..., 0, 1] = K[..., 1, 0] = Syz - Szy
+    K[..., 0, 2] = K[..., 2, 0] = Szx - Sxz
+    K[..., 0, 3] = K[..., 3, 0] = Sxy - Syx
+    K[..., 1, 2] = K[..., 2, 1] = Sxy + Syx
+    K[..., 1, 3] = K[..., 3, 1] = Szx + Sxz
+    K[..., 2, 3] = K[..., 3, 2] = Syz + Szy
+    lambdaMax = np.linalg.eigvalsh(K)[..., -1]
+    msd = (G[iSlice, None] + G[None, jSlice] - 2.0 * lambdaMax) / totWeight
+    return np.sqrt(np.maximum(msd, 0.0))
+
+def rmsd_matrix(coords, weights=None, tileSize=64, nWorkers=1):
+    """
+    pairwise RMSD matrix after optimal superposition (same as
+    MDAnalysis.analysis.rms.rmsd(A, B, center=True, superposition=True) for all pairs)
+
+    coords: [nFrames, nAtoms, 3]
+    weights: optional atomic weights (e.g. masses), uniform by default
+    tileSize: number of frames per row/column tile
+    nWorkers: number of threads working on row tiles
+    returns: symmetric matrix [nFrames, nFrames]
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    nFrames, nAtoms = coords.shape[0], coords.shape[1]
+    if weights is None:
+        weights = np.ones(nAtoms)
+    weights = np.asarray(weights, dtype=np.float64)
+    totWeight = np.sum(weights)
+    # center all frames once
+    COM = np.einsum('fna,n->fa', coords, weights) / totWeight
+    X = coords - COM[:, None, :]
+    G = np.einsum('fna,fna,n->f', X, X, weights)
+    # weights are applied via sqrt(w) to both frames of each pair
+    X *= np.sqrt(weights)[None, :, None]
+
+    matrix = np.zeros((nFrames, nFrames))
+    def row(i0):
+        iSlice = slice(i0, min(i0 + tileSize, nFrames))
+        # upper triangle of tiles only, use symmetry of RMSD matrix
+        for j0 in range(i0, nFrames, tileSize):
+            jSlice = slice(j0, min(j0 + tileSize, nFrames))
+            tile = _rmsd_tile(X, G, iSlice, jSlice, totWeight)
+            matrix[iSlice, jSlice] = tile
+            matrix[jSlice, iSlice] = tile.T
+    rows = range(0, nFrames, tileSize)
+    if nWorkers > 1:
+        with futures.ThreadPoolExecutor(max_workers=nWorkers) as executor:
+            list(executor.map(row, rows))
+    else:
+        for i0 in rows:
+            row(i0)
+    np.fill_diagonal(matrix, 0.0)
+    return matrix
+
+def representative(rmsdMatrix, cutoff):
+    """
+    select the structure with the largest number of structures within the RMSD cutoff
+    (ties are resolved by the last index, as in the notebooks)
+    returns: (index, number of structures within cutoff)
+    """
+    rowCounts = np.sum(rmsdMatrix < cutoff, axis=1)
+    maxCount = np.max(rowCounts)
+    return np.where(rowCounts == maxCount)[0][-1], maxCount
+
+def select_conformer(u, sel, frames=None, cutoff=0.75, unwrap=None, weights=None, tileSize=64, nWorkers=1):
+    """
+    most representative structure of a trajectory segment
+    u, sel: Universe and atom group or store.frameStore and atom indices (see load_frames)
+    returns: (frame index, rmsd matrix)
+    """
+    if frames is None:
+        frames = u['frames'] if isinstance(u, store.frameStore) else np.arange(len(u.trajectory))
+    frames = np.asarray(frames)
+    coords = load_frames(u, sel, frames, unwrap)
+    matrix = rmsd_matrix(coords, weights=weights, tileSize=tileSize, nWorkers=nWorkers)
+    index, count = representative(matrix, cutoff)
+    return frames[index], matrix
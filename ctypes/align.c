@@ -29,8 +29,31 @@ typedef struct {
     int nResSys;
     t_residue *resSys;
     float box[9];
+    int fitMethod;
+    float rmsd;
+    int fused;
 } t_align;
 
+/* error details returned to the caller (metrics.t_error), code 0 = no error */
+typedef struct t_error {
+    int code;
+    int frame;
+    int index;
+    int value;
+    int limit;
+} t_error;
+
+#define ERR_NO_RESIDUES 3
+
+/* methods to determine the rotation matrix */
+#define FIT_JACOBI 0
+#define FIT_QCP 1
+
+/* interface version checked by backends.py, increase with incompatible changes of the exported functions */
+int abiVersion(void) {
+    return 1;
+}
+
 void *save_calloc(char *name,char *file,int line,
                   unsigned nelem,unsigned elsize)
 {
@@ -266,6 +289,152 @@ void calc_fit_R(int natoms,double *w_rls,float *xp,float *x,matrix R)
     sfree(om);
 }
 
+static inline double det3(double a[3][3])
+{
+    return a[0][0]*(a[1][1]*a[2][2]-a[1][2]*a[2][1])
+          -a[0][1]*(a[1][0]*a[2][2]-a[1][2]*a[2][0])
+          +a[0][2]*(a[1][0]*a[2][1]-a[1][1]*a[2][0]);
+}
+
+/* determinant of the 3x3 minor of a 4x4 matrix without row r and column c */
+static inline double minor4(double a[4][4],int r,int c)
+{
+    double m[3][3];
+    int i,j,mi,mj;
+
+    for(i=0,mi=0;i<4;i++) {
+        if(i==r) continue;
+        for(j=0,mj=0;j<4;j++) {
+            if(j==c) continue;
+            m[mi][mj]=a[i][j];
+            mj++;
+        }
+        mi++;
+    }
+    return det3(m);
+}
+
+/* closed-form superposition via the quaternion characteristic polynomial (QCP)
+ * D. L. Theobald, Acta Cryst. A 61, 478-480 (2005)
+ * same convention as calc_fit_R: R rotates x (centered) onto xp (COM at COMxp)
+ * no heap allocation, returns the mass-weighted RMSD after fitting */
+float calc_fit_R_qcp(int natoms,double *w,float *xp,float *COMxp,double totMass,float *x,matrix R)
+{
+    double S[3][3]={{0.0}};
+    double K[4][4];
+    double xpc[3];
+    double Gx=0.0,Gxp=0.0,E0;
+    double c0,c1,c2,lambda,p,dp,delta;
+    double q[4],qn,qmax,norm;
+    double msd;
+    int n,a,b,i,j,best;
+
+    for(n=0;n<natoms;n++) {
+        if(w[n]==0.0) continue;
+        for(a=0;a<3;a++) xpc[a]=xp[3*n+a]-COMxp[a];
+        for(a=0;a<3;a++) {
+            Gx+=w[n]*x[3*n+a]*x[3*n+a];
+            Gxp+=w[n]*xpc[a]*xpc[a];
+            for(b=0;b<3;b++) {
+                S[a][b]+=w[n]*x[3*n+a]*xpc[b];
+            }
+        }
+    }
+    E0=0.5*(Gx+Gxp);
+
+    /* symmetric key matrix, its largest eigenvalue gives the RMSD
+     * and the corresponding eigenvector the optimal rotation (as quaternion) */
+    K[0][0]= S[0][0]+S[1][1]+S[2][2];
+    K[1][1]= S[0][0]-S[1][1]-S[2][2];
+    K[2][2]=-S[0][0]+S[1][1]-S[2][2];
+    K[3][3]=-S[0][0]-S[1][1]+S[2][2];
+    K[0][1]=K[1][0]=S[1][2]-S[2][1];
+    K[0][2]=K[2][0]=S[2][0]-S[0][2];
+    K[0][3]=K[3][0]=S[0][1]-S[1][0];
+    K[1][2]=K[2][1]=S[0][1]+S[1][0];
+    K[1][3]=K[3][1]=S[2][0]+S[0][2];
+    K[2][3]=K[3][2]=S[1][2]+S[2][1];
+
+    /* characteristic polynomial P(l) = l^4 + c2*l^2 + c1*l + c0 */
+    c2=0.0;
+    for(a=0;a<3;a++) {
+        for(b=0;b<3;b++) c2+=S[a][b]*S[a][b];
+    }
+    c2*=-2.0;
+    c1=-8.0*det3(S);
+    c0=0.0;
+    for(j=0;j<4;j++) {
+        c0+=((j%2==0)?1.0:-1.0)*K[0][j]*minor4(K,0,j);
+    }
+
+    /* Newton-Raphson for the largest root, E0 is an upper bound */
+    lambda=E0;
+    for(i=0;i<50;i++) {
+        p=((lambda*lambda+c2)*lambda+c1)*lambda+c0;
+        dp=(4.0*lambda*lambda+2.0*c2)*lambda+c1;
+        if(dp==0.0) break;
+        delta=p/dp;
+        lambda-=delta;
+        if(fabs(delta)<1e-11*fabs(lambda)) break;
+    }
+    msd=2.0*(E0-lambda)/totMass;
+
+    /* eigenvector: any non-zero column of the adjugate of (K - lambda*I) */
+    for(a=0;a<4;a++) K[a][a]-=lambda;
+    qmax=0.0;
+    best=-1;
+    for(j=0;j<4;j++) {
+        norm=0.0;
+        for(i=0;i<4;i++) {
+            qn=(((i+j)%2==0)?1.0:-1.0)*minor4(K,j,i);
+            norm+=qn*qn;
+        }
+        if(norm>qmax) {
+            qmax=norm;
+            best=j;
+        }
+    }
+    if(best<0 || qmax<1e-24*E0*E0*E0*E0*E0*E0) {
+        /* degenerate case (e.g. single atom), no rotation */
+        clear_mat(R);
+        R[0][0]=R[1][1]=R[2][2]=1.0;
+        return (float)sqrt(msd>0.0?msd:0.0);
+    }
+    for(i=0;i<4;i++) {
+        q[i]=(((i+best)%2==0)?1.0:-1.0)*minor4(K,best,i);
+    }
+    norm=sqrt(q[0]*q[0]+q[1]*q[1]+q[2]*q[2]+q[3]*q[3]);
+    for(i=0;i<4;i++) q[i]/=norm;
+
+    R[0][0]=q[0]*q[0]+q[1]*q[1]-q[2]*q[2]-q[3]*q[3];
+    R[0][1]=2.0*(q[1]*q[2]-q[0]*q[3]);
+    R[0][2]=2.0*(q[1]*q[3]+q[0]*q[2]);
+    R[1][0]=2.0*(q[1]*q[2]+q[0]*q[3]);
+    R[1][1]=q[0]*q[0]-q[1]*q[1]+q[2]*q[2]-q[3]*q[3];
+    R[1][2]=2.0*(q[2]*q[3]-q[0]*q[1]);
+    R[2][0]=2.0*(q[1]*q[3]-q[0]*q[2]);
+    R[2][1]=2.0*(q[2]*q[3]+q[0]*q[1]);
+    R[2][2]=q[0]*q[0]-q[1]*q[1]-q[2]*q[2]+q[3]*q[3];
+
+    return (float)sqrt(msd>0.0?msd:0.0);
+}
+
+/* mass-weighted RMSD between R*x (centered) and xp (COM at COMxp) */
+float fitRMSD(int natoms,double *w,float *xp,float *COMxp,double totMass,float *x,matrix R)
+{
+    double msd=0.0,d;
+    int n,a,c;
+
+    for(n=0;n<natoms;n++) {
+        for(a=0;a<3;a++) {
+            d=xp[3*n+a]-COMxp[a];
+            for(c=0;c<3;c++) d-=R[a][c]*x[3*n+c];
+            msd+=w[n]*d*d;
+        }
+    }
+    return (float)sqrt(msd/totMass);
+}
+
 int residueCOM(t_residue *res,float *crd) {
     int i;
     float *crdPtr;
@@ -322,13 +491,43 @@ int addVec(int nAtoms,float *crdVel,float *add) {
     return 0;
 }
 
+/* rotation matrix fitting the (centered) reference group onto the fixed reference */
+void calcRot(t_align *align,matrix R) {
+    if(align->fitMethod==FIT_QCP) {
+        align->rmsd=calc_fit_R_qcp(align->nAtomsRef,align->massesRef,align->crdRefFix,align->COMrefFix,
+                                   align->totMassRef,align->crdRef,R);
+    } else {
+        /* reference implementation (Jacobi diagonalization) */
+        calc_fit_R(align->nAtomsRef,align->massesRef,align->crdRefFix,align->crdRef,R);
+        align->rmsd=fitRMSD(align->nAtomsRef,align->massesRef,align->crdRefFix,align->COMrefFix,
+                            align->totMassRef,align->crdRef,R);
+    }
+}
+
+void rotBox(t_align *align,matrix R) {
+    int j,c;
+    float x_old[3];
+
+    for(j=0;j<3;j++) {
+        x_old[0]=align->box[j*3+0];
+        x_old[1]=align->box[j*3+1];
+        x_old[2]=align->box[j*3+2];
+        align->box[j*3+0]=0.0;
+        for(c=0; c<3; c++) align->box[j*3+0]+=R[0][c]*x_old[c];
+        align->box[j*3+1]=0.0;
+        for(c=0; c<3; c++) align->box[j*3+1]+=R[1][c]*x_old[c];
+        align->box[j*3+2]=0.0;
+        for(c=0; c<3; c++) align->box[j*3+2]+=R[2][c]*x_old[c];
+    }
+}
+
 int alignRot(t_align *align,int doVel) {
     int j,c;
     matrix R;
     float x_old[3],v_old[3];
     
     /* Calculate the rotation matrix R */
-    calc_fit_R(align->nAtomsRef,align->massesRef,align->crdRefFix,align->crdRef,R);
+    calcRot(align,R);
 
     /* rotate all coords */
     for(j=0;j<align->nAtomsSys;j++) {
@@ -357,17 +556,7 @@ int alignRot(t_align *align,int doVel) {
         }
     }
     /* rotate box */
-    for(j=0;j<3;j++) {
-        x_old[0]=align->box[j*3+0];
-        x_old[1]=align->box[j*3+1];
-        x_old[2]=align->box[j*3+2];
-        align->box[j*3+0]=0.0;
-        for(c=0; c<3; c++) align->box[j*3+0]+=R[0][c]*x_old[c];
-        align->box[j*3+1]=0.0;
-        for(c=0; c<3; c++) align->box[j*3+1]+=R[1][c]*x_old[c];
-        align->box[j*3+2]=0.0;
-        for(c=0; c<3; c++) align->box[j*3+2]+=R[2][c]*x_old[c];
-    }
+    rotBox(align,R);
 
     return 0;
 }
@@ -393,6 +582,9 @@ int setup(t_align *align,int nAtomsRef,double *massesRef,float *refCrd,int nAtom
     int offset=0;
     double *massPtr;
 
+    if(nRes<1) {
+        return ERR_NO_RESIDUES;
+    }
     align->nAtomsRef=nAtomsRef;
     /* prep reference atom coordinates */
     align->crdRefFix=(float*)malloc(3*nAtomsRef*sizeof(float));
@@ -431,10 +623,11 @@ int alignCrdVel(t_align *align,float *crdRef,float *velRef,float *crdSys,float *
     float refCOM[3];
     float refCOMvel[3];
     float halfBox[3];
-    float pbcJump[0];
+    float pbcJump[3];
     float *crdPtr;
 
     align->crdRef=crdRef;
+    align->rmsd=-1.0;
     align->crdSys=crdSys;
     align->velSys=velSys;
     copyFloatArray(align->box,box,9);
@@ -449,8 +642,7 @@ int alignCrdVel(t_align *align,float *crdRef,float *velRef,float *crdSys,float *
         }
         if(align->placeCOMInBox!=0) {
             if(align->resSys==NULL) {
-                fprintf(stderr,"Error: align->sysRes is NULL\n -> align\n -> align.c\n");
-                return 1;
+                return ERR_NO_RESIDUES;
             }
             halfBox[0]=box[0]/2;
             halfBox[1]=box[4]/2;
@@ -486,10 +678,11 @@ int alignCrd(t_align *align,float *crdRef,float *crdSys,float *box) {
     int i;
     float refCOM[3];
     float halfBox[3];
-    float pbcJump[0];
+    float pbcJump[3];
     float *crdPtr;
 
     align->crdRef=crdRef;
+    align->rmsd=-1.0;
     align->crdSys=crdSys;
     copyFloatArray(align->box,box,9);
     
@@ -499,8 +692,7 @@ int alignCrd(t_align *align,float *crdRef,float *crdSys,float *box) {
         subVec(align->nAtomsSys,crdSys,refCOM);
         if(align->placeCOMInBox!=0) {
             if(align->resSys==NULL) {
-                fprintf(stderr,"Error: align->sysRes is NULL\n -> align\n -> align.c\n");
-                return 1;
+                return ERR_NO_RESIDUES;
             }
             halfBox[0]=box[0]/2;
             halfBox[1]=box[4]/2;
@@ -530,4 +722,178 @@ int alignCrd(t_align *align,float *crdRef,float *crdSys,float *box) {
         }
     }
     return 0;
-}
\ No newline at end of file
+}
+/* translate -> PBC residue shift -> rotate -> re-translate in a single pass over the atoms
+ * for coordinates and (if doVel!=0) velocities, same results as alignCrd/alignCrdVel */
+int alignFused(t_align *align,float *crdRef,float *velRef,float *crdSys,float *velSys,int doVel,float *box) {
+    int i,j,c,r,nItems;
+    float refCOM[3];
+    float refCOMvel[3]={0.0,0.0,0.0};
+    float shift[3]={0.0,0.0,0.0};
+    float halfBox[3];
+    matrix R;
+    int doRot,rotVel,inBox;
+
+    align->crdRef=crdRef;
+    align->crdSys=crdSys;
+    align->velSys=velSys;
+    align->rmsd=-1.0;
+    copyFloatArray(align->box,box,9);
+    if(align->align==0) return 0;
+
+    /* everything that only depends on the reference group comes first */
+    generalCOM(align->nAtomsRef,align->massesRef,align->totMassRef,crdRef,refCOM);
+    subVec(align->nAtomsRef,crdRef,refCOM);
+    if(doVel!=0 && align->subCOMvel!=0) {
+        generalCOM(align->nAtomsRef,align->massesRef,align->totMassRef,velRef,refCOMvel);
+    }
+    doRot=(align->rotate!=0);
+    rotVel=(doRot && doVel!=0 && align->rotVel!=0);
+    if(doRot) {
+        calcRot(align,R);
+        rotBox(align,R);
+    }
+    if(align->centerCOM==0) {
+        copyFloatArray(shift,align->COMrefFix,3);
+    }
+    inBox=(align->placeCOMInBox!=0);
+    if(inBox && align->resSys==NULL) {
+        return ERR_NO_RESIDUES;
+    }
+    halfBox[0]=box[0]/2;
+    halfBox[1]=box[4]/2;
+    halfBox[2]=box[8]/2;
+
+    /* residues (or single atoms without PBC shift) are independent work items */
+    nItems=inBox?align->nResSys:align->nAtomsSys;
+    #pragma omp parallel for private(i,j,c) schedule(static) if(align->nAtomsSys>10000)
+    for(r=0;r<nItems;r++) {
+        int first,last;
+        float COM[3]={0.0,0.0,0.0};
+        float pbcJump[3]={0.0,0.0,0.0};
+        float x_old[3],v_old[3],x_new,v_new;
+        t_residue *res;
+
+        if(inBox) {
+            res=&align->resSys[r];
+            first=res->offset;
+            last=res->offset+res->nAtoms;
+            /* residue COM after removing the reference COM */
+            for(j=first;j<last;j++) {
+                for(c=0;c<3;c++) {
+                    x_old[c]=crdSys[3*j+c]-refCOM[c];
+                    COM[c]+=res->masses[j-first]*x_old[c];
+                }
+            }
+            for(c=0;c<3;c++) {
+                COM[c]/=res->totMass;
+            }
+            if(COM[0]<-halfBox[0]) pbcJump[0]+=box[0];
+            if(COM[0]> halfBox[0]) pbcJump[0]-=box[0];
+            if(COM[1]<-halfBox[1]) pbcJump[1]+=box[4];
+            if(COM[1]> halfBox[1]) pbcJump[1]-=box[4];
+            if(COM[2]<-halfBox[2]) pbcJump[2]+=box[8];
+            if(COM[2]> halfBox[2]) pbcJump[2]-=box[8];
+        } else {
+            first=r;
+            last=r+1;
+        }
+        for(j=first;j<last;j++) {
+            for(c=0;c<3;c++) {
+                x_old[c]=crdSys[3*j+c]-refCOM[c];
+                x_old[c]+=pbcJump[c];
+            }
+            for(i=0;i<3;i++) {
+                if(doRot) {
+                    x_new=0.0;
+                    for(c=0;c<3;c++) x_new+=R[i][c]*x_old[c];
+                } else {
+                    x_new=x_old[i];
+                }
+                crdSys[3*j+i]=x_new+shift[i];
+            }
+            if(doVel!=0) {
+                for(c=0;c<3;c++) {
+                    v_old[c]=velSys[3*j+c]-refCOMvel[c];
+                }
+                for(i=0;i<3;i++) {
+                    if(rotVel) {
+                        v_new=0.0;
+                        for(c=0;c<3;c++) v_new+=R[i][c]*v_old[c];
+                    } else {
+                        v_new=v_old[i];
+                    }
+                    velSys[3*j+i]=v_new;
+                }
+            }
+        }
+    }
+    return 0;
+}
+
+/* align a block of frames: crd[nFrames][nAtomsSys][3], vel[nFrames][nAtomsSys][3] (if doVel!=0)
+ * boxes[nFrames][9] (box vectors, replaced by the rotated box vectors)
+ * reference coordinates are taken from the system coordinates (refIdx) before alignment
+ * rmsd[nFrames] receives the RMSD of the reference group after fitting (-1 if not rotated)
+ * error receives the code and frame of the first failed frame */
+int alignFrames(t_align *align,int nFrames,int *refIdx,float *crd,float *vel,int doVel,float *boxes,float *rmsd,t_error *error) {
+    int code=0;
+    int failed=-1;
+
+    /*frames are independent, each thread works on private copies of the alignment state*/
+    #pragma omp parallel
+    {
+        t_align local;
+        float *crdRef,*velRef;
+        size_t off;
+        int f,i,m;
+        int err;
+
+        local=*align;
+        local.resSys=(t_residue*)malloc(align->nResSys*sizeof(t_residue));
+        for(i=0;i<align->nResSys;i++) {
+            local.resSys[i]=align->resSys[i];
+        }
+        crdRef=(float*)malloc(3*align->nAtomsRef*sizeof(float));
+        velRef=(float*)malloc(3*align->nAtomsRef*sizeof(float));
+        #pragma omp for schedule(static)
+        for(f=0;f<nFrames;f++) {
+            off=(size_t)3*align->nAtomsSys*f;
+            for(i=0;i<align->nAtomsRef;i++) {
+                for(m=0;m<3;m++) {
+                    crdRef[3*i+m]=crd[off+3*refIdx[i]+m];
+                    if(doVel!=0) velRef[3*i+m]=vel[off+3*refIdx[i]+m];
+                }
+            }
+            if(align->fused!=0) {
+                err=alignFused(&local,crdRef,velRef,crd+off,vel+off,doVel,boxes+9*f);
+            } else if(doVel!=0) {
+                err=alignCrdVel(&local,crdRef,velRef,crd+off,vel+off,boxes+9*f);
+            } else {
+                err=alignCrd(&local,crdRef,crd+off,boxes+9*f);
+            }
+            copyFloatArray(boxes+9*f,local.box,9);
+            rmsd[f]=local.rmsd;
+            if(err!=0) {
+                #pragma omp critical
+                {
+                    if(code==0 || f<failed) {
+                        code=err;
+                        failed=f;
+                    }
+                }
+            }
+        }
+        free(crdRef);
+        free(velRef);
+        free(local.resSys);
+    }
+    if(code!=0 && error!=NULL) {
+        error->code=code;
+        error->frame=failed;
+        error->index=-1;
+        error->value=0;
+        error->limit=nFrames;
+    }
+    return code;
+}
@@ -1,190 +1,176 @@
 #include <stdio.h>
 #include <stdlib.h>
 
-typedef struct t_branch {
-    int node;
-    struct t_branch* links;
-    int nLinks;
-} t_branch;
-
+/* molecules are stored as flat breadth-first trees:
+ * edge e connects atom parent[e] (already placed) with atom child[e],
+ * the edges of tree t are edgeStart[t] ... edgeStart[t+1]-1 */
 typedef struct t_trees {
-    t_branch *trees;
     int nTrees;
+    int nEdges;
+    int *root;
+    int *edgeStart;
+    int *parent;
+    int *child;
 } t_trees;
 
-int getNextRoot(int nAtoms,int *atomTags) {
-    int i;
-    int node=-1;
-    for(i=0;i<nAtoms;i++) {
-        if(atomTags[i]==0) {
-            node=i;
-            atomTags[i]=1;
-            return node;
-        }
-    }
-    return node;
-}
+/* error details returned to the caller (metrics.t_error), code 0 = no error */
+typedef struct t_error {
+    int code;
+    int frame;
+    int index;
+    int value;
+    int limit;
+} t_error;
 
-int buildTree(    t_branch *tree,
-        int nAtoms,int *atomTags,
-        int nBonds,int *bondTags,
-        int *bondList,int *bondStart) {
-    int i,b0,b1;
-    int node;
-    int tmp[10]; /*temporary storage*/
-    int count=0; /*number of bonds found for current node*/
-    int continuous=1;  /*track if any bonds were skipped*/
-    t_branch *next;
-    int error;
+#define ERR_BOND_RANGE 1
+#define ERR_DUMMY_FIRST 2
 
-    node=tree->node;
-    i=bondStart[0];
-    while(i<nBonds && count<10) {
-        b0=bondList[i*2+0];
-        b1=bondList[i*2+1];
-    
-        if((b0<0 || b0>=nAtoms) || (b1<0 || b1>=nAtoms)) {
-            FILE *err;
-            err=fopen("error.log","a");
-            fprintf(err,"ERROR: function wrap()\n aroms %d %d in bond %d out of range (0-%d)\n",b0,b1,i,nAtoms);
-            fclose(err);
-            return 1;
-        }
-        if(b0==node && atomTags[b1]==0) {
-            tmp[count]=b1;
-            count++;
-            atomTags[b1]=1;
-            bondTags[i]=1;
-        }
-        if(b1==node && atomTags[b0]==0) {
-            tmp[count]=b0;
-            count++;
-            atomTags[b0]=1;
-            bondTags[i]=1;
-        }
-        if(atomTags[b0]==1 && atomTags[b1]==1) {
-            bondTags[i]=1;
-        }
-        if(continuous==1 && bondTags[i]==0) {
-            continuous=0;
-            bondStart[0]=i;
-        }
-        i++;
-        if(continuous==0 && (b0>node && b1>node)) {
-            /*bondList is assumed to be sorted*/
-            /*therefore we can break the loop now*/
-            break;
-        }
-    }
-    if(count==10) {
-        FILE *err;
-        err=fopen("error.log","a");
-        fprintf(err,"ERROR: function wrap()\n found >=10 bonds for atom %d\n",node);
-        fclose(err);
-        return 1;
-    }
-    tree->nLinks=count;
-    tree->links=(t_branch*)malloc(count*sizeof(t_branch));
-    for(i=0;i<count;i++) {
-        tree->links[i].node=tmp[i];
+/* interface version checked by backends.py, increase with incompatible changes of the exported functions */
+int abiVersion(void) {
+    return 1;
+}
+
+int setError(t_error *error,int code,int frame,int index,int value,int limit) {
+    if(error!=NULL) {
+        error->code=code;
+        error->frame=frame;
+        error->index=index;
+        error->value=value;
+        error->limit=limit;
     }
-    if(count==0) {
-        return 0;
-    } else {
-        for(i=0;i<count;i++) {
-            next=&(tree->links[i]);
-            error=buildTree(next,nAtoms,atomTags,nBonds,bondTags,bondList,bondStart);
-            if(error==1) return 1;
+    return code;
+}
+
+int getNextRoot(int nAtoms,int *atomTags,int *cursor) {
+    int i;
+    /*all atoms before the cursor have been assigned to a tree already*/
+    for(i=cursor[0];i<nAtoms;i++) {
+        if(atomTags[i]==0) {
+            atomTags[i]=1;
+            cursor[0]=i+1;
+            return i;
         }
-        return 0;
     }
+    cursor[0]=nAtoms;
+    return -1;
 }
 
-int buildTrees(t_trees *trees,int nAtoms,int *atomTags,int nBonds,int *bondTags,int *bondList,float *masses) {
+/* bonds are passed as adjacency list in CSR format:
+ * the bonded neighbors of atom i are neighbors[offsets[i]] ... neighbors[offsets[i+1]-1] */
+int buildTrees(t_trees *trees,int nAtoms,int *atomTags,int *offsets,int *neighbors,float *masses,t_error *error) {
     int cnt=0;
     int node;
-    int bondStart=0;
-    t_branch *tree;
-    int error;
-    t_branch *tmp;
-    int i;
+    int cursor=0;
+    int e,i,nb;
 
-    trees->trees=(t_branch*)malloc(nAtoms*sizeof(t_branch));
-    node=getNextRoot(nAtoms,atomTags);
+    trees->root=(int*)malloc(nAtoms*sizeof(int));
+    trees->edgeStart=(int*)malloc((nAtoms+1)*sizeof(int));
+    /*every atom is the child of at most one edge*/
+    trees->parent=(int*)malloc(nAtoms*sizeof(int));
+    trees->child=(int*)malloc(nAtoms*sizeof(int));
+    trees->nEdges=0;
+    trees->nTrees=0;
+    node=getNextRoot(nAtoms,atomTags,&cursor);
     while(node!=-1) {
-        tree=&(trees->trees[cnt]);
-        tree->node=node;
-        error=buildTree(tree,nAtoms,atomTags,nBonds,bondTags,bondList,&bondStart);
-        if(error==1) return 1;
-        if(tree->nLinks==0 && masses[node]==0.0) {
+        trees->root[cnt]=node;
+        trees->edgeStart[cnt]=trees->nEdges;
+        /*breadth-first search: the edge list itself is the queue of nodes*/
+        e=trees->nEdges;
+        while(node!=-1) {
+            for(i=offsets[node];i<offsets[node+1];i++) {
+                nb=neighbors[i];
+                if(nb<0 || nb>=nAtoms) {
+                    return setError(error,ERR_BOND_RANGE,-1,node,nb,nAtoms);
+                }
+                if(atomTags[nb]==0) {
+                    atomTags[nb]=1;
+                    trees->parent[trees->nEdges]=node;
+                    trees->child[trees->nEdges]=nb;
+                    trees->nEdges++;
+                }
+            }
+            if(e<trees->nEdges) {
+                node=trees->child[e];
+                e++;
+            } else {
+                node=-1;
+            }
+        }
+        node=trees->root[cnt];
+        if(trees->nEdges==trees->edgeStart[cnt] && masses[node]==0.0) {
             /*found isolated atoms with zero mass == dummy atom*/
             /*ensure that this is not the first tree (not allowed = error)*/
-            if(cnt==0) return 1;
+            if(cnt==0) return setError(error,ERR_DUMMY_FIRST,-1,node,0,nAtoms);
             /*will pretend there is a bond with first atom of previous molecule/tree*/
-            /*first we create a copy of all branches connected to root of last tree*/
-            /*we reserve space for one extra branch (+1) to connect the isolated atom*/
-            tmp=(t_branch*)malloc((trees->trees[cnt-1].nLinks+1)*sizeof(t_branch));
-            for(i=0;i<trees->trees[cnt-1].nLinks;i++) {
-                tmp[i].node=trees->trees[cnt-1].links[i].node;
-                tmp[i].links=trees->trees[cnt-1].links[i].links; /*pointers connecting to downstream branches*/
-                tmp[i].nLinks=trees->trees[cnt-1].links[i].nLinks;
-            }
-            tmp[i].node=node;
-            tmp[i].nLinks=0;
-            free(trees->trees[cnt-1].links);
-            trees->trees[cnt-1].links=tmp;
-            trees->trees[cnt-1].nLinks+=1;
+            /*edges of the previous tree are the last ones, so we can simply append*/
+            trees->parent[trees->nEdges]=trees->root[cnt-1];
+            trees->child[trees->nEdges]=node;
+            trees->nEdges++;
         } else {
             cnt++;
         }
-        node=getNextRoot(nAtoms,atomTags);
+        node=getNextRoot(nAtoms,atomTags,&cursor);
     }
+    trees->edgeStart[cnt]=trees->nEdges;
     trees->nTrees=cnt;
     return 0;
 }
 
-int unwrapTree(t_branch branch,float *coords,float *box) {
-    int i,m;
-    int node;
-    float nodeCrd[3];
-    int atomIdx;
-    float atomCrd[3];
-    float link[3];
-    int nLinks;
-    int error;
+void freeTrees(t_trees *trees) {
+    free(trees->root);
+    free(trees->edgeStart);
+    free(trees->parent);
+    free(trees->child);
+    trees->root=NULL;
+    trees->edgeStart=NULL;
+    trees->parent=NULL;
+    trees->child=NULL;
+    trees->nTrees=0;
+    trees->nEdges=0;
+}
 
-    node=branch.node;
-    for(m=0;m<3;m++) {
-        nodeCrd[m]=coords[3*node+m];
-    }
-    nLinks=branch.nLinks;
-    for(i=0;i<nLinks;i++) {
-        atomIdx=branch.links[i].node;
+void unwrapTree(t_trees *trees,int t,float *coords,float *box) {
+    int e,m;
+    int node,atomIdx;
+    float link;
+
+    for(e=trees->edgeStart[t];e<trees->edgeStart[t+1];e++) {
+        node=trees->parent[e];
+        atomIdx=trees->child[e];
         for(m=0;m<3;m++) {
-            atomCrd[m]=coords[3*atomIdx+m];
-            link[m]=atomCrd[m]-nodeCrd[m];
-            while(link[m]>box[m]/2.0) {
-                link[m]-=box[m];
+            link=coords[3*atomIdx+m]-coords[3*node+m];
+            while(link>box[m]/2.0) {
+                link-=box[m];
             }
-            while(link[m]<-1.0*box[m]/2.0) {
-                link[m]+=box[m];
+            while(link<-1.0*box[m]/2.0) {
+                link+=box[m];
             }
-            coords[3*atomIdx+m]=nodeCrd[m]+link[m];
-        }
-        if(branch.links[i].nLinks!=0) {
-            error=unwrapTree(branch.links[i],coords,box);
-            if(error==1) return 1;
+            coords[3*atomIdx+m]=coords[3*node+m]+link;
         }
     }
-    return 0;
 }
 
 int unwrap(t_trees trees,float *coords,float *box) {
-    int i,j;
-    int error;
-    for(i=0;i<trees.nTrees;i++) {
-        error=unwrapTree(trees.trees[i],coords,box);
-        if(error==1) return 1;
+    int t;
+
+    /*trees (molecules) are independent, edges within a tree are ordered*/
+    #pragma omp parallel for schedule(static) if(trees.nTrees>1000)
+    for(t=0;t<trees.nTrees;t++) {
+        unwrapTree(&trees,t,coords,box);
+    }
+    return 0;
+}
+
+/* unwrap a block of frames: coords[nFrames][nAtoms][3], boxes[nFrames][6] (box dimensions) */
+int unwrapFrames(t_trees trees,int nFrames,int nAtoms,float *coords,float *boxes) {
+    int f,t;
+
+    /*frames are independent*/
+    #pragma omp parallel for private(t) schedule(static)
+    for(f=0;f<nFrames;f++) {
+        for(t=0;t<trees.nTrees;t++) {
+            unwrapTree(&trees,t,coords+(size_t)3*nAtoms*f,boxes+6*f);
+        }
     }
     return 0;
 }
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from concurrent import futures
+import numpy as np
+from scipy import fft as sfft
+import fresean
+import store
+
+def _files(filename):
+    """auxiliary files of a distributed build next to the output store"""
+    return dict(meta=f"{filename}.json",
+                velFFT=f"{filename}.velfft.npy",
+                winTime=f"{filename}.win.npy",
+                tiles=f"{filename}.tiles.npy")
+
+def _digest(velocities, blockSize=256):
+    """SHA-256 of the velocity content, hashed block by block (no copy of the whole array)"""
+    velocities = np.asarray(velocities)
+    h = hashlib.sha256(f"{velocities.dtype.str}{velocities.shape}".encode())
+    for i0 in range(0, len(velocities), blockSize):
+        h.update(np.ascontiguousarray(velocities[i0:i0 + blockSize]).tobytes())
+    return h.hexdigest()
+
+def tiles(nDOF, blockSize):
+    """
+    upper triangle of (i-block, j-block) tiles, ordered by decreasing cost
+    (number of DOF pairs, smaller edge tiles last) for load balancing
+    returns: [nTiles, 2] block start indices (i0, j0)
+    """
+    starts = np.arange(0, nDOF, blockSize)
+    i0, j0 = np.triu_indices(len(starts))
+    tileStarts = np.c_[starts[i0], starts[j0]]
+    sizes = np.minimum(tileStarts + blockSize, nDOF) - tileStarts
+    cost = sizes[:, 0] * sizes[:, 1]
+    # stable sort keeps row-major order among tiles of equal cost
+    return tileStarts[np.argsort(-cost, kind='stable')]
+
+def schedule(nDOF, blockSize, nRanks):
+    """
+    static assignment of tiles to ranks (longest processing time first)
+    returns: list of tile indices for each rank
+    """
+    tileStarts = tiles(nDOF, blockSize)
+    sizes = np.minimum(tileStarts + blockSize, nDOF) - tileStarts
+    cost = sizes[:, 0] * sizes[:, 1]
+    load = np.zeros(nRanks)
+    assignment = [[] for r in range(nRanks)]
+    for t in range(len(tileStarts)):
+        r = np.argmin(load)
+        assignment[r].append(t)
+        load[r] += cost[t]
+    return assignment
+
+def _fft_rows(block, real, workers=None):
+    """FFT along the time axis of a block of DOFs (Eq. 2)"""
+    if real:
+        return sfft.rfft(block, axis=1, workers=workers)
+    return sfft.fft(block, axis=1, workers=workers)
+
+def prepare(velocities, nCorr, winTime, filename, blockSize=256, transform='real', dtype=np.float64,
+            storeDtype=np.float64, packed=False, workers=None):
+    """
+    set up a distributed build (done once, before the workers/ranks start)
+    - Fourier transformed velocities are written to a memory-mapped file shared read-only by all workers
+    - the output store.corrStore and a file with the completed tiles are created
+    an existing build with the same parameters and velocities (SHA-256 of the content) is kept and resumed
+    """
+    files = _files(filename)
+    nDOF, nFrames = np.shape(velocities)
+    digest = _digest(velocities)
+    velocities, real = fresean.prepare_velocities(velocities, transform, dtype)
+    meta = dict(nDOF=nDOF,
+                nFrames=nFrames,
+                nCorr=nCorr,
+                blockSize=blockSize,
+                transform='real' if real else 'complex',
+                dtype=np.dtype(dtype).name,
+                storeDtype=np.dtype(storeDtype).name,
+                packed=packed,
+                velocities=digest)
+    if os.path.exists(files['meta']):
+        with open(files['meta']) as f:
+            previous = json.load(f)
+        if previous == meta and np.array_equal(np.load(files['winTime']), winTime):
+            print(f"resuming build of {filename}: {int(np.sum(np.load(files['tiles'])))} tiles completed")
+            return meta
+        print(f"parameters of {filename} changed, starting a new build")
+        os.remove(files['meta'])
+    velFFT = np.lib.format.open_memmap(files['velFFT'], mode='w+',
+                                       dtype=np.result_type(dtype, np.complex64),
+                                       shape=(nDOF, nFrames // 2 + 1 if real else nFrames))
+    for i0 in range(0, nDOF, blockSize):
+        velFFT[i0:i0 + blockSize] = _fft_rows(velocities[i0:i0 + blockSize], real, workers)
+    velFFT.flush()
+    del velFFT
+    np.save(files['winTime'], winTime)
+    out = store.corrStore(filename, nCorr, nDOF, dtype=storeDtype, packed=packed)
+    out.flush()
+    del out
+    np.save(files['tiles'], np.zeros(len(tiles(nDOF, blockSize)), dtype=np.int8))
+    # metadata is written last, a build without it is started from scratch
+    with open(files['meta'], 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+def run_tiles(filename, tileIds=None, rank=None, nRanks=None, workers=1):
+    """
+    compute tiles of a prepared build and write them into the shared output store
+    tileIds: tiles to compute (default: all tiles assigned to rank by schedule())
+    rank, nRanks: position in a locally launched MPI-style job (default: all tiles)
+    completed tiles are skipped, so a crashed build continues where it stopped
+    returns: number of tiles computed
+    """
+    files = _files(filename)
+    with open(files['meta']) as f:
+        meta = json.load(f)
+    nDOF = meta['nDOF']
+    blockSize = meta['blockSize']
+    nFrames = meta['nFrames']
+    tileStarts = tiles(nDOF, blockSize)
+    if tileIds is None:
+        if rank is None:
+            tileIds = range(len(tileStarts))
+        else:
+            tileIds = schedule(nDOF, blockSize, nRanks)[rank]
+    velFFT = np.load(files['velFFT'], mmap_mode='r')
+    winTime = np.load(files['winTime']).astype(meta['dtype'])
+    done = np.load(files['tiles'], mmap_mode='r+')
+    out = store.corrStore(filename, mode='r+')
+    nReal = nFrames if meta['transform'] == 'real' else None
+    nComputed = 0
+    for t in tileIds:
+        if done[t]:
+            continue
+        i0, j0 = tileStarts[t]
+        iSlice = slice(i0, min(i0 + blockSize, nDOF))
+        jSlice = slice(j0, min(j0 + blockSize, nDOF))
+        tile = fresean.tile_spectra(velFFT, iSlice, jSlice, meta['nCorr'], winTime, workers, nReal)
+        # tile is [bi, bj, nCorr] -> store as [nCorr, bi, bj]
+        tile = np.moveaxis(tile, -1, 0).astype(np.float64, copy=False)
+        # correct for implicit multiplication in power spectrum
+        tile /= nFrames
+        out.set_block(iSlice, jSlice, tile)
+        # a tile is marked as completed only after its data is on disk
+        out.flush()
+        done[t] = 1
+        done.flush()
+        nComputed += 1
+    return nComputed
+
+def _run_task(filename, tileIds, workers):
+    return run_tiles(filename, tileIds=tileIds, workers=workers)
+
+def status(filename):
+    """(completed tiles, total tiles) of a build"""
+    done = np.load(_files(filename)['tiles'])
+    return int(np.sum(done)), len(done)
+
+def finish(filename, cleanup=True):
+    """open the completed store, auxiliary files are removed (cleanup=True)"""
+    nDone, nTiles = status(filename)
+    if nDone < nTiles:
+        raise ValueError(f"{filename}: only {nDone} of {nTiles} tiles completed")
+    if cleanup:
+        # metadata first, an interrupted cleanup never looks like a resumable build
+        for key in ('meta', 'velFFT', 'winTime', 'tiles'):
+            os.remove(_files(filename)[key])
+    return store.corrStore(filename, mode='r+')
+
+def correlation_matrix(velocities,
+                       nCorr,
+                       winTime,
+                       filename,
+                       blockSize=256,
+                       nWorkers=4,
+                       tilesPerTask=1,
+                       transform='real',
+                       dtype=np.float64,
+                       storeDtype=np.float64,
+                       packed=False,
+                       workers=1,
+                       cleanup=True):
+    """
+    velocity correlation matrix (same as fresean.correlation_matrix) built by a pool
+    of worker processes that write tiles straight into a memory-mapped store.corrStore
+    - tiles are handed out dynamically, largest first, to balance the load
+    - the build resumes after a crash when called again with the same parameters
+
+    filename: output store (.npy), auxiliary files use it as prefix
+    nWorkers: number of worker processes
+    tilesPerTask: number of tiles per task sent to a worker
+    workers: scipy.fft threads per worker process
+    returns: store.corrStore
+    """
+    prepare(velocities, nCorr, winTime, filename,
+            blockSize=blockSize,
+            transform=transform,
+            dtype=dtype,
+            storeDtype=storeDtype,
+            packed=packed)
+    done = np.load(_files(filename)['tiles'])
+    todo = [t for t in range(len(done)) if not done[t]]
+    tasks = [todo[i:i + tilesPerTask] for i in range(0, len(todo), tilesPerTask)]
+    if nWorkers > 1:
+        with fresean.pinned_env(workers), \
+             futures.ProcessPoolExecutor(max_workers=nWorkers,
+                                         mp_context=multiprocessing.get_context('spawn')) as executor:
+            for task in [executor.submit(_run_task, filename, tileIds, workers) for tileIds in tasks]:
+                task.result()
+    else:
+        run_tiles(filename, tileIds=todo, workers=workers)
+    return finish(filename, cleanup=cleanup)
+
+def _env_rank():
+    """rank and number of ranks set by common MPI launchers"""
+    for rankVar, sizeVar in (('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE'),
+                             ('PMI_RANK', 'PMI_SIZE'),
+                             ('SLURM_PROCID', 'SLURM_NTASKS')):
+        if rankVar in os.environ and sizeVar in os.environ:
+            return int(os.environ[rankVar]), int(os.environ[sizeVar])
+    return None, None
+
+if __name__ == '__main__':
+    # MPI-style use after prepare():  mpirun -n 8 python distributed.py corr.npy
+    # or without a launcher:          python distributed.py corr.npy <rank> <nRanks>
+    filename = sys.argv[1]
+    if len(sys.argv) > 3:
+        rank, nRanks = int(sys.argv[2]), int(sys.argv[3])
+    else:
+        rank, nRanks = _env_rank()
+    n = run_tiles(filename, rank=rank, nRanks=nRanks)
+    nDone, nTiles = status(filename)
+    print(f"rank {rank}: {n} tiles computed, {nDone} of {nTiles} tiles completed")
@@ -0,0 +1,561 @@
+import contextlib
+import multiprocessing
+import os
+from concurrent import futures
+import numpy as np
+from scipy import fft as sfft
+from scipy import linalg
+import metrics
+import store
+
+def gaussian_window(nCorr, dt, sigma):
+    """
+    Gaussian window for FFT (same construction as in the notebooks)
+    returns the frequency axis (cm**-1) and the window in the time domain
+    """
+    # - frequency resolution in cm**-1
+    wn0 = 1.0 / ((2 * nCorr - 1) * dt) * 33.3564
+    # - frequency range for spectra
+    freqs = np.arange(nCorr) * wn0
+    # normalization factor for Gaussian window function in frequency domain
+    winNorm = 1.0 / np.sqrt(2.0 * np.pi * sigma**2)
+    # create Gaussian window in frequency domain
+    # - first half is Gaussian, second half is a mirror image
+    # - this is to ensure that the window is real-valued in the time domain
+    winFreq = np.zeros(2 * nCorr - 1)
+    winFreq[0:nCorr] = winNorm * np.exp(-0.5 * freqs**2 / sigma**2)
+    winFreq[nCorr:] = winFreq[nCorr-1:0:-1]
+    # generate the Gaussian window in time domain
+    winTime = np.real(sfft.ifft(winFreq))
+    return freqs, winTime
+
+def _tile_time(velFFT, iSlice, jSlice, nCorr, workers, nFrames=None):
+    """
+    truncated time correlation functions for one (i-block, j-block) tile of DOF pairs
+    nFrames: length of the real input for half spectra from rfft (None for full spectra)
+    """
+    # multiply Fourier transformed velocities for all pairs in tile (Eq. 3)
+    # and enforce real-valued result (Eq. 4)
+    tmp1 = np.real(velFFT[iSlice, None, :] * velFFT[None, jSlice, :].conj())
+    # transform from frequency into time domain (Eq. 5)
+    if nFrames is None:
+        tmp2 = np.real(sfft.ifft(tmp1, axis=-1, overwrite_x=True, workers=workers))
+    else:
+        # real part of the product is even in frequency, half spectrum is sufficient
+        tmp2 = sfft.irfft(tmp1, n=nFrames, axis=-1, overwrite_x=True, workers=workers)
+    del tmp1
+    # cut off time domain data after tau_max = nCorr * dt
+    return tmp2[..., :nCorr]
+
+def _window(corrTime, winTime, workers, real=False):
+    """windowed spectra from truncated time correlation functions (time along the last axis)"""
+    nCorr = corrTime.shape[-1]
+    # enforce time symmetry of truncated time correlation function
+    tmp3 = np.concatenate((corrTime, corrTime[..., nCorr-1:0:-1]), axis=-1)
+    # multiply with Gaussian window function in time domain (Eq. 8)
+    tmp3 *= winTime
+    # and Fourier transform into frequency domain (Eq. 8)
+    if real:
+        # real input of length 2 * nCorr - 1 gives exactly nCorr frequencies
+        return np.real(sfft.rfft(tmp3, axis=-1, overwrite_x=True, workers=workers))
+    return np.real(sfft.fft(tmp3, axis=-1, overwrite_x=True, workers=workers)[..., :nCorr])
+
+def tile_spectra(velFFT, iSlice, jSlice, nCorr, winTime, workers, nFrames=None):
+    """
+    windowed spectra [bi, bj, nCorr] for one (i-block, j-block) tile of DOF pairs
+    velFFT: Fourier transformed velocities (see prepare_velocities), winTime: see gaussian_window
+    nFrames: length of the real input for half spectra from rfft (None for full spectra)
+    """
+    corrTime = _tile_time(velFFT, iSlice, jSlice, nCorr, workers, nFrames)
+    return _window(corrTime, winTime.astype(corrTime.dtype, copy=False), workers, real=nFrames is not None)
+
+def prepare_velocities(velocities, transform, dtype):
+    """
+    velocities in working precision and whether the real-input transforms are used
+    transform: 'auto', 'real' or 'complex' (see correlation_matrix)
+    """
+    if transform not in ('auto', 'real', 'complex'):
+        raise ValueError("transform must be 'auto', 'real' or 'complex'")
+    velocities = np.asarray(velocities)
+    if transform == 'auto':
+        # the notebooks store real velocities in complex arrays
+        real = np.isrealobj(velocities) or not np.any(np.imag(velocities))
+    else:
+        real = transform == 'real'
+    if real:
+        return np.ascontiguousarray(np.real(velocities), dtype=dtype), True
+    if np.iscomplexobj(velocities):
+        return np.asarray(velocities, dtype=np.result_type(dtype, np.complex64)), False
+    return np.asarray(velocities, dtype=dtype), False
+
+def _store_tile(out, iSlice, jSlice, tile):
+    """store tile [nCorr, bi, bj] (jSlice.start >= iSlice.start) and its symmetric counterpart"""
+    if isinstance(out, np.ndarray):
+        out[:, iSlice, jSlice] = tile
+        out[:, jSlice, iSlice] = tile.transpose(0, 2, 1)
+    else:
+        out.set_block(iSlice, jSlice, tile)
+
+def _check_out(out, shape):
+    if out is None:
+        return np.empty(shape)
+    if tuple(out.shape) != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+    return out
+
+@metrics.timed('correlation')
+def correlation_matrix(velocities,
+                       nCorr,
+                       winTime,
+                       blockSize=64,
+                       workers=None,
+                       out=None,
+                       transform='complex',
+                       dtype=np.float64):
+    """
+    velocity correlation matrix in the frequency domain (Eqs. 2-8)
+
+    velocities: mass-weighted velocities [3N, nFrames] (real or complex)
+    nCorr: number of correlation time frames
+    winTime: window function in the time domain [2 * nCorr - 1]
+             None returns the unwindowed time-domain tensor (see correlation_tensor)
+    blockSize: number of DOFs per block, a tile of blockSize**2 DOF pairs
+               is transformed at once (peak memory ~ 32 * blockSize**2 * nFrames bytes)
+    workers: number of threads used by scipy.fft
+    out: optional store.corrStore (e.g. memory-mapped, float32 or packed)
+         that receives the result instead of an in-memory array
+    transform: 'complex' (full FFTs as in the notebooks), 'real' (real FFTs for
+               real velocities, about half the memory and work) or 'auto'
+               ('real' if the velocities have no imaginary part)
+    dtype: working precision of the FFTs, np.float32 halves memory again,
+           tiles are accumulated and stored in float64 (see precision_check)
+    returns: corrMatrix [nCorr, 3N, 3N] (or out)
+    """
+    nDOF, nFrames = np.shape(velocities)
+    if nDOF == 0:
+        raise ValueError("no degrees of freedom (empty selection)")
+    if winTime is not None and len(winTime) != 2 * nCorr - 1:
+        raise ValueError("winTime must have 2 * nCorr - 1 elements")
+    if nFrames < nCorr:
+        raise ValueError("trajectory segment shorter than nCorr")
+    out = _check_out(out, (nCorr, nDOF, nDOF))
+    velocities, real = prepare_velocities(velocities, transform, dtype)
+    # Fourier transform of velocities (Eq. 2)
+    with metrics.kernel('correlation'):
+        if real:
+            velFFT = sfft.rfft(velocities, axis=1, workers=workers)
+        else:
+            velFFT = sfft.fft(velocities, axis=1, workers=workers)
+    del velocities
+    nReal = nFrames if real else None
+    # loop over upper triangle of tiles, use symmetry of correlation matrix
+    for i0 in range(0, nDOF, blockSize):
+        iSlice = slice(i0, min(i0 + blockSize, nDOF))
+        for j0 in range(i0, nDOF, blockSize):
+            jSlice = slice(j0, min(j0 + blockSize, nDOF))
+            with metrics.kernel('correlation'):
+                if winTime is None:
+                    tile = _tile_time(velFFT, iSlice, jSlice, nCorr, workers, nReal)
+                else:
+                    tile = tile_spectra(velFFT, iSlice, jSlice, nCorr, winTime, workers, nReal)
+            # tile is [bi, bj, nCorr] -> store as [nCorr, bi, bj]
+            tile = np.moveaxis(tile, -1, 0).astype(np.float64, copy=False)
+            # correct for implicit multiplication in power spectrum
+            tile /= nFrames
+            _store_tile(out, iSlice, jSlice, tile)
+    metrics.arrays('correlation', velFFT, tile, out if isinstance(out, np.ndarray) else None)
+    metrics.count('dofPairs', nDOF * (nDOF + 1) // 2)
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+def correlation_tensor(velocities, nCorr, blockSize=64, workers=None, out=None, transform='complex', dtype=np.float64):
+    """
+    unwindowed velocity correlation tensor in the time domain (Eqs. 2-5)
+    truncated after nCorr time frames, keep it to change sigma or nCorr with rewindow()
+    returns: corrTime [nCorr, 3N, 3N] (or out, e.g. a memory-mapped store.corrStore)
+    """
+    return correlation_matrix(velocities, nCorr, None,
+                              blockSize=blockSize,
+                              workers=workers,
+                              out=out,
+                              transform=transform,
+                              dtype=dtype)
+
+@metrics.timed('rewindow')
+def rewindow(corrTime, dt, sigma, nCorr=None, blockSize=64, workers=None, out=None):
+    """
+    frequency-domain correlation matrix for a new window width and/or correlation length
+    from the time-domain tensor of correlation_tensor(), without touching the velocities
+    (one batched FFT along the time axis per tile of blockSize**2 DOF pairs,
+    peak memory ~ 24 * blockSize**2 * nCorr bytes)
+
+    corrTime: [nCorrMax, 3N, 3N] array or store.corrStore
+    dt: time step (ps)
+    sigma: width of the Gaussian window (cm**-1)
+    nCorr: number of correlation time frames (<= nCorrMax, default: nCorrMax)
+    returns: (freqs [nCorr], corrMatrix [nCorr, 3N, 3N] (or out))
+    """
+    nCorrMax, nDOF = corrTime.shape[0], corrTime.shape[1]
+    if nCorr is None:
+        nCorr = nCorrMax
+    if nCorr > nCorrMax:
+        raise ValueError(f"nCorr is limited to {nCorrMax} time frames of the stored tensor")
+    freqs, winTime = gaussian_window(nCorr, dt, sigma)
+    out = _check_out(out, (nCorr, nDOF, nDOF))
+    # loop over upper triangle of tiles, use symmetry of correlation matrix
+    for i0 in range(0, nDOF, blockSize):
+        iSlice = slice(i0, min(i0 + blockSize, nDOF))
+        for j0 in range(i0, nDOF, blockSize):
+            jSlice = slice(j0, min(j0 + blockSize, nDOF))
+            if isinstance(corrTime, np.ndarray):
+                block = corrTime[:nCorr, iSlice, jSlice]
+            else:
+                block = corrTime.block(iSlice, jSlice, nCorr)
+            # time axis last for the FFT
+            tile = _window(np.moveaxis(block, 0, -1), winTime, workers, real=True)
+            _store_tile(out, iSlice, jSlice, np.moveaxis(tile, -1, 0))
+    if hasattr(out, 'flush'):
+        out.flush()
+    return freqs, out
+
+def _slab(corrMatrix, k):
+    """frequency slab k and the triangle that holds valid data"""
+    if isinstance(corrMatrix, str):
+        # memory-mapped store opened by a worker process
+        if corrMatrix not in _workerStores:
+            _workerStores[corrMatrix] = store.corrStore(corrMatrix, mode='r')
+        corrMatrix = _workerStores[corrMatrix]
+    if isinstance(corrMatrix, np.ndarray):
+        return corrMatrix[k], 'L'
+    return corrMatrix.slab(k), 'U'
+
+def _eigh(slab, uplo, nModes):
+    """eigenpairs of one slab in descending order, eigenvectors as rows"""
+    nDOF = len(slab)
+    if nModes is None or nModes >= nDOF:
+        vals, vecs = np.linalg.eigh(slab, UPLO=uplo)
+    else:
+        # partial eigensolver: only the nModes largest eigenpairs
+        vals, vecs = linalg.eigh(slab,
+                                 lower=(uplo == 'L'),
+                                 subset_by_index=[nDOF - nModes, nDOF - 1],
+                                 check_finite=False)
+    # sort eigenvalues and eigenvectors in descending order
+    # and transpose to have eigenvectors as rows
+    return vals[::-1], vecs[:, ::-1].T
+
+def _eigh_task(source, k, nModes):
+    """worker task: eigenpairs at frequency index k"""
+    if isinstance(source, tuple):
+        slab, uplo = source
+    else:
+        slab, uplo = _slab(source, k)
+    vals, vecs = _eigh(slab, uplo, nModes)
+    return k, vals, vecs
+
+def _blas_limits(nThreads):
+    """limit the number of BLAS threads (requires threadpoolctl, no-op otherwise)"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=nThreads, user_api='blas')
+
+def init_worker(blasThreads):
+    """pin BLAS threads in worker processes"""
+    global _workerLimits
+    _workerLimits = _blas_limits(blasThreads)
+
+@contextlib.contextmanager
+def pinned_env(nThreads):
+    """thread count variables inherited by newly started worker processes"""
+    saved = {var: os.environ.get(var) for var in _threadVars}
+    for var in _threadVars:
+        os.environ[var] = str(nThreads)
+    try:
+        yield
+    finally:
+        for var, val in saved.items():
+            if val is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = val
+
+_threadVars = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+_workerStores = {}
+_workerLimits = None
+
+@metrics.timed('eigenmodes')
+def eigenmodes(corrMatrix, nModes=None, nWorkers=1, pool='thread', blasThreads=None, out=None):
+    """
+    eigenvalues and eigenvectors of the correlation matrix at each frequency
+    slabs are read and decomposed one at a time (works on store.corrStore)
+
+    corrMatrix: [nCorr, 3N, 3N] array or store.corrStore
+    nModes: only compute the nModes largest eigenpairs per frequency (partial eigensolver)
+            None computes all 3N eigenpairs
+    nWorkers: number of frequencies decomposed concurrently
+    pool: 'thread' or 'process'
+    blasThreads: BLAS threads per worker (default: cpu count / nWorkers)
+    out: optional array-like [nCorr, nModes, 3N] (e.g. np.memmap) for eigenvectors
+    returns: eigenvalues [nCorr, nModes] in descending order
+             eigenvectors [nCorr, nModes, 3N] (access i'th eigenvector as eigenvectors[k, i])
+    """
+    nCorr, nDOF = corrMatrix.shape[0], corrMatrix.shape[1]
+    if nModes is None or nModes > nDOF:
+        nModes = nDOF
+    eigenvalues = np.empty((nCorr, nModes))
+    if out is None:
+        out = np.empty((nCorr, nModes, nDOF))
+    elif tuple(out.shape) != (nCorr, nModes, nDOF):
+        raise ValueError(f"out has shape {out.shape}, expected {(nCorr, nModes, nDOF)}")
+    if nWorkers <= 1:
+        for k in range(nCorr):
+            slab, uplo = _slab(corrMatrix, k)
+            with metrics.kernel('eigenmodes'):
+                eigenvalues[k], out[k] = _eigh(slab, uplo, nModes)
+    else:
+        if blasThreads is None:
+            blasThreads = max(1, (os.cpu_count() or 1) // nWorkers)
+        if pool == 'thread':
+            executor = futures.ThreadPoolExecutor(max_workers=nWorkers)
+            limits = _blas_limits(blasThreads)
+        elif pool == 'process':
+            executor = futures.ProcessPoolExecutor(max_workers=nWorkers,
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=init_worker,
+                                                   initargs=(blasThreads,))
+            limits = pinned_env(blasThreads)
+        else:
+            raise ValueError("pool must be 'thread' or 'process'")
+        with limits, executor:
+            # file-backed stores are opened by the workers, other data (including
+            # np.memmap views) is sent slab by slab
+            source = corrMatrix
+            if pool == 'process' and isinstance(corrMatrix, store.corrStore) and corrMatrix.filename is not None:
+                source = corrMatrix.filename
+            pending = set()
+            for k in range(nCorr):
+                if pool == 'process' and not isinstance(source, str):
+                    task = executor.submit(_eigh_task, _slab(source, k), k, nModes)
+                else:
+                    task = executor.submit(_eigh_task, source, k, nModes)
+                pending.add(task)
+                # bounded number of slabs in flight
+                if len(pending) >= 2 * nWorkers:
+                    done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for task in done:
+                        i, eigenvalues[i], out[i] = task.result()
+            for task in futures.as_completed(pending):
+                i, eigenvalues[i], out[i] = task.result()
+    metrics.count('frequencies', nCorr)
+    if hasattr(out, 'flush'):
+        out.flush()
+    return eigenvalues, out
+
+def precision_check(velocities, nCorr, winTime, transform='real', dtype=np.float32, blockSize=64, workers=None):
+    """
+    accuracy of a transform/precision mode of correlation_matrix()
+    compared to the float64 reference with full complex FFTs (as in the notebooks)
+    returns: dict with the maximum absolute deviation of the eigenvalues and of the
+             total VDoS (sum of eigenvalues), also relative to the largest reference value
+    """
+    reference = correlation_matrix(velocities, nCorr, winTime, blockSize=blockSize, workers=workers)
+    test = correlation_matrix(velocities, nCorr, winTime,
+                              blockSize=blockSize,
+                              workers=workers,
+                              transform=transform,
+                              dtype=dtype)
+    refVals = np.linalg.eigvalsh(reference)
+    testVals = np.linalg.eigvalsh(test)
+    # total VDoS (Eq. 10) before normalization
+    refVDoS = np.sum(refVals, axis=1)
+    testVDoS = np.sum(testVals, axis=1)
+    dVals = np.max(np.abs(testVals - refVals))
+    dVDoS = np.max(np.abs(testVDoS - refVDoS))
+    result = dict(transform=transform,
+                  dtype=np.dtype(dtype).name,
+                  eigenvalues=dVals,
+                  eigenvaluesRelative=dVals / np.max(np.abs(refVals)),
+                  vdos=dVDoS,
+                  vdosRelative=dVDoS / np.max(np.abs(refVDoS)))
+    print(f"{transform} FFTs, {np.dtype(dtype).name}: max. deviation of eigenvalues {result['eigenvaluesRelative']:.2e}, "
+          f"total VDoS {result['vdosRelative']:.2e} (relative to maximum)")
+    return result
+
+def time_correlation(spectra, axis=0):
+    """
+    time correlation functions from spectra with nCorr frequencies along axis
+    (symmetrized inverse FFT as in the notebooks, first nCorr time frames)
+    """
+    spectra = np.moveaxis(np.asarray(spectra), axis, 0)
+    nCorr = spectra.shape[0]
+    # enforce time symmetry before transforming back into the time domain
+    sym = np.concatenate((spectra, spectra[nCorr-1:0:-1]), axis=0)
+    vcf = np.real(sfft.ifft(sym, axis=0))[:nCorr]
+    return np.moveaxis(vcf, 0, axis)
+
+@metrics.timed('projection')
+def project_modes(corrMatrix, modesA, modesB=None, timeDomain=False):
+    """
+    correlation matrix projected onto pairs of modes (Eq. 11 for modesA == modesB)
+
+    corrMatrix: [nCorr, 3N, 3N] array or store.corrStore
+    modesA: [nA, 3N] modes as rows (e.g. eigenvectors[k, 0:nA])
+    modesB: [nB, 3N] (default: modesA)
+    timeDomain: return time correlation functions (see time_correlation) instead of spectra
+    returns: [nCorr, nA, nB] with result[k, a, b] = modesA[a] . corrMatrix[k] . modesB[b]
+    """
+    modesA = np.atleast_2d(modesA)
+    modesB = modesA if modesB is None else np.atleast_2d(modesB)
+    if isinstance(corrMatrix, np.ndarray):
+        # batched matrix products over all frequencies, smaller intermediate first
+        if len(modesA) <= len(modesB):
+            projected = (modesA @ corrMatrix) @ modesB.T
+        else:
+            projected = modesA @ (corrMatrix @ modesB.T)
+    else:
+        projected = np.empty((len(corrMatrix), len(modesA), len(modesB)))
+        for k in range(len(corrMatrix)):
+            projected[k] = modesA @ corrMatrix[k] @ modesB.T
+    if timeDomain:
+        return time_correlation(projected)
+    return projected
+
+@metrics.timed('projection')
+def mode_vdos(corrMatrix, modes):
+    """
+    1D-VDoS of modes (Eq. 11), only the diagonal of project_modes
+    returns: [nModes, nCorr]
+    """
+    modes = np.atleast_2d(modes)
+    if isinstance(corrMatrix, np.ndarray):
+        return np.einsum('kim,mi->mk', corrMatrix @ modes.T, modes)
+    vdos = np.empty((len(modes), len(corrMatrix)))
+    for k in range(len(corrMatrix)):
+        vdos[:, k] = np.einsum('im,mi->m', corrMatrix[k] @ modes.T, modes)
+    return vdos
+
+class accumulator:
+    """
+    streaming, segment-averaged (Welch-style) velocity correlation matrix
+    - frames are buffered in overlapping segments of segLength frames
+    - each full segment is transformed with correlation_matrix() and added
+      to a running sum, memory scales with segLength rather than trajectory length
+    - more frames (or trajectories) can be added to an existing result at any time
+    - winTime=None accumulates the unwindowed time-domain tensor instead (see rewindow)
+    """
+    def __init__(self,
+                 nDOF,
+                 nCorr,
+                 winTime,
+                 segLength=None,
+                 overlap=0.5,
+                 blockSize=64,
+                 workers=None,
+                 transform='complex',
+                 dtype=np.float64):
+        if segLength is None:
+            segLength = 4 * nCorr
+        if segLength < 2 * nCorr - 1:
+            raise ValueError("segLength must be at least 2 * nCorr - 1 frames")
+        if overlap < 0.0 or overlap >= 1.0:
+            raise ValueError("overlap must be in [0, 1)")
+        self.nDOF = nDOF
+        self.nCorr = nCorr
+        self.winTime = winTime
+        self.segLength = segLength
+        self.nOverlap = int(overlap * segLength)
+        self.blockSize = blockSize
+        self.workers = workers
+        self.transform = transform
+        self.dtype = dtype
+        # running sum of segment correlation matrices
+        self.corrSum = np.zeros((nCorr, nDOF, nDOF))
+        self.nSegments = 0
+        # frames of the current (incomplete) segment
+        self.buffer = np.zeros((nDOF, segLength))
+        self.nBuffered = 0
+
+    def add_frames(self, velocities):
+        """add mass-weighted velocities [3N, nFrames] of consecutive frames"""
+        velocities = np.asarray(velocities)
+        if velocities.ndim == 1:
+            velocities = velocities[:, None]
+        nNew = velocities.shape[1]
+        i = 0
+        while i < nNew:
+            n = min(nNew - i, self.segLength - self.nBuffered)
+            self.buffer[:, self.nBuffered:self.nBuffered + n] = np.real(velocities[:, i:i + n])
+            self.nBuffered += n
+            i += n
+            if self.nBuffered == self.segLength:
+                self._add_segment()
+
+    def _add_segment(self):
+        self.corrSum += correlation_matrix(self.buffer,
+                                           self.nCorr,
+                                           self.winTime,
+                                           blockSize=self.blockSize,
+                                           workers=self.workers,
+                                           transform=self.transform,
+                                           dtype=self.dtype)
+        self.nSegments += 1
+        # keep overlapping frames for the next segment
+        if self.nOverlap > 0:
+            self.buffer[:, :self.nOverlap] = self.buffer[:, self.segLength - self.nOverlap:]
+        self.nBuffered = self.nOverlap
+
+    def add_trajectory(self, u, sel, frames=None, unwrap=None, align=None):
+        """
+        read frames through u.trajectory, make molecules whole and align (optional)
+        and add the mass-weighted velocities of sel
+        """
+        if sel.n_atoms * 3 != self.nDOF:
+            raise ValueError(f"selection has {sel.n_atoms * 3} DOF, expected {self.nDOF}")
+        # store square root of atomic masses for each DOF
+        sqm = np.repeat(np.sqrt(sel.atoms.masses), 3)
+        traj = u.trajectory if frames is None else u.trajectory[frames]
+        # coordinates and velocities (float32) of all atoms are read for each frame
+        with metrics.timer('trajectory', frames=len(traj), bytesRead=len(traj) * u.atoms.n_atoms * 24):
+            for ts in traj:
+                if unwrap is not None:
+                    unwrap.single_frame()
+                if align is not None:
+                    align.single_frame()
+                self.add_frames(sqm * sel.velocities.flatten())
+
+    def result(self):
+        """segment-averaged correlation matrix [nCorr, 3N, 3N] (time-domain tensor if winTime is None)"""
+        if self.nSegments == 0:
+            raise ValueError("no complete segment has been added yet")
+        return self.corrSum / self.nSegments
+
+    def save(self, filename):
+        """save the accumulator state (continue later with accumulator.load)"""
+        np.savez(filename,
+                 corrSum=self.corrSum,
+                 nSegments=self.nSegments,
+                 buffer=self.buffer[:, :self.nBuffered],
+                 winTime=np.empty(0) if self.winTime is None else self.winTime,
+                 segLength=self.segLength,
+                 nOverlap=self.nOverlap)
+
+    @classmethod
+    def load(cls, filename, blockSize=64, workers=None, transform='complex', dtype=np.float64):
+        data = np.load(filename)
+        nCorr, nDOF = data['corrSum'].shape[0], data['corrSum'].shape[1]
+        winTime = data['winTime'] if data['winTime'].size > 0 else None
+        acc = cls(nDOF, nCorr, winTime,
+                  segLength=int(data['segLength']),
+                  blockSize=blockSize,
+                  workers=workers,
+                  transform=transform,
+                  dtype=dtype)
+        acc.nOverlap = int(data['nOverlap'])
+        acc.corrSum[:] = data['corrSum']
+        acc.nSegments = int(data['nSegments'])
+        acc.nBuffered = data['buffer'].shape[1]
+        acc.buffer[:, :acc.nBuffered] = data['buffer']
+        return acc
@@ -147,11 +147,66 @@ class graphics2d:
 #         ax.plot_surface(X, Y, Z, color=color, alpha=1.0, shade=True, antialiased=False)
 
 import pyvista as pv
-pv.set_jupyter_backend('trame')
+try:
+    pv.set_jupyter_backend('trame')
+except ImportError:
+    # not needed for off-screen rendering (e.g. batch jobs on headless nodes)
+    pass
+
+# element colors and (relative) radii for molecule
+elementStyles = {'C': ('black', 1.7),
+                 'N': ('blue', 1.625),
+                 'O': ('red', 1.5),
+                 'H': ('white', 1.0),
+                 'S': ('yellow', 1.85)}
+defaultStyle = ('gray', 1.5)
+
+def lod_resolution(nAtoms):
+    """
+    level of detail: sphere/tube resolution for a system of nAtoms
+    (0: atoms as point sprites and bonds as lines)
+    """
+    if nAtoms <= 100:
+        return 30
+    if nAtoms <= 1000:
+        return 16
+    if nAtoms <= 10000:
+        return 10
+    if nAtoms <= 100000:
+        return 6
+    return 0
+
+def _rgb(colors, n):
+    """colors (one name/RGB for all or one per item) as uint8 RGB array [n, 3]"""
+    if isinstance(colors, str) or (np.ndim(colors) == 1 and not isinstance(colors[0], str)):
+        colors = [colors] * n
+    elif isinstance(colors, np.ndarray) and colors.dtype == np.uint8:
+        return colors.reshape(n, 3)
+    lookup = {}
+    rgb = np.empty((n, 3), dtype=np.uint8)
+    for i, c in enumerate(colors):
+        key = c if isinstance(c, str) else tuple(c)
+        if key not in lookup:
+            lookup[key] = pv.Color(c).int_rgb
+        rgb[i] = lookup[key]
+    return rgb
+
+def _segments(starts, ends):
+    """line segments from starts to ends [n, 3] as a single PolyData"""
+    n = len(starts)
+    points = np.empty((2 * n, 3))
+    points[0::2] = starts
+    points[1::2] = ends
+    lines = np.column_stack((np.full(n, 2), np.arange(0, 2 * n, 2), np.arange(1, 2 * n, 2))).ravel()
+    return pv.PolyData(points, lines=lines)
 
 class graphics3d:
-    def __init__(self):
-        self.plotter = pv.Plotter()
+    def __init__(self, offScreen=False, windowSize=None):
+        """
+        offScreen: render without a window (no display/GPU needed with an OSMesa/EGL build of VTK)
+        windowSize: image size in pixels, e.g. (1024, 768)
+        """
+        self.plotter = pv.Plotter(off_screen=offScreen, window_size=windowSize)
         # self.plotter.set_viewup([0, 0, 1])
         self.actors = []
 
@@ -160,6 +215,25 @@ class graphics3d:
         actor = self.plotter.add_mesh(sphere, color=color, smooth_shading=True)
         self.actors.append(actor)
 
+    def add_spheres(self, centers, radii, colors='white', resolution=30):
+        """
+        all spheres as one glyph-instanced mesh (single actor)
+        resolution: sphere resolution, 0: point sprites (fastest, same size for all spheres)
+        """
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        points = pv.PolyData(centers)
+        points.point_data['color'] = _rgb(colors, len(centers))
+        if resolution == 0:
+            actor = self.plotter.add_mesh(points, scalars='color', rgb=True,
+                                          render_points_as_spheres=True, point_size=5)
+        else:
+            points.point_data['radius'] = np.broadcast_to(radii, len(centers)).astype(np.float64)
+            sphere = pv.Sphere(radius=1.0, theta_resolution=resolution, phi_resolution=resolution)
+            glyphs = points.glyph(geom=sphere, scale='radius', orient=False)
+            actor = self.plotter.add_mesh(glyphs, scalars='color', rgb=True, smooth_shading=True)
+        self.actors.append(actor)
+        return actor
+
     def add_arrow(self, start, end, radius=0.05, color='red', cone_length=0.2, cone_radius=0.1):
         start = np.array(start)
         end = np.array(end)
@@ -179,6 +253,41 @@ class graphics3d:
         cone = pv.Cone(center=cone_center, direction=direction, height=cone_length, radius=cone_radius, resolution = 30)
         self.plotter.add_mesh(cone, color=color, smooth_shading=True)
 
+    def add_arrows(self, starts, ends, radius=0.05, colors='red', cone_length=0.2, cone_radius=0.1, resolution=30):
+        """
+        all arrows as one tube mesh (shafts) and one glyph-instanced mesh (cones)
+        same geometry as add_arrow, returns the list of actors
+        """
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+        rgb = _rgb(colors, len(starts))
+        direction = ends - starts
+        length = np.linalg.norm(direction, axis=1)
+        keep = length > 0
+        starts, direction, length, rgb = starts[keep], direction[keep], length[keep], rgb[keep]
+        if len(starts) == 0:
+            return []
+        direction /= length[:, None]
+        actors = []
+        # shafts
+        shaftLength = length - cone_length
+        shaft = shaftLength > 0
+        if np.any(shaft):
+            actors.append(self.add_cylinders(starts[shaft],
+                                             starts[shaft] + direction[shaft] * shaftLength[shaft, None],
+                                             radius, rgb[shaft], resolution))
+        # cones
+        cones = pv.PolyData(starts + direction * (length - cone_length / 2)[:, None])
+        cones.point_data['color'] = rgb
+        cones.point_data['direction'] = direction
+        cone = pv.Cone(center=(0.0, 0.0, 0.0), direction=(1.0, 0.0, 0.0), height=cone_length,
+                       radius=cone_radius, resolution=max(resolution, 3))
+        glyphs = cones.glyph(geom=cone, orient='direction', scale=False)
+        actor = self.plotter.add_mesh(glyphs, scalars='color', rgb=True, smooth_shading=True)
+        self.actors.append(actor)
+        actors.append(actor)
+        return actors
+
     def add_cylinder(self, start, end, radius=0.1, color='gray'):
         start = np.array(start)
         end = np.array(end)
@@ -191,52 +300,124 @@ class graphics3d:
         cylinder = pv.Cylinder(center=center, direction=direction, radius=radius, height=height, resolution = 30)
         self.plotter.add_mesh(cylinder, color=color, smooth_shading=True)
 
-    def render(self):
+    def add_cylinders(self, starts, ends, radius=0.1, colors='gray', resolution=30):
+        """
+        all cylinders as one tube mesh (single actor)
+        resolution: number of tube sides, 0: lines
+        """
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        segments = _segments(starts, ends)
+        segments.point_data['color'] = np.repeat(_rgb(colors, len(starts)), 2, axis=0)
+        if resolution == 0:
+            actor = self.plotter.add_mesh(segments, scalars='color', rgb=True, line_width=2)
+        else:
+            tubes = segments.tube(radius=radius, n_sides=max(resolution, 3), capping=True)
+            actor = self.plotter.add_mesh(tubes, scalars='color', rgb=True, smooth_shading=True)
+        self.actors.append(actor)
+        return actor
+
+    def remove(self, actors):
+        """remove actors (e.g. mode arrows) from the scene"""
+        for actor in actors:
+            self.plotter.remove_actor(actor, render=False)
+            if actor in self.actors:
+                self.actors.remove(actor)
+
+    def render(self, filename=None):
+        """show the scene, filename: also save an image (required if rendered off-screen)"""
         self.plotter.view_xy()
-        self.plotter.show()
+        if self.plotter.off_screen:
+            if filename is None:
+                raise ValueError("graphics3d: filename required for off-screen rendering")
+            self.plotter.screenshot(filename)
+        else:
+            self.plotter.show(screenshot=filename)
+
+    def close(self):
+        self.plotter.close()
 
 class molecule:
+    """
+    atoms (spheres) and bonds (cylinders, colored by atom) of a selection, optionally with mode displacements (arrows)
+    all atoms, bonds and arrows are single meshes with a level-of-detail resolution (see lod_resolution)
+    """
     def __init__(self, 
                  sel, 
                  atomRadius = 0.25, 
                  bondRadius=0.05, 
                  modeDisp=None, 
                  modeScale = 1.0, 
-                 arrowRadius = 0.05):
-        img = graphics3d()
-        atColors = []
-        atRad = []
-        for at in sel.atoms:
-            if at.element == 'C':
-                atColors.append('black')
-                atRad.append(1.7)
-            elif at.element == 'N':
-                atColors.append('blue')
-                atRad.append(1.625)
-            elif at.element == 'O':
-                atColors.append('red')
-                atRad.append(1.5)
-            elif at.element == 'H':
-                atColors.append('white')
-                atRad.append(1.0)
-            elif at.element == 'S':
-                atColors.append('yellow')
-                atRad.append(1.85)
-        for i, at in enumerate(sel.atoms):
-            img.add_sphere(at.position, atomRadius * atRad[i], color=atColors[i])
-            if modeDisp is not None:
-                img.add_arrow(at.position, at.position + modeScale * modeDisp[i], arrowRadius, color='orange', cone_length=arrowRadius*3, cone_radius=arrowRadius*2)
-                img.add_arrow(at.position, at.position - modeScale * modeDisp[i], arrowRadius, color='yellow', cone_length=arrowRadius*3, cone_radius=arrowRadius*2)
-        for b in sel.bonds:
-            idx1 = b.atoms[0].index
-            idx2 = b.atoms[1].index
-            start = b.atoms[0].position
-            end = b.atoms[1].position
+                 arrowRadius = 0.05,
+                 resolution=None,
+                 offScreen=False,
+                 filename=None,
+                 windowSize=None,
+                 show=True):
+        """
+        resolution: sphere/tube resolution (default: lod_resolution(number of atoms))
+        offScreen, windowSize: see graphics3d, filename: save an image
+        show: render immediately (False: call render() later, e.g. after set_mode())
+        """
+        self.img = graphics3d(offScreen=offScreen, windowSize=windowSize)
+        self.positions = sel.atoms.positions
+        self.resolution = lod_resolution(len(self.positions)) if resolution is None else resolution
+        self.arrowRadius = arrowRadius
+        self.modeActors = []
+        styles = [elementStyles.get(e, defaultStyle) for e in sel.atoms.elements]
+        atColors = _rgb([c for c, r in styles], len(styles))
+        atRad = np.array([r for c, r in styles])
+        self.img.add_spheres(self.positions, atomRadius * atRad, atColors, self.resolution)
+        # bonds within the selection, two halves colored by their atoms
+        lookup = np.full(sel.universe.atoms.n_atoms, -1)
+        lookup[sel.atoms.indices] = np.arange(len(sel.atoms))
+        bonds = lookup[np.asarray(sel.bonds.indices, dtype=np.int64).reshape(-1, 2)]
+        bonds = bonds[np.all(bonds >= 0, axis=1)]
+        if len(bonds) > 0:
+            start = self.positions[bonds[:, 0]]
+            end = self.positions[bonds[:, 1]]
             center = (start + end) / 2
-            img.add_cylinder(start, center, bondRadius, color=atColors[idx1])
-            img.add_cylinder(center, end, bondRadius, color=atColors[idx2])
+            self.img.add_cylinders(np.concatenate((start, center)),
+                                   np.concatenate((center, end)),
+                                   bondRadius,
+                                   np.concatenate((atColors[bonds[:, 0]], atColors[bonds[:, 1]])),
+                                   self.resolution)
+        if modeDisp is not None:
+            self.set_mode(modeDisp, modeScale)
         # limits = [[min * 5 , max * 5] for min, max in [[-1, 1], [-1, 1], [-1, 1]]]
-        img.render()
+        if show:
+            self.render(filename)
+
+    def set_mode(self, modeDisp, modeScale=1.0):
+        """replace the displacement arrows (+modeDisp orange, -modeDisp yellow)"""
+        self.img.remove(self.modeActors)
+        disp = modeScale * np.asarray(modeDisp).reshape(-1, 3)
+        n = len(self.positions)
+        self.modeActors = self.img.add_arrows(np.concatenate((self.positions, self.positions)),
+                                              np.concatenate((self.positions + disp, self.positions - disp)),
+                                              self.arrowRadius,
+                                              ['orange'] * n + ['yellow'] * n,
+                                              cone_length=self.arrowRadius * 3,
+                                              cone_radius=self.arrowRadius * 2,
+                                              resolution=self.resolution)
+
+    def render(self, filename=None):
+        self.img.render(filename)
+
+def mode_images(sel, modeDisps, filenames, modeScale=1.0, windowSize=(1024, 768), **kwargs):
+    """
+    render an image for each mode off-screen (batch use on headless nodes)
+    atoms and bonds are built once, only the arrows are replaced for each mode
+    modeDisps: displacements [nModes, nAtoms, 3], filenames: one per mode
+    kwargs: passed to molecule (atomRadius, bondRadius, arrowRadius, resolution)
+    """
+    if len(modeDisps) != len(filenames):
+        raise ValueError("mode_images: need one filename per mode")
+    mol = molecule(sel, offScreen=True, windowSize=windowSize, show=False, **kwargs)
+    mol.img.plotter.view_xy()
+    for modeDisp, filename in zip(modeDisps, filenames):
+        mol.set_mode(modeDisp, modeScale)
+        mol.img.plotter.screenshot(filename)
+    mol.img.close()
 
 class plotSpectra:
     def __init__(self,
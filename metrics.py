@@ -0,0 +1,216 @@
+import contextlib
+import ctypes as ct
+import functools
+import json
+import threading
+import time
+import numpy as np
+
+class t_error(ct.Structure):
+    """error details filled in by the C kernels (code 0: no error)"""
+    _fields_ = (("code", ct.c_int32),
+                ("frame", ct.c_int32),
+                ("index", ct.c_int32),
+                ("value", ct.c_int32),
+                ("limit", ct.c_int32))
+
+# error codes of the C kernels (ctypes/unwrap.c, ctypes/align.c)
+errorMessages = {
+    1: "atom {index} bonded to atom {value} out of range (0-{limit})",
+    2: "isolated zero-mass (dummy) atom {index} before the first molecule",
+    3: "residues of the system are not set up (frame {frame})",
+}
+
+def set_error(error, code, frame=-1, index=-1, value=0, limit=0):
+    """fill error details (t_error or None) like setError in ctypes/unwrap.c, returns code"""
+    if error is not None:
+        error.code = code
+        error.frame = frame
+        error.index = index
+        error.value = value
+        error.limit = limit
+    return code
+
+class kernelError(ValueError):
+    """error reported by a C kernel, details as attributes (code, frame, index, value, limit)"""
+    def __init__(self, function, code, error=None):
+        self.function = function
+        self.code = code
+        self.details = {name: getattr(error, name) for name, ctype in t_error._fields_} if error else {}
+        self.details['code'] = code
+        message = errorMessages.get(code, "error code {code}")
+        try:
+            message = message.format(**self.details)
+        except KeyError:
+            pass
+        super().__init__(f"{function}: {message}")
+
+def check(function, code, error=None):
+    """raise kernelError for a non-zero return code of a C kernel (and count it)"""
+    if code == 0:
+        return
+    if _collector is not None:
+        _collector.count('errors')
+        _collector.event(dict(stage=function, error=code))
+    raise kernelError(function, code, error)
+
+class collector:
+    """
+    stage timings and counters
+    - per stage: calls, wall time, time spent in C/FFT/LAPACK kernels (the rest is
+      Python overhead), frames, bytes read and peak array memory
+    - optional per-frame timing histograms
+    """
+    def __init__(self, histograms=False, callback=None):
+        self.histograms = histograms
+        self.callback = callback
+        self.stages = {}
+        self.counters = {}
+        self.frameTimes = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = dict(calls=0, seconds=0.0, kernelSeconds=0.0, frames=0, bytesRead=0, peakBytes=0)
+        return self.stages[stage]
+
+    @contextlib.contextmanager
+    def timer(self, stage, frames=0, bytesRead=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                s = self._stage(stage)
+                s['calls'] += 1
+                s['seconds'] += seconds
+                s['frames'] += frames
+                s['bytesRead'] += bytesRead
+                if self.histograms and frames > 0:
+                    self.frameTimes.setdefault(stage, []).append(seconds / frames)
+            if self.callback is not None:
+                self.callback(dict(stage=stage, seconds=seconds, frames=frames, bytesRead=bytesRead))
+
+    @contextlib.contextmanager
+    def kernel(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self._stage(stage)['kernelSeconds'] += seconds
+
+    def arrays(self, stage, *arrays):
+        nBytes = sum(getattr(a, 'nbytes', 0) for a in arrays)
+        with self.lock:
+            s = self._stage(stage)
+            s['peakBytes'] = max(s['peakBytes'], nBytes)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, record):
+        with self.lock:
+            self.events.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def to_dict(self, bins=20):
+        """all metrics as a dict (stage rates and per-frame histograms included)"""
+        stages = {}
+        for stage, s in self.stages.items():
+            s = dict(s)
+            s['overheadSeconds'] = max(0.0, s['seconds'] - s['kernelSeconds']) if s['kernelSeconds'] > 0.0 else None
+            if s['frames'] > 0 and s['seconds'] > 0.0:
+                s['framesPerSecond'] = s['frames'] / s['seconds']
+            if stage in self.frameTimes:
+                counts, edges = np.histogram(self.frameTimes[stage], bins=bins)
+                s['frameHistogram'] = dict(counts=counts.tolist(), edges=edges.tolist())
+            stages[stage] = s
+        return dict(stages=stages, counters=dict(self.counters), events=list(self.events))
+
+    def report(self):
+        """print a summary table of all stages"""
+        for stage, s in self.to_dict()['stages'].items():
+            line = f"{stage:<14s} {s['calls']:>8d} calls {s['seconds']:10.3f} s"
+            if s['overheadSeconds'] is not None:
+                line += f" (kernel {s['kernelSeconds']:.3f} s, overhead {s['overheadSeconds']:.3f} s)"
+            if s['frames'] > 0:
+                line += f" {s['framesPerSecond']:10.1f} frames/s"
+            if s['peakBytes'] > 0:
+                line += f" peak {s['peakBytes'] / 1024**2:.1f} MiB"
+            print(line)
+
+# the active collector, None disables all instrumentation
+_collector = None
+_null = contextlib.nullcontext()
+
+def enable(histograms=False, callback=None):
+    """
+    start collecting metrics in unwrap, align and the FRESEAN stages
+    histograms: keep per-frame timings (for histograms in export)
+    callback: called with a dict after each timed call and for each error
+    returns: the collector
+    """
+    global _collector
+    _collector = collector(histograms=histograms, callback=callback)
+    return _collector
+
+def disable():
+    """stop collecting, returns the last collector"""
+    global _collector
+    last = _collector
+    _collector = None
+    return last
+
+def active():
+    return _collector
+
+def timer(stage, frames=0, bytesRead=0):
+    """time a stage (no-op context if disabled)"""
+    if _collector is None:
+        return _null
+    return _collector.timer(stage, frames, bytesRead)
+
+def kernel(stage):
+    """time the kernel part of a stage (no-op context if disabled)"""
+    if _collector is None:
+        return _null
+    return _collector.kernel(stage)
+
+def timed(stage):
+    """decorator: time every call of a function as stage (only checks a flag if disabled)"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _collector is None:
+                return function(*args, **kwargs)
+            with _collector.timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def arrays(stage, *arrays):
+    """record the memory of arrays used at the same time by a stage (peak over calls)"""
+    if _collector is not None:
+        _collector.arrays(stage, *arrays)
+
+def count(name, n=1):
+    if _collector is not None:
+        _collector.count(name, n)
+
+def export(filename=None, callback=None):
+    """metrics as dict, written to filename (JSON) and/or passed to callback"""
+    if _collector is None:
+        return None
+    metrics = _collector.to_dict()
+    if filename is not None:
+        with open(filename, 'w') as f:
+            json.dump(metrics, f, indent=1)
+    if callback is not None:
+        callback(metrics)
+    return metrics
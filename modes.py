@@ -0,0 +1,162 @@
+import json
+import os
+import numpy as np
+import fresean
+
+# file layout: magic, header length (uint64), JSON header, arrays (each aligned to 64 bytes)
+magic = b'FRESMODE'
+version = 1
+_align = 64
+
+class modeLibrary:
+    """
+    memory-mapped library of mode vectors with frequencies and metadata
+    - vectors: [nModes, 3N] (rows), frequencies: [nModes] (cm^-1)
+    - optional arrays stored along (e.g. reference structure, masses)
+    - metadata: JSON-serializable dict (elements, source files, ...)
+    create with write() or convert_xyz()
+    """
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(f"{filename} is not a mode library")
+            headerLength = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(headerLength).decode())
+        if header['version'] > version:
+            raise ValueError(f"{filename}: unsupported mode library version {header['version']}")
+        self.meta = header['meta']
+        self.arrays = {}
+        for name, a in header['arrays'].items():
+            self.arrays[name] = np.memmap(filename, mode=mode, dtype=np.dtype(a['dtype']),
+                                          offset=a['offset'], shape=tuple(a['shape']))
+        self.vectors = self.arrays['vectors']
+        self.frequencies = self.arrays['frequencies']
+        self.nModes, self.nDOF = self.vectors.shape
+
+    def __len__(self):
+        return self.nModes
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def select(self, fMin=None, fMax=None, skip=0):
+        """
+        indices of modes with fMin <= frequency <= fMax
+        skip: ignore the first modes (e.g. 6 translations/rotations)
+        """
+        keep = np.arange(self.nModes) >= skip
+        if fMin is not None:
+            keep &= self.frequencies >= fMin
+        if fMax is not None:
+            keep &= self.frequencies <= fMax
+        return np.flatnonzero(keep)
+
+def write(filename, vectors, frequencies, dtype=np.float64, arrays=None, **meta):
+    """
+    write a mode library (written to a temporary file first, then renamed)
+    vectors: [nModes, 3N], frequencies: [nModes]
+    dtype: storage type of the mode vectors (e.g. np.float32 halves the size)
+    arrays: dict of additional arrays, meta: additional metadata (JSON-serializable)
+    returns: modeLibrary
+    """
+    vectors = np.asarray(vectors, dtype=dtype)
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    if vectors.ndim != 2 or len(frequencies) != len(vectors):
+        raise ValueError("need vectors [nModes, 3N] and one frequency per mode")
+    data = dict(vectors=vectors, frequencies=frequencies)
+    for name, array in (arrays or {}).items():
+        data[name] = np.ascontiguousarray(array)
+    # header size depends on the offsets, reserve enough space for their digits
+    layout = {name: dict(dtype=a.dtype.str, shape=list(a.shape), offset=0) for name, a in data.items()}
+    header = dict(version=version, meta=meta, arrays=layout)
+    reserve = len(json.dumps(header).encode()) + 24 * len(data)
+    offset = -(-(len(magic) + 8 + reserve) // _align) * _align
+    for name, a in data.items():
+        layout[name]['offset'] = offset
+        offset += -(-a.nbytes // _align) * _align
+    encoded = json.dumps(header).encode().ljust(reserve)
+    tmp = f"{filename}.tmp{os.getpid()}"
+    with open(tmp, 'wb') as f:
+        f.write(magic)
+        f.write(np.array(reserve, dtype='<u8').tobytes())
+        f.write(encoded)
+        for name, a in data.items():
+            f.seek(layout[name]['offset'])
+            f.write(a.tobytes())
+        f.truncate(offset)
+    os.replace(tmp, filename)
+    return modeLibrary(filename)
+
+def read_xyz(filename):
+    """
+    multi-frame xyz file as (elements [nAtoms], coordinates [nFrames, nAtoms, 3])
+    all frames are parsed at once (no per-frame trajectory reads)
+    """
+    with open(filename) as f:
+        lines = f.read().split('\n')
+    nAtoms = int(lines[0])
+    frameLength = nAtoms + 2
+    nFrames = len([l for l in lines[::frameLength] if l.strip()])
+    atomLines = [lines[f * frameLength + 2 + i] for f in range(nFrames) for i in range(nAtoms)]
+    fields = ' '.join(atomLines).split()
+    elements = fields[0:4 * nAtoms:4]
+    coordinates = np.array([fields[i::4] for i in (1, 2, 3)], dtype=np.float64).T.reshape(nFrames, nAtoms, 3)
+    return elements, coordinates
+
+def convert_xyz(vectorFile, frequencyFile, filename, reference=None, dtype=np.float64):
+    """
+    mode library from harmonic normal modes as xyz (one frame per mode) and frequency file (mode, wavenumber)
+    e.g. convert_xyz('data/harmonic-normal-modes/eigenvec.xyz', 'data/harmonic-normal-modes/eigenfreq.dat',
+                     'harmonic.modes', reference='data/harmonic-normal-modes/min.xyz')
+    reference: xyz file of the structure the modes refer to (stored as array 'reference')
+    """
+    elements, vectors = read_xyz(vectorFile)
+    frequencies = np.loadtxt(frequencyFile, comments='#', ndmin=2)[:, 1]
+    if len(frequencies) != len(vectors):
+        raise ValueError(f"{frequencyFile} contains {len(frequencies)} frequencies for {len(vectors)} modes")
+    arrays = {}
+    if reference is not None:
+        arrays['reference'] = read_xyz(reference)[1][0]
+    return write(filename,
+                 vectors.reshape(len(vectors), -1),
+                 frequencies,
+                 dtype=dtype,
+                 arrays=arrays,
+                 elements=elements,
+                 source=dict(vectors=os.path.basename(vectorFile),
+                             frequencies=os.path.basename(frequencyFile)),
+                 units=dict(frequencies='cm^-1'))
+
+def _basis(library):
+    """mode vectors [nModes, 3N] of a modeLibrary or an array"""
+    if isinstance(library, modeLibrary):
+        return np.asarray(library.vectors, dtype=np.float64)
+    return np.atleast_2d(library)
+
+def overlap(eigenvectors, library, squared=False):
+    """
+    overlap |v . h| of modes v with all modes h of a library in a single matrix product
+    eigenvectors: [..., 3N], e.g. FRESEAN eigenvectors [nCorr, nModes, 3N] at every frequency
+    squared: (v . h)^2, sums to 1 over a complete orthonormal basis
+    returns: [..., nLibrary]
+    """
+    eigenvectors = np.asarray(eigenvectors)
+    basis = _basis(library)
+    projection = (eigenvectors.reshape(-1, eigenvectors.shape[-1]) @ basis.T).reshape(eigenvectors.shape[:-1] + (len(basis),))
+    if squared:
+        return projection * projection
+    return np.abs(projection)
+
+def vdos(corrMatrix, library):
+    """1D-VDoS (Eq. 11) of all modes of a library [nModes, nCorr] (see fresean.mode_vdos)"""
+    return fresean.mode_vdos(corrMatrix, _basis(library))
+
+def vdos_from_eigenmodes(eigenvalues, eigenvectors, library):
+    """
+    1D-VDoS of all library modes from FRESEAN eigenpairs, without the correlation matrix:
+    VDoS_h(k) = sum_m eigenvalues[k, m] (eigenvectors[k, m] . h)^2
+    (equal to vdos() if all eigenpairs are included, a lower bound for the leading eigenpairs)
+    returns: [nLibrary, nCorr]
+    """
+    return np.einsum('km,kmh->hk', eigenvalues, overlap(eigenvectors, library, squared=True))
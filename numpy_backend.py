@@ -0,0 +1,196 @@
+import numpy as np
+import metrics
+
+# error codes, same as in ctypes/unwrap.c and ctypes/align.c (see metrics.errorMessages)
+ERR_DUMMY_FIRST = 2
+ERR_NO_RESIDUES = 3
+
+class trees:
+    """
+    molecules as breadth-first bond trees (same trees as t_trees in ctypes/unwrap.c)
+    edges are ordered by depth, levelStart[l] ... levelStart[l+1]-1 are the edges of level l+1
+    (all edges of one level are independent and unwrapped at once)
+    """
+    def __init__(self, root, parent, child, levelStart):
+        self.root = root
+        self.parent = parent
+        self.child = child
+        self.levelStart = levelStart
+        self.nTrees = len(root)
+        self.nEdges = len(child)
+
+def _component_roots(nAtoms, offsets, neighbors):
+    """lowest atom index of the molecule (connected component) of each atom"""
+    atoms = np.repeat(np.arange(nAtoms), np.diff(offsets))
+    labels = np.arange(nAtoms)
+    while True:
+        # smallest label among the bonded neighbors, then pointer jumping
+        new = labels.copy()
+        np.minimum.at(new, atoms, labels[neighbors])
+        while True:
+            jumped = new[new]
+            if np.array_equal(jumped, new):
+                break
+            new = jumped
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+def build_trees(offsets, neighbors, masses, error=None):
+    """
+    breadth-first bond trees from a CSR bond adjacency, same trees as buildTrees in C:
+    - each tree starts at the lowest atom index of a molecule
+    - the parent of an atom is the first atom in breadth-first order that is bonded to it
+    - isolated zero-mass (dummy) atoms are attached to the root of the previous tree
+    all molecules are searched at once, one level per iteration
+    returns: (error code, trees)
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    neighbors = np.asarray(neighbors, dtype=np.int64)
+    nAtoms = len(offsets) - 1
+    degree = np.diff(offsets)
+    component = _component_roots(nAtoms, offsets, neighbors)
+    roots = np.flatnonzero(component == np.arange(nAtoms))
+    depth = np.full(nAtoms, -1, dtype=np.int64)
+    parent = np.full(nAtoms, -1, dtype=np.int64)
+    depth[roots] = 0
+    parents = []
+    children = []
+    frontier = roots
+    while len(frontier) > 0:
+        # bonded neighbors of the frontier in queue order (frontier order, then CSR order)
+        counts = degree[frontier]
+        owners = np.repeat(frontier, counts)
+        first = np.repeat(offsets[frontier] - np.cumsum(counts) + counts, counts)
+        nbs = neighbors[first + np.arange(len(owners))]
+        new = depth[nbs] < 0
+        nbs, owners = nbs[new], owners[new]
+        # the first atom in queue order that reaches a neighbor becomes its parent
+        nbs, firstSeen = np.unique(nbs, return_index=True)
+        order = np.argsort(firstSeen, kind='stable')
+        nbs, owners = nbs[order], owners[firstSeen[order]]
+        depth[nbs] = depth[owners] + 1
+        parent[nbs] = owners
+        parents.append(owners)
+        children.append(nbs)
+        frontier = nbs
+    dummies = roots[(degree[roots] == 0) & (masses[roots] == 0.0)]
+    roots = np.setdiff1d(roots, dummies)
+    if len(dummies) > 0:
+        previous = np.searchsorted(roots, dummies) - 1
+        if previous[0] < 0:
+            return metrics.set_error(error, ERR_DUMMY_FIRST, -1, int(dummies[0]), 0, nAtoms), None
+        # pretend there is a bond with the root of the previous molecule (depth 1)
+        if len(parents) == 0:
+            parents.append(np.empty(0, dtype=np.int64))
+            children.append(np.empty(0, dtype=np.int64))
+        parents[0] = np.concatenate((parents[0], roots[previous]))
+        children[0] = np.concatenate((children[0], dummies))
+    levelStart = np.zeros(len(children) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in children], out=levelStart[1:])
+    parents = np.concatenate(parents) if parents else np.empty(0, dtype=np.int64)
+    children = np.concatenate(children) if children else np.empty(0, dtype=np.int64)
+    return 0, trees(roots, parents, children, levelStart)
+
+def unwrap_frames(trees, coords, boxes):
+    """
+    unwrap coords [nFrames, nAtoms, 3] (float32) in place, boxes: box dimensions [nFrames, 6]
+    level by level, same arithmetic as unwrapTree in C (results are identical)
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 1, 6)
+    box = boxes[:, :, :3]
+    halfBox = box.astype(np.float64) / 2.0
+    for l in range(len(trees.levelStart) - 1):
+        parent = trees.parent[trees.levelStart[l]:trees.levelStart[l + 1]]
+        child = trees.child[trees.levelStart[l]:trees.levelStart[l + 1]]
+        link = coords[:, child] - coords[:, parent]
+        # shift by box lengths until the link is at most half the box
+        above = link > halfBox
+        while above.any():
+            link = np.where(above, link - box, link)
+            above = link > halfBox
+        below = link < -halfBox
+        while below.any():
+            link = np.where(below, link + box, link)
+            below = link < -halfBox
+        coords[:, child] = coords[:, parent] + link
+    return 0
+
+class reference:
+    """fixed reference and residues of the system (what setup in ctypes/align.c stores in t_align)"""
+    def __init__(self, massesRef, refCrd, massesSys, nAtomsPerRes):
+        self.massesRef = np.asarray(massesRef, dtype=np.float64)
+        self.totMassRef = np.sum(self.massesRef)
+        refCrd = np.asarray(refCrd, dtype=np.float64)
+        self.COMrefFix = (self.massesRef @ refCrd / self.totMassRef).astype(np.float32)
+        # centered reference coordinates
+        self.crdRefFix = refCrd - self.COMrefFix
+        self.massesSys = np.asarray(massesSys, dtype=np.float64)
+        nAtomsPerRes = np.asarray(nAtomsPerRes, dtype=np.int64)
+        self.nResSys = len(nAtomsPerRes)
+        # residues are contiguous: atoms resStart[r] ... resStart[r+1]-1
+        self.resStart = np.zeros(self.nResSys + 1, dtype=np.int64)
+        np.cumsum(nAtomsPerRes, out=self.resStart[1:])
+        self.resIndex = np.repeat(np.arange(self.nResSys), nAtomsPerRes)
+        self.resMass = np.diff(np.r_[0.0, np.cumsum(self.massesSys)][self.resStart])
+
+def _mass_weighted(masses, totMass, crdVel):
+    """center of mass (or COM velocity) [nFrames, 1, 3] of crdVel [nFrames, nAtoms, 3]"""
+    return (np.einsum('a,fai->fi', masses, crdVel, dtype=np.float64) / totMass).astype(np.float32)[:, None]
+
+def fit(ref, crdRef):
+    """
+    rotation matrices R [nFrames, 3, 3] that fit the centered reference group crdRef [nFrames, nAtomsRef, 3]
+    onto the fixed reference (mass-weighted least squares, proper rotations via SVD)
+    returns: (R, RMSD after fitting [nFrames])
+    """
+    x = np.asarray(crdRef, dtype=np.float64)
+    V, S, Wt = np.linalg.svd(np.einsum('a,ai,faj->fij', ref.massesRef, ref.crdRefFix, x))
+    # no reflections
+    d = np.sign(np.linalg.det(V @ Wt))
+    V[:, :, 2] *= np.where(d == 0.0, 1.0, d)[:, None]
+    R = V @ Wt
+    diff = ref.crdRefFix - x @ R.transpose(0, 2, 1)
+    msd = np.einsum('a,fai->f', ref.massesRef, diff * diff) / ref.totMassRef
+    return R, np.sqrt(np.maximum(msd, 0.0))
+
+def align_frames(settings, ref, crdRef, velRef, crdSys, velSys, doVel, boxes):
+    """
+    align a block of frames in place, same steps as alignCrd/alignCrdVel in C:
+    remove reference COM (and COM velocity) -> residue COM into box -> rotate -> re-translate
+    settings: t_align (or any object with its settings attributes)
+    crdRef, velRef: reference group [nFrames, nAtomsRef, 3] (taken before alignment)
+    crdSys, velSys: all atoms [nFrames, nAtoms, 3] (float32, velSys only used if doVel)
+    boxes: box vectors [nFrames, 3, 3]
+    returns: (error code, rotated box vectors, RMSD of the reference group or -1 if not rotated)
+    """
+    boxes = np.array(boxes, dtype=np.float32).reshape(-1, 3, 3)
+    rmsd = np.full(len(boxes), -1.0, dtype=np.float32)
+    if settings.align == 0:
+        return 0, boxes, rmsd
+    refCOM = _mass_weighted(ref.massesRef, ref.totMassRef, crdRef)
+    crdRef = crdRef - refCOM
+    crdSys -= refCOM
+    if doVel and settings.subCOMvel != 0:
+        velSys -= _mass_weighted(ref.massesRef, ref.totMassRef, velRef)
+    if settings.placeCOMInBox != 0:
+        if ref.nResSys == 0:
+            return ERR_NO_RESIDUES, boxes, rmsd
+        diag = np.diagonal(boxes, axis1=1, axis2=2)[:, None]
+        # residue COMs from cumulative sums over the (contiguous) residues
+        cumulative = np.zeros((len(crdSys), crdSys.shape[1] + 1, 3))
+        np.cumsum(ref.massesSys[:, None] * crdSys, axis=1, out=cumulative[:, 1:])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            COM = (np.diff(cumulative[:, ref.resStart], axis=1) / ref.resMass[:, None]).astype(np.float32)
+        pbcJump = np.where(COM < -diag / 2, diag, 0.0) - np.where(COM > diag / 2, diag, 0.0)
+        crdSys += pbcJump.astype(np.float32)[:, ref.resIndex]
+    if settings.rotate != 0:
+        R, rmsd[:] = fit(ref, crdRef)
+        Rt = R.transpose(0, 2, 1)
+        crdSys[:] = crdSys @ Rt
+        if doVel and settings.rotVel != 0:
+            velSys[:] = velSys @ Rt
+        boxes = (boxes @ Rt).astype(np.float32)
+    if settings.centerCOM == 0:
+        crdSys += ref.COMrefFix
+    return 0, boxes, rmsd
@@ -0,0 +1,279 @@
+import json
+import multiprocessing
+import queue
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+import MDAnalysis as mda
+import segmentation
+
+# seconds between checks of the worker processes while waiting for a block
+pollInterval = 1.0
+
+def _worker(job, tasks, freeSlots, done, shmName, shape):
+    """
+    worker process with its own Universe, unwrap trees and align state
+    - takes a free shared memory slot, then the next chunk of frame indices
+    - writes mass-weighted velocities [nFrames, 3N] of the chunk into the slot,
+      for job['record'] followed by positions (3N), box dimensions (6) and time (1) of each frame
+      and for job['dihedrals'] by the dihedral angles of each frame (same pass over the trajectory)
+    """
+    import unwrap as pbc
+    import align as fit
+    import segmentation
+    try:
+        u = mda.Universe(job['topology'], job['trajectory'])
+        sel = u.select_atoms(job['selection'])
+        unwrap = pbc.unwrap(u) if job['unwrap'] else None
+        if job['alignKwargs'] is not None:
+            refSel = u.select_atoms(job['refSelection'])
+            align = fit.align(u, refSel, **job['alignKwargs'])
+        else:
+            align = None
+        # store square root of atomic masses for each DOF
+        sqm = np.repeat(np.sqrt(sel.atoms.masses), 3)
+        nDOF = len(sqm)
+        column = 2 * nDOF + 7 if job['record'] else nDOF
+        dihedrals = job.get('dihedrals')
+        shm = shared_memory.SharedMemory(name=shmName)
+        slots = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    except Exception:
+        done.put(('error', traceback.format_exc(), None))
+        return
+    try:
+        while True:
+            # holding a slot before taking a chunk guarantees that the
+            # chunk expected next by the consumer can always be completed
+            slot = freeSlots.get()
+            task = tasks.get()
+            if task is None:
+                freeSlots.put(slot)
+                break
+            chunk, frames = task
+            for n, ts in enumerate(u.trajectory[frames]):
+                if unwrap is not None:
+                    unwrap.single_frame()
+                if align is not None:
+                    align.single_frame()
+                slots[slot, n, :nDOF] = sqm * sel.velocities.flatten()
+                if job['record']:
+                    slots[slot, n, nDOF:2 * nDOF] = sel.positions.flatten()
+                    slots[slot, n, 2 * nDOF:2 * nDOF + 6] = np.nan if ts.dimensions is None else ts.dimensions
+                    slots[slot, n, 2 * nDOF + 6] = ts.time
+                if dihedrals is not None:
+                    slots[slot, n, column:column + len(dihedrals)] = segmentation.dihedral_angles(u.atoms.positions, dihedrals)
+            done.put((chunk, slot, len(frames)))
+    except Exception:
+        done.put(('error', traceback.format_exc(), None))
+    finally:
+        del slots
+        shm.close()
+
+def iter_blocks(topology,
+                trajectory,
+                selection='all',
+                frames=None,
+                nWorkers=4,
+                chunkSize=250,
+                prefetch=2,
+                unwrap=True,
+                refSelection=None,
+                alignKwargs=None,
+                dihedrals=None):
+    """
+    multi-process preprocessing: read, unwrap and align frames in worker processes
+
+    topology, trajectory: files used to create an MDAnalysis Universe in each worker
+    selection: atoms for which mass-weighted velocities are extracted
+    frames: frame indices (default: all frames)
+    nWorkers: number of worker processes
+    chunkSize: number of frames per block handed to a worker
+    prefetch: number of blocks that can be buffered ahead of the consumer
+    unwrap: make molecules whole (unwrap.single_frame())
+    refSelection: reference atoms for alignment (default: selection)
+    alignKwargs: keyword arguments of align.align (e.g. dict(rotVel=1, placeCOMInBox=0, altRefPos=...)),
+                 None disables alignment
+    dihedrals: optional dihedrals computed in the same pass (atom groups such as residue.phi_selection()
+               or atom index quadruplets, see segmentation.dihedral_indices)
+    yields: mass-weighted velocity blocks [3N, nBlockFrames] in frame order
+            (views into shared memory, valid until the next block is requested),
+            with dihedrals (velocity block, dihedral angles [nBlockFrames, nDihedrals]) instead
+    """
+    u = mda.Universe(topology, trajectory)
+    nDOF = 3 * u.select_atoms(selection).n_atoms
+    if frames is None:
+        frames = np.arange(len(u.trajectory))
+    job = dict(topology=topology,
+               trajectory=trajectory,
+               selection=selection,
+               refSelection=selection if refSelection is None else refSelection,
+               unwrap=unwrap,
+               alignKwargs=alignKwargs,
+               record=False,
+               dihedrals=None if dihedrals is None else segmentation.dihedral_indices(dihedrals))
+    if dihedrals is None:
+        for chunkFrames, block in _blocks(job, frames, nDOF, nWorkers, chunkSize, prefetch):
+            yield block.T
+        return
+    for chunkFrames, block in _blocks(job, frames, nDOF + len(job['dihedrals']), nWorkers, chunkSize, prefetch):
+        yield block[:, :nDOF].T, block[:, nDOF:]
+
+def _blocks(job, frames, width, nWorkers, chunkSize, prefetch):
+    """
+    run the workers for job, yields (frame indices, block [nBlockFrames, width]) in frame order
+    (blocks are views into shared memory, valid until the next block is requested)
+    """
+    frames = np.asarray(frames)
+    chunks = [frames[i:i + chunkSize] for i in range(0, len(frames), chunkSize)]
+    nSlots = nWorkers + prefetch
+    shape = (nSlots, chunkSize, width)
+
+    ctx = multiprocessing.get_context('spawn')
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+    slots = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    tasks = ctx.Queue()
+    freeSlots = ctx.Queue()
+    done = ctx.Queue()
+    for slot in range(nSlots):
+        freeSlots.put(slot)
+    for chunk, chunkFrames in enumerate(chunks):
+        tasks.put((chunk, chunkFrames))
+    for i in range(nWorkers):
+        tasks.put(None)
+    workers = [ctx.Process(target=_worker, args=(job, tasks, freeSlots, done, shm.name, shape))
+               for i in range(nWorkers)]
+    for p in workers:
+        p.start()
+    try:
+        # blocks can complete out of order, keep them until it is their turn
+        finished = {}
+        for chunk in range(len(chunks)):
+            while chunk not in finished:
+                try:
+                    key, slot, n = done.get(timeout=pollInterval)
+                except queue.Empty:
+                    # a worker killed by a signal (segfault, OOM) never reports an error
+                    failed = [p.exitcode for p in workers if p.exitcode not in (None, 0)]
+                    if failed:
+                        raise RuntimeError(f"pipeline worker exited with code {failed[0]}")
+                    if all(p.exitcode is not None for p in workers):
+                        raise RuntimeError("pipeline workers exited before all blocks were completed")
+                    continue
+                if key == 'error':
+                    raise RuntimeError(f"pipeline worker failed:\n{slot}")
+                finished[key] = (slot, n)
+            slot, n = finished.pop(chunk)
+            yield chunks[chunk], slots[slot, :n]
+            freeSlots.put(slot)
+    finally:
+        for p in workers:
+            p.join(timeout=1.0)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        del slots
+        shm.close()
+        shm.unlink()
+
+def velocities(topology, trajectory, selection='all', frames=None, dtype=np.float64, dihedrals=None, **kwargs):
+    """
+    mass-weighted velocities [3N, nFrames] extracted with the multi-process pipeline
+    (same as the per-frame loop in the notebooks, see iter_blocks for options)
+    dtype: storage precision, e.g. np.float32 for fresean.correlation_matrix(..., dtype=np.float32)
+    dihedrals: also compute these dihedrals in the same pass, returns (velocities, angles [nFrames, nDihedrals])
+    """
+    u = mda.Universe(topology, trajectory)
+    if frames is None:
+        frames = np.arange(len(u.trajectory))
+    velocities = np.empty((3 * u.select_atoms(selection).n_atoms, len(frames)), dtype=dtype)
+    angles = None if dihedrals is None else np.empty((len(frames), len(dihedrals)))
+    offset = 0
+    for block in iter_blocks(topology, trajectory, selection, frames, dihedrals=dihedrals, **kwargs):
+        if dihedrals is not None:
+            block, blockAngles = block
+            angles[offset:offset + len(blockAngles)] = blockAngles
+        velocities[:, offset:offset + block.shape[1]] = block
+        offset += block.shape[1]
+    if dihedrals is not None:
+        return velocities, angles
+    return velocities
+
+def extract(topology,
+            trajectory,
+            directory,
+            selection='all',
+            frames=None,
+            nWorkers=4,
+            chunkSize=250,
+            prefetch=2,
+            unwrap=True,
+            refSelection=None,
+            alignKwargs=None,
+            dihedrals=None,
+            dtype=np.float32,
+            overwrite=False):
+    """
+    preprocess a trajectory once into a store.frameStore (unwrapped, aligned positions,
+    mass-weighted velocities, boxes and times of the selected atoms)
+    later analyses read the store instead of decoding the trajectory again, e.g.
+    fresean.correlation_matrix(frames.velocities(), ...) or conformers.select_conformer(frames, None, ...)
+    an existing complete store with the same inputs is reused (overwrite=True rebuilds it)
+    directory: output directory, dtype: storage precision of positions and velocities
+    dihedrals: dihedral angles stored along (frames.dihedrals(), for segmentation.label_frames)
+    other options as in iter_blocks (alignKwargs arrays such as altRefPos are part of the inputs)
+    returns: store.frameStore
+    """
+    import cache
+    import store
+    u = mda.Universe(topology, trajectory)
+    sel = u.select_atoms(selection)
+    if frames is None:
+        frames = np.arange(len(u.trajectory))
+    frames = np.asarray(frames, dtype=np.int64)
+    if dihedrals is not None:
+        dihedrals = segmentation.dihedral_indices(dihedrals)
+    inputs = cache.canonical(dict(topology=cache.file_identity(topology),
+                                  trajectory=cache.file_identity(trajectory),
+                                  selection=selection,
+                                  frames=frames,
+                                  dtype=np.dtype(dtype).name,
+                                  unwrap=unwrap,
+                                  refSelection=refSelection,
+                                  alignKwargs=alignKwargs,
+                                  dihedrals=dihedrals))
+    if store.frameStore.complete(directory) and not overwrite:
+        frameStore = store.frameStore(directory)
+        if frameStore.meta['inputs'] == json.loads(json.dumps(inputs)):
+            return frameStore
+        print(f"inputs of {directory} changed, extracting again")
+    nAtoms = sel.n_atoms
+    nDOF = 3 * nAtoms
+    nDihedrals = 0 if dihedrals is None else len(dihedrals)
+    frameStore = store.frameStore(directory, mode='w+', nFrames=len(frames), nAtoms=nAtoms,
+                                  nDihedrals=nDihedrals, dtype=dtype)
+    job = dict(topology=topology,
+               trajectory=trajectory,
+               selection=selection,
+               refSelection=selection if refSelection is None else refSelection,
+               unwrap=unwrap,
+               alignKwargs=alignKwargs,
+               record=True,
+               dihedrals=dihedrals)
+    offset = 0
+    for chunkFrames, block in _blocks(job, frames, 2 * nDOF + 7 + nDihedrals, nWorkers, chunkSize, prefetch):
+        n = len(chunkFrames)
+        rows = slice(offset, offset + n)
+        frameStore['velocities'][rows] = block[:, :nDOF]
+        frameStore['positions'][rows] = block[:, nDOF:2 * nDOF].reshape(n, nAtoms, 3)
+        frameStore['boxes'][rows] = block[:, 2 * nDOF:2 * nDOF + 6]
+        frameStore['times'][rows] = block[:, 2 * nDOF + 6]
+        frameStore['frames'][rows] = chunkFrames
+        if nDihedrals > 0:
+            frameStore['dihedrals'][rows] = block[:, 2 * nDOF + 7:]
+        offset += n
+    frameStore.finish(selection=selection,
+                      indices=sel.indices.tolist(),
+                      masses=sel.masses.tolist(),
+                      dihedrals=None if dihedrals is None else dihedrals.tolist(),
+                      inputs=inputs)
+    return frameStore
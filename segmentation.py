@@ -0,0 +1,108 @@
+import numpy as np
+
+def dihedral_angles(positions, indices):
+    """
+    dihedral angles (degrees, -180 to 180) for all frames at once
+    positions: [nAtoms, 3] or [nFrames, nAtoms, 3] (molecules must be whole, e.g. after unwrap)
+    indices: atom indices [nDihedrals, 4] (or a single quadruplet)
+    returns: [nDihedrals] or [nFrames, nDihedrals]
+    """
+    indices = np.atleast_2d(np.asarray(indices, dtype=np.int64))
+    p = np.asarray(positions, dtype=np.float64)[..., indices, :]
+    # bond vectors a-b, b-c, c-d and the normals of both planes (same convention as MDAnalysis)
+    ab = p[..., 1, :] - p[..., 0, :]
+    bc = p[..., 2, :] - p[..., 1, :]
+    cd = p[..., 3, :] - p[..., 2, :]
+    n1 = np.cross(ab, bc)
+    n2 = np.cross(bc, cd)
+    x = np.sum(n1 * n2, axis=-1)
+    y = np.sum(np.cross(n1, n2) * bc, axis=-1) / np.linalg.norm(bc, axis=-1)
+    return np.degrees(np.arctan2(y, x))
+
+def dihedral_indices(groups):
+    """atom indices [nDihedrals, 4] of atom groups (e.g. residue.phi_selection()) or index quadruplets"""
+    return np.array([getattr(g, 'indices', g) for g in groups], dtype=np.int64).reshape(-1, 4)
+
+def in_range(angles, limits):
+    """
+    mask of angles within limits (degrees)
+    limits: (lower, upper), lower > upper wraps around +-180, e.g. (100, -150) for [100, 180] or [-180, -150]
+            a list of such pairs selects angles in any of them, None selects all angles
+    """
+    angles = np.asarray(angles)
+    if limits is None:
+        return np.ones(angles.shape, dtype=bool)
+    if np.ndim(limits[0]) > 0:
+        mask = np.zeros(angles.shape, dtype=bool)
+        for pair in limits:
+            mask |= in_range(angles, pair)
+        return mask
+    lower, upper = limits
+    if lower <= upper:
+        return (angles >= lower) & (angles <= upper)
+    return (angles >= lower) | (angles <= upper)
+
+def label_frames(angles, basins):
+    """
+    conformational basin of each frame
+    angles: dihedral time series [nFrames, nDihedrals]
+    basins: list of basins, each with limits for every dihedral (see in_range), e.g. for (phi, psi)
+            [[(-180, 0), (100, -150)], [(-180, 0), (-120, 60)]]
+            a dict {name: limits} is accepted as well (labels follow its order)
+    returns: labels [nFrames] (index of the first matching basin, -1 for frames in no basin)
+    """
+    angles = np.asarray(angles)
+    if angles.ndim == 1:
+        angles = angles[:, None]
+    if isinstance(basins, dict):
+        basins = list(basins.values())
+    labels = np.full(len(angles), -1, dtype=np.int32)
+    # later basins are assigned first, so the first matching basin wins
+    for b in range(len(basins) - 1, -1, -1):
+        if len(basins[b]) != angles.shape[1]:
+            raise ValueError(f"basin {b} has limits for {len(basins[b])} of {angles.shape[1]} dihedrals")
+        mask = np.ones(len(angles), dtype=bool)
+        for d, limits in enumerate(basins[b]):
+            mask &= in_range(angles[:, d], limits)
+        labels[mask] = b
+    return labels
+
+def runs(labels):
+    """
+    run-length encoding of a label (or mask) time series
+    returns: (starts, stops, values), frames starts[i] ... stops[i]-1 all have values[i]
+    """
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), labels[:0]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    stops = np.r_[starts[1:], len(labels)]
+    return starts, stops, labels[starts]
+
+def segments(labels, minLength=1, label=None):
+    """
+    all consecutive segments of frames in the same basin (unassigned frames, label -1, are skipped)
+    minLength: shortest segment that is kept (frames)
+    label: only segments of this basin (boolean masks: True)
+    returns: (starts, stops, labels) of the segments in frame order (stops exclusive)
+    """
+    starts, stops, values = runs(labels)
+    keep = stops - starts >= minLength
+    if label is not None:
+        keep &= values == label
+    elif values.dtype != bool:
+        keep &= values >= 0
+    else:
+        keep &= values
+    return starts[keep], stops[keep], values[keep]
+
+def longest_segment(labels, label=True):
+    """
+    frame indices of the longest segment of a basin (first one for ties), None if there is none
+    same result as longest_consecutive_indices in the notebooks for a mask of the limits
+    """
+    starts, stops, values = segments(labels, label=label)
+    if len(starts) == 0:
+        return None
+    i = np.argmax(stops - starts)
+    return np.arange(starts[i], stops[i])
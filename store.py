@@ -0,0 +1,267 @@
+import json
+import os
+import numpy as np
+
+class corrStore:
+    """
+    storage for the velocity correlation matrix [nCorr, 3N, 3N]
+    - disk-backed (memory-mapped .npy file) or in memory (filename=None)
+    - one contiguous frequency slab per chunk
+    - optional float32 storage
+    - optional packed layout: only the upper triangle of each slab is stored
+      (row-major, same order as np.triu_indices), which halves disk and memory
+    """
+    def __init__(self,
+                 filename=None,
+                 nCorr=None,
+                 nDOF=None,
+                 dtype=np.float64,
+                 packed=False,
+                 mode='w+'):
+        self.filename = filename
+        if mode == 'w+':
+            if nCorr is None or nDOF is None:
+                raise ValueError("nCorr and nDOF are required to create a new store")
+            if packed:
+                shape = (nCorr, nDOF * (nDOF + 1) // 2)
+            else:
+                shape = (nCorr, nDOF, nDOF)
+            if filename is None:
+                self.data = np.zeros(shape, dtype=dtype)
+            else:
+                self.data = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+        else:
+            # open existing store, layout is inferred from the array shape
+            self.data = np.lib.format.open_memmap(filename, mode=mode)
+        self.packed = self.data.ndim == 2
+        self.nCorr = self.data.shape[0]
+        if self.packed:
+            self.nDOF = int(round((np.sqrt(8 * self.data.shape[1] + 1) - 1) / 2))
+            if self.nDOF * (self.nDOF + 1) // 2 != self.data.shape[1]:
+                raise ValueError(f"{filename} does not contain a packed upper triangle")
+            # start of each row of the upper triangle in packed layout
+            rows = np.arange(self.nDOF)
+            self.rowStart = rows * self.nDOF - rows * (rows - 1) // 2
+            self.triu = None
+        else:
+            self.nDOF = self.data.shape[1]
+        self.dtype = self.data.dtype
+        self.shape = (self.nCorr, self.nDOF, self.nDOF)
+
+    def __len__(self):
+        return self.nCorr
+
+    def __getitem__(self, k):
+        """full symmetric slab at frequency index k (float64)"""
+        if not self.packed:
+            return np.asarray(self.data[k], dtype=np.float64)
+        slab = self.slab(k)
+        iu = self._triu()
+        slab[iu[1], iu[0]] = self.data[k]
+        return slab
+
+    def _triu(self):
+        if self.triu is None:
+            self.triu = np.triu_indices(self.nDOF)
+        return self.triu
+
+    def slab(self, k):
+        """
+        slab at frequency index k (float64)
+        for the packed layout only the upper triangle is filled (use with UPLO='U')
+        """
+        if not self.packed:
+            return np.array(self.data[k], dtype=np.float64)
+        slab = np.zeros((self.nDOF, self.nDOF))
+        slab[self._triu()] = self.data[k]
+        return slab
+
+    def slabs(self):
+        """iterate over frequency slabs, one chunk in memory at a time"""
+        for k in range(self.nCorr):
+            yield self.slab(k)
+
+    def block(self, iSlice, jSlice, nCorr=None):
+        """elements [nCorr, bi, bj] for DOF pairs (iSlice, jSlice) (float64), first nCorr frames only"""
+        nCorr = self.nCorr if nCorr is None else nCorr
+        if not self.packed:
+            return np.asarray(self.data[:nCorr, iSlice, jSlice], dtype=np.float64)
+        i = np.arange(iSlice.start, iSlice.stop)[:, None]
+        j = np.arange(jSlice.start, jSlice.stop)[None, :]
+        # elements below the diagonal are read from the upper triangle
+        a = np.minimum(i, j)
+        b = np.maximum(i, j)
+        return np.asarray(self.data[:nCorr, self.rowStart[a] + b - a], dtype=np.float64)
+
+    def set_block(self, iSlice, jSlice, tile):
+        """
+        store tile [nCorr, bi, bj] for DOF pairs (iSlice, jSlice)
+        the tile is expected to be in the upper triangle (jSlice.start >= iSlice.start)
+        """
+        if not self.packed:
+            self.data[:, iSlice, jSlice] = tile
+            # use symmetry of correlation matrix
+            self.data[:, jSlice, iSlice] = tile.transpose(0, 2, 1)
+            return
+        j0 = jSlice.start
+        j1 = jSlice.stop
+        for r, i in enumerate(range(iSlice.start, iSlice.stop)):
+            # only elements with j >= i are stored
+            jStart = max(j0, i)
+            if jStart >= j1:
+                continue
+            p = self.rowStart[i] + jStart - i
+            self.data[:, p:p + j1 - jStart] = tile[:, r, jStart - j0:]
+
+    def scale(self, factor):
+        """multiply all elements by factor, slab by slab"""
+        for k in range(self.nCorr):
+            self.data[k] *= factor
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+class frameStore:
+    """
+    frame-major store of preprocessed (unwrapped, aligned) frames of the selected atoms,
+    written once by pipeline.extract() and memory-mapped by all later analyses
+    - directory with one .npy file per array and meta.json:
+      positions [nFrames, nAtoms, 3], velocities [nFrames, 3N] (mass-weighted),
+      boxes [nFrames, 6] (nan without box), times [nFrames], frames [nFrames] (trajectory frame indices)
+      and optional dihedrals [nFrames, nDihedrals] (degrees)
+    - meta.json holds the atom indices, masses and the inputs of the extraction,
+      it is written last and marks the store as complete
+    slices by trajectory frame indices with a constant stride are views (no copies)
+    """
+    names = ('positions', 'velocities', 'boxes', 'times', 'frames')
+
+    def __init__(self, directory, mode='r', nFrames=None, nAtoms=None, nDihedrals=0, dtype=np.float32):
+        self.directory = directory
+        if mode == 'w+':
+            if nFrames is None or nAtoms is None:
+                raise ValueError("nFrames and nAtoms are required to create a new store")
+            os.makedirs(directory, exist_ok=True)
+            # a store without metadata is incomplete
+            if os.path.exists(self._file('meta')):
+                os.remove(self._file('meta'))
+            shapes = dict(positions=((nFrames, nAtoms, 3), dtype),
+                          velocities=((nFrames, 3 * nAtoms), dtype),
+                          boxes=((nFrames, 6), np.float32),
+                          times=((nFrames,), np.float64),
+                          frames=((nFrames,), np.int64))
+            if nDihedrals > 0:
+                shapes['dihedrals'] = ((nFrames, nDihedrals), np.float64)
+            self.arrays = {name: np.lib.format.open_memmap(self._file(name), mode='w+', dtype=d, shape=s)
+                           for name, (s, d) in shapes.items()}
+            self.meta = None
+        else:
+            if not frameStore.complete(directory):
+                raise ValueError(f"{directory} is not a complete frame store")
+            with open(self._file('meta')) as f:
+                self.meta = json.load(f)
+            names = self.names + (('dihedrals',) if self.meta.get('dihedrals') else ())
+            self.arrays = {name: np.lib.format.open_memmap(self._file(name), mode=mode) for name in names}
+        self.nFrames, self.nAtoms = self.arrays['positions'].shape[:2]
+        self.nDOF = 3 * self.nAtoms
+        self.dtype = self.arrays['positions'].dtype
+        self._start = self._step = None
+
+    def _file(self, name):
+        return os.path.join(self.directory, 'meta.json' if name == 'meta' else f"{name}.npy")
+
+    @staticmethod
+    def complete(directory):
+        return os.path.exists(os.path.join(directory, 'meta.json'))
+
+    def __len__(self):
+        return self.nFrames
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    @property
+    def masses(self):
+        return np.asarray(self.meta['masses'])
+
+    def _stride(self):
+        """(first frame, stride) if the stored frames are evenly spaced, else None"""
+        if self._start is None:
+            frames = self.arrays['frames']
+            step = int(frames[1] - frames[0]) if self.nFrames > 1 else 1
+            if step > 0 and np.array_equal(frames, frames[0] + step * np.arange(self.nFrames)):
+                self._start, self._step = int(frames[0]), step
+            else:
+                self._start, self._step = False, False
+        return None if self._start is False else (self._start, self._step)
+
+    def rows(self, frames=None):
+        """
+        rows of the trajectory frame indices frames (None: all), a slice selects
+        the stored frames in its range of trajectory frames (e.g. slice(100, 200, 4))
+        returns a slice if the frames are evenly spaced (zero-copy access), else an index array
+        """
+        if frames is None:
+            return slice(None)
+        if isinstance(frames, slice):
+            if frames == slice(None):
+                return slice(None)
+            # slice of trajectory frame indices, resolved against the stored frames
+            stored = self.arrays['frames']
+            step = 1 if frames.step is None else frames.step
+            if step <= 0:
+                raise ValueError("frame slices need a positive step")
+            start = int(np.min(stored)) if frames.start is None else frames.start
+            stop = int(np.max(stored)) + 1 if frames.stop is None else frames.stop
+            frames = np.arange(start, stop, step)
+            frames = frames[np.isin(frames, stored)]
+        frames = np.asarray(frames, dtype=np.int64)
+        stride = self._stride()
+        if stride is not None:
+            start, step = stride
+            rows = (frames - start) // step
+            valid = (frames - start) % step == 0
+        else:
+            order = np.argsort(self.arrays['frames'])
+            position = np.searchsorted(self.arrays['frames'], frames, sorter=order)
+            rows = order[np.minimum(position, self.nFrames - 1)]
+            valid = position < self.nFrames
+        valid &= (rows >= 0) & (rows < self.nFrames)
+        if not np.all(valid) or not np.array_equal(self.arrays['frames'][rows[valid]], frames):
+            raise ValueError(f"frames not in {self.directory}: {frames[~valid][:10].tolist()}")
+        if len(rows) > 1 and np.all(np.diff(rows) == rows[1] - rows[0]) and rows[1] > rows[0]:
+            return slice(int(rows[0]), int(rows[-1]) + 1, int(rows[1] - rows[0]))
+        if len(rows) == 1:
+            return slice(int(rows[0]), int(rows[0]) + 1)
+        return rows
+
+    def positions(self, frames=None, atoms=None):
+        """positions [nFrames, nAtoms, 3] at trajectory frames, atoms: optional indices within the store"""
+        positions = self.arrays['positions'][self.rows(frames)]
+        return positions if atoms is None else positions[:, atoms]
+
+    def velocities(self, frames=None):
+        """mass-weighted velocities [3N, nFrames] (as used by fresean.correlation_matrix)"""
+        return self.arrays['velocities'][self.rows(frames)].T
+
+    def boxes(self, frames=None):
+        return self.arrays['boxes'][self.rows(frames)]
+
+    def times(self, frames=None):
+        return self.arrays['times'][self.rows(frames)]
+
+    def dihedrals(self, frames=None):
+        """dihedral angles [nFrames, nDihedrals] (if extracted with dihedrals)"""
+        if 'dihedrals' not in self.arrays:
+            raise ValueError(f"{self.directory} contains no dihedrals")
+        return self.arrays['dihedrals'][self.rows(frames)]
+
+    def finish(self, **meta):
+        """flush all arrays and write the metadata (marks the store as complete)"""
+        for array in self.arrays.values():
+            array.flush()
+        self.meta = meta
+        tmp = self._file('meta') + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file('meta'))
@@ -0,0 +1,33 @@
+import os
+import sys
+
+# modules are imported from the repository root (as in the notebooks)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+dataDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+@pytest.fixture(scope='session')
+def trajectory(tmp_path_factory):
+    """
+    (topology, trajectory) of alanine dipeptide in water (solute only): 60 frames around
+    the harmonic minimum with random velocities in a 30 A box (molecules broken across the box)
+    """
+    import MDAnalysis as mda
+    topology = os.path.join(dataDir, 'MD-water-300K', 'topol.tpr')
+    filename = str(tmp_path_factory.mktemp('trajectory') / 'traj.trr')
+    u = mda.Universe(topology)
+    minimum = mda.Universe(os.path.join(dataDir, 'harmonic-normal-modes', 'min.xyz')).atoms.positions
+    rng = np.random.default_rng(0)
+    box = np.array([30.0, 30.0, 30.0, 90.0, 90.0, 90.0], dtype=np.float32)
+    with mda.Writer(filename, u.atoms.n_atoms) as w:
+        for i in range(60):
+            positions = minimum + rng.normal(scale=0.05, size=minimum.shape) + 28.0 + 0.05 * i
+            u.atoms.positions = positions % 30.0
+            u.atoms.velocities = rng.normal(scale=5.0, size=minimum.shape)
+            u.trajectory.ts.dimensions = box
+            u.trajectory.ts.time = 0.01 * i
+            w.write(u.atoms)
+    return topology, filename
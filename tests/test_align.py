@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import backends
+import benchmark
+import unwrap as pbc
+import align as fit
+
+pytestmark = pytest.mark.skipif(not backends.available('align'), reason="native align library not available")
+
+def _aligned(system, fitMethod, refAtoms, nAtoms=300, nFrames=4, rotVel=1, backend='native'):
+    """aligned coordinates, velocities and RMSD of all frames with one fit method"""
+    u = benchmark.systems[system](nAtoms, nFrames=nFrames, triclinic=False)
+    unwrap = pbc.unwrap(u, backend=backend)
+    align = fit.align(u, u.atoms[refAtoms], rotVel=rotVel, fitMethod=fitMethod, backend=backend)
+    crd, vel, rmsd = [], [], []
+    for ts in u.trajectory:
+        unwrap.single_frame()
+        align.single_frame()
+        crd.append(u.atoms.positions)
+        vel.append(u.atoms.velocities)
+        rmsd.append(align.rmsd)
+    unwrap.close()
+    return np.array(crd), np.array(vel), np.array(rmsd)
+
+def _assert_close(a, b, tol=1e-4):
+    # float32 kernels, tolerance relative to the largest value
+    np.testing.assert_allclose(a, b, rtol=0.0, atol=tol * max(np.max(np.abs(a)), 1.0))
+
+@pytest.mark.parametrize('system', ['water', 'alkane'])
+@pytest.mark.parametrize('rotVel', [0, 1])
+def test_qcp_matches_jacobi(system, rotVel):
+    refAtoms = slice(0, 60)
+    jacobi = _aligned(system, 'jacobi', refAtoms, rotVel=rotVel)
+    qcp = _aligned(system, 'qcp', refAtoms, rotVel=rotVel)
+    for a, b in zip(jacobi, qcp):
+        _assert_close(a, b)
+
+def test_qcp_matches_jacobi_planar_reference():
+    # a single water molecule: three atoms in a plane (one zero eigenvalue in the fit)
+    refAtoms = slice(0, 3)
+    jacobi = _aligned('water', 'jacobi', refAtoms)
+    qcp = _aligned('water', 'qcp', refAtoms)
+    # float64 SVD fit of the numpy backend
+    exact = _aligned('water', 'jacobi', refAtoms, backend='numpy')
+    for a, b, c in zip(jacobi, qcp, exact):
+        _assert_close(c, b, tol=1e-5)
+        # the single precision Jacobi iteration converges less tightly for degenerate references
+        _assert_close(a, b, tol=5e-4)
+
+def test_qcp_matches_jacobi_linear_reference():
+    # two atoms: rotations about the bond are arbitrary, compare the reference atoms and RMSD only
+    refAtoms = slice(0, 2)
+    crdJacobi, velJacobi, rmsdJacobi = _aligned('water', 'jacobi', refAtoms)
+    crdQCP, velQCP, rmsdQCP = _aligned('water', 'qcp', refAtoms)
+    crdExact, velExact, rmsdExact = _aligned('water', 'jacobi', refAtoms, backend='numpy')
+    _assert_close(crdExact[:, refAtoms], crdQCP[:, refAtoms], tol=1e-5)
+    _assert_close(crdJacobi[:, refAtoms], crdQCP[:, refAtoms], tol=5e-4)
+    np.testing.assert_allclose(rmsdJacobi, rmsdQCP, atol=1e-4)
+    np.testing.assert_allclose(rmsdExact, rmsdQCP, atol=1e-4)
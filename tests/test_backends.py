@@ -0,0 +1,80 @@
+import shutil
+import subprocess
+import numpy as np
+import pytest
+import backends
+import benchmark
+import unwrap as pbc
+import align as fit
+
+native = pytest.mark.skipif(not (backends.available('unwrap') and backends.available('align')),
+                            reason="native libraries not available")
+
+def _unwrapped(backend, system, nAtoms=600, nFrames=3):
+    u = benchmark.systems[system](nAtoms, nFrames=nFrames, triclinic=False)
+    unwrap = pbc.unwrap(u, backend=backend)
+    crd = []
+    for ts in u.trajectory:
+        unwrap.single_frame()
+        crd.append(u.atoms.positions)
+    unwrap.close()
+    return np.array(crd)
+
+def _aligned(backend, system, fitMethod, rotVel, nAtoms=600, nFrames=3):
+    u = benchmark.systems[system](nAtoms, nFrames=nFrames, triclinic=False)
+    unwrap = pbc.unwrap(u, backend=backend)
+    align = fit.align(u, u.atoms[:150], rotVel=rotVel, fitMethod=fitMethod, backend=backend)
+    crd, vel, boxes, rmsd = [], [], [], []
+    for ts in u.trajectory:
+        unwrap.single_frame()
+        align.single_frame()
+        crd.append(u.atoms.positions)
+        vel.append(u.atoms.velocities)
+        boxes.append(align.box)
+        rmsd.append(align.rmsd)
+    unwrap.close()
+    return [np.array(x, dtype=np.float64) for x in (crd, vel, boxes, rmsd)]
+
+@native
+@pytest.mark.parametrize('system', ['water', 'alkane'])
+def test_unwrap_backends_agree(system):
+    # same arithmetic in both backends
+    np.testing.assert_array_equal(_unwrapped('native', system), _unwrapped('numpy', system))
+
+@native
+@pytest.mark.parametrize('system', ['water', 'alkane'])
+@pytest.mark.parametrize('fitMethod', ['jacobi', 'qcp'])
+@pytest.mark.parametrize('rotVel', [0, 1])
+def test_align_backends_agree(system, fitMethod, rotVel):
+    for a, b in zip(_aligned('native', system, fitMethod, rotVel), _aligned('numpy', system, fitMethod, rotVel)):
+        # the native kernels fit in single precision
+        np.testing.assert_allclose(a, b, rtol=0.0, atol=1e-4 * max(np.max(np.abs(a)), 1.0))
+
+@pytest.mark.parametrize('system', ['water', 'alkane'])
+def test_numpy_backend_makes_molecules_whole(system):
+    u = benchmark.systems[system](300, nFrames=2, triclinic=False)
+    unwrap = pbc.unwrap(u, backend='numpy')
+    for ts in u.trajectory:
+        unwrap.single_frame()
+        bonds = u.atoms.positions[u.bonds.indices]
+        assert np.all(np.abs(bonds[:, 0] - bonds[:, 1]) < u.dimensions[:3] / 2)
+
+@native
+def test_equivalence_check():
+    assert backends.equivalence_check(nAtoms=300, nFrames=2)['passed']
+
+@pytest.mark.skipif(shutil.which('gcc') is None, reason="gcc not available")
+def test_outdated_prebuilt_library_is_rejected(tmp_path, monkeypatch):
+    # a library built from old sources: buildTrees only, no abiVersion or unwrapFrames
+    source = tmp_path / 'old.c'
+    source.write_text("int buildTrees(void) { return 0; }\n")
+    subprocess.run(['gcc', '-shared', '-fpic', str(source), '-o', str(tmp_path / 'libunwrap.so')], check=True)
+    monkeypatch.setattr(backends, 'sourceDir', str(tmp_path))
+    monkeypatch.setattr(backends, 'build_key', lambda name: 'missing')
+    monkeypatch.setattr(backends, 'compiler', 'no-such-compiler')
+    monkeypatch.setattr(backends, '_libraries', {})
+    monkeypatch.setattr(backends, '_failed', {})
+    with pytest.raises(OSError, match="abiVersion"):
+        backends.native('unwrap')
+    assert not backends.available('unwrap')
+    assert backends.select('auto', 'unwrap') == 'numpy'
@@ -0,0 +1,39 @@
+import os
+import shutil
+import numpy as np
+import batch
+
+def _jobs(trajectory, sigma=20.0):
+    topology, filename = trajectory
+    common = dict(topology=topology, trajectory=filename, nCorr=10, sigma=sigma)
+    return [dict(common, name='all'),
+            dict(common, name='basin', nModes=12,
+                 segment=dict(dihedrals=['phi 1', 'psi 1'], basins=[[[-180, 180], [-180, 180]]], minLength=20))]
+
+def test_run_and_skip_complete(trajectory, tmp_path):
+    output = str(tmp_path / 'results')
+    status = batch.run(_jobs(trajectory), output, nWorkers=1)
+    assert status == dict(all='done', basin='done')
+    eigenvalues = np.load(os.path.join(output, 'all', 'eigenvalues.npy'))
+    assert eigenvalues.shape == (10, 66)
+    assert np.load(os.path.join(output, 'basin', 'eigenvalues.npy')).shape == (10, 12)
+    # complete jobs are recognized without the frame stores
+    shutil.rmtree(os.path.join(output, 'frames'))
+    status = batch.run(_jobs(trajectory), output, nWorkers=1)
+    assert status == dict(all='skipped', basin='skipped')
+    assert not os.path.exists(os.path.join(output, 'frames'))
+    # changed inputs are analyzed again
+    status = batch.run(_jobs(trajectory, sigma=30.0), output, nWorkers=1)
+    assert status == dict(all='done', basin='done')
+
+def test_rerun_reuses_frame_store(trajectory, tmp_path):
+    output = str(tmp_path / 'results')
+    assert batch.run(_jobs(trajectory), output, nWorkers=1) == dict(all='done', basin='done')
+    frames = os.path.join(output, 'frames')
+    meta = [os.path.join(frames, key, 'meta.json') for key in os.listdir(frames)]
+    assert len(meta) == 1
+    written = os.stat(meta[0]).st_mtime_ns
+    # only the job without dihedrals is unfinished, the store still holds the dihedrals of the other one
+    os.remove(os.path.join(output, 'all', 'meta.json'))
+    assert batch.run(_jobs(trajectory), output, nWorkers=1) == dict(all='done', basin='skipped')
+    assert os.stat(meta[0]).st_mtime_ns == written
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import MDAnalysis as mda
+import cache
+import fresean
+
+def _correlation_matrix(u, nCorr, sigma):
+    sqm = np.repeat(np.sqrt(u.atoms.masses), 3)
+    velocities = np.array([sqm * u.atoms.velocities.flatten() for ts in u.trajectory]).T
+    freqs, winTime = fresean.gaussian_window(nCorr, 0.01, sigma)
+    return fresean.correlation_matrix(velocities, nCorr, winTime)
+
+def test_get_or_compute_reuses_results(trajectory, tmp_path):
+    u = mda.Universe(*trajectory)
+    c = cache.cache(str(tmp_path / 'cache'))
+    calls = []
+    def compute(sigma):
+        calls.append(sigma)
+        return _correlation_matrix(u, 10, sigma)
+    key = c.key(cache.analysis_inputs(u, u.atoms, nCorr=10, dt=0.01, sigma=20.0))
+    first = c.get_or_compute(key, 'corrMatrix', lambda: compute(20.0))
+    second = c.get_or_compute(key, 'corrMatrix', lambda: compute(20.0))
+    assert calls == [20.0]
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(first, _correlation_matrix(u, 10, 20.0))
+    np.testing.assert_array_equal(second, first)
+    # changed inputs give a new entry
+    other = c.key(cache.analysis_inputs(u, u.atoms, nCorr=10, dt=0.01, sigma=30.0))
+    assert other != key
+    c.get_or_compute(other, 'corrMatrix', lambda: compute(30.0))
+    assert calls == [20.0, 30.0]
+    assert c.key(cache.analysis_inputs(u, u.atoms, nCorr=10, dt=0.01, sigma=20.0)) == key
+
+def test_evict_least_recently_used(tmp_path):
+    array = np.zeros(1000)
+    c = cache.cache(str(tmp_path / 'cache'), maxBytes=10**9)
+    keys = [c.key(dict(entry=i)) for i in range(3)]
+    c.put(keys[0], 'a', array)
+    c.put(keys[1], 'a', array)
+    size = max(size for access, size, key in c.entries())
+    # explicit access times, the first entry is read last
+    for i, key in enumerate(keys[:2]):
+        os.utime(os.path.join(c.directory, key), ns=(i * 10**9, i * 10**9))
+    assert c.get(keys[0], 'a') is not None
+    c.maxBytes = 2 * size
+    c.put(keys[2], 'a', array)
+    assert c.get(keys[1], 'a') is None
+    assert c.get(keys[0], 'a') is not None
+    assert c.get(keys[2], 'a') is not None
+    # an entry larger than the cache is kept until the next one is stored
+    c.maxBytes = 0
+    c.put(keys[1], 'a', array)
+    assert sorted(key for access, size, key in c.entries()) == [keys[1]]
@@ -0,0 +1,68 @@
+import numpy as np
+import MDAnalysis as mda
+import clustering
+import fresean
+
+def _modes(trajectory, nCorr=10, sigma=20.0):
+    """eigenvalues and eigenvectors of the correlation matrix of all atoms"""
+    u = mda.Universe(*trajectory)
+    sqm = np.repeat(np.sqrt(u.atoms.masses), 3)
+    velocities = np.array([sqm * u.atoms.velocities.flatten() for ts in u.trajectory]).T
+    freqs, winTime = fresean.gaussian_window(nCorr, 0.01, sigma)
+    return fresean.eigenmodes(fresean.correlation_matrix(velocities, nCorr, winTime))
+
+def _notebook_clusters(eigenvalues, eigenvectors, freqSelIndices, cutoff):
+    """selection, weighted comparison matrix (Eq. 12) and cluster centers as in the notebooks"""
+    eigenvectorsSel = []
+    eigenvaluesSel = []
+    for i in freqSelIndices:
+        for m in range(5):
+            eigenvaluesSel.append(eigenvalues[i, m])
+            eigenvectorsSel.append(eigenvectors[i, m])
+    eigenvectorsSel = np.array(eigenvectorsSel)
+    eigenvaluesSel = np.array(eigenvaluesSel)
+    maxEigenvalue = np.max(eigenvaluesSel)
+    nSel = len(eigenvaluesSel)
+    clusterMatrix = np.zeros((nSel, nSel), dtype=np.float64)
+    for i in range(nSel):
+        a = np.sqrt(eigenvaluesSel[i]) if eigenvaluesSel[i] > 0 else 0.0
+        vec1 = eigenvectorsSel[i].copy()
+        for k in range(6):
+            vec1 -= np.dot(vec1, eigenvectors[0][k]) * eigenvectors[0][k]
+        for j in range(nSel):
+            b = np.sqrt(eigenvaluesSel[j]) if eigenvaluesSel[j] > 0 else 0.0
+            vec2 = eigenvectorsSel[j].copy()
+            for k in range(6):
+                vec2 -= np.dot(vec2, eigenvectors[0][k]) * eigenvectors[0][k]
+            clusterMatrix[i, j] = a * b / maxEigenvalue * np.abs(np.dot(vec1, vec2))
+    clusterIndices = []
+    matrix = clusterMatrix.copy()
+    if np.max(matrix) > cutoff:
+        while True:
+            row_counts = np.sum(matrix > cutoff, axis=1)
+            max_count = np.max(row_counts)
+            if max_count == 0:
+                break
+            max_row_index = np.where(row_counts == max_count)[0][-1]
+            clusterIndices.append(max_row_index)
+            indices_to_remove = np.where(matrix[max_row_index] > cutoff)[0]
+            matrix[:, indices_to_remove] = 0
+            matrix[indices_to_remove, :] = 0
+    return eigenvaluesSel, eigenvectorsSel, clusterMatrix, np.array(clusterIndices, dtype=np.int64)
+
+def test_clustering_matches_notebook_loops(trajectory):
+    eigenvalues, eigenvectors = _modes(trajectory)
+    freqIndices = np.arange(1, 10)
+    cutoff = 0.3
+    valuesRef, vectorsRef, matrixRef, centersRef = _notebook_clusters(eigenvalues, eigenvectors, freqIndices, cutoff)
+    assert len(centersRef) > 1
+    valuesSel, vectorsSel = clustering.select_modes(eigenvalues, eigenvectors, freqIndices, 5)
+    np.testing.assert_array_equal(valuesSel, valuesRef)
+    np.testing.assert_array_equal(vectorsSel, vectorsRef)
+    rigidBody = eigenvectors[0, :6]
+    matrix = clustering.similarity_matrix(valuesSel, vectorsSel, rigidBody)
+    np.testing.assert_allclose(matrix, matrixRef, rtol=1e-10, atol=1e-12)
+    np.testing.assert_array_equal(clustering.cluster_centers(matrix, cutoff), centersRef)
+    # the sparse graph (built in row blocks) selects the same centers
+    graph = clustering.similarity_graph(valuesSel, vectorsSel, cutoff, rigidBody, blockSize=7)
+    np.testing.assert_array_equal(clustering.cluster_centers(graph, cutoff), centersRef)
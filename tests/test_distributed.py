@@ -0,0 +1,32 @@
+import numpy as np
+import distributed
+import fresean
+
+def _inputs(seed):
+    velocities = np.random.default_rng(seed).normal(size=(10, 120))
+    freqs, winTime = fresean.gaussian_window(20, 0.01, 20.0)
+    return velocities, winTime
+
+def test_matches_fresean(tmp_path):
+    velocities, winTime = _inputs(0)
+    out = distributed.correlation_matrix(velocities, 20, winTime, str(tmp_path / 'corr.npy'), blockSize=4, nWorkers=2)
+    reference = fresean.correlation_matrix(velocities, 20, winTime, transform='real')
+    np.testing.assert_allclose(out[:], reference, rtol=1e-10, atol=1e-12)
+
+def test_new_velocities_start_a_new_build(tmp_path):
+    filename = str(tmp_path / 'corr.npy')
+    velocities, winTime = _inputs(0)
+    distributed.prepare(velocities, 20, winTime, filename, blockSize=4)
+    # same shape and parameters, different content
+    velocities, winTime = _inputs(1)
+    out = distributed.correlation_matrix(velocities, 20, winTime, filename, blockSize=4, nWorkers=1)
+    reference = fresean.correlation_matrix(velocities, 20, winTime, transform='real')
+    np.testing.assert_allclose(out[:], reference, rtol=1e-10, atol=1e-12)
+
+def test_new_store_dtype_starts_a_new_build(tmp_path):
+    filename = str(tmp_path / 'corr.npy')
+    velocities, winTime = _inputs(0)
+    distributed.prepare(velocities, 20, winTime, filename, blockSize=4)
+    out = distributed.correlation_matrix(velocities, 20, winTime, filename, blockSize=4, nWorkers=1,
+                                         storeDtype=np.float32)
+    assert out.dtype == np.float32
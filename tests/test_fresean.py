@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+from scipy.fft import fft, ifft
+import MDAnalysis as mda
+import fresean
+import store
+
+def _corr_matrix(nCorr=6, nDOF=8, seed=0):
+    rng = np.random.default_rng(seed)
+    a = rng.normal(size=(nCorr, nDOF, nDOF))
+    return a + a.transpose(0, 2, 1)
+
+def _velocities(trajectory):
+    """mass-weighted velocities [3N, nFrames] of all atoms (per-frame loop of the notebooks)"""
+    u = mda.Universe(*trajectory)
+    sqm = np.repeat(np.sqrt(u.atoms.masses), 3)
+    return np.array([sqm * u.atoms.velocities.flatten() for ts in u.trajectory]).T
+
+def _notebook_corr_matrix(velocities, nCorr, winTime):
+    """correlation matrix with the element loop of the notebooks"""
+    nDOF, nFrames = velocities.shape
+    velocities = fft(np.array(velocities, dtype=np.complex128), axis=1)
+    corrMatrix = np.empty((nCorr, nDOF, nDOF))
+    tmp3 = np.zeros(2 * nCorr - 1)
+    for i in range(nDOF):
+        for j in range(i, nDOF):
+            tmp2 = np.real(ifft(np.real(velocities[i] * velocities[j].conj())))
+            tmp3[:nCorr] = tmp2[:nCorr]
+            tmp3[nCorr:] = tmp2[nCorr-1:0:-1]
+            tmp3 *= winTime
+            corrMatrix[:, i, j] = np.real(fft(tmp3)[:nCorr])
+            corrMatrix[:, j, i] = corrMatrix[:, i, j]
+    return corrMatrix / nFrames
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_eigenmodes_sliced_memmap(tmp_path, pool):
+    filename = str(tmp_path / 'corr.npy')
+    np.save(filename, _corr_matrix())
+    corrMatrix = np.load(filename, mmap_mode='r')[2:]
+    reference, referenceVectors = fresean.eigenmodes(np.array(corrMatrix))
+    eigenvalues, eigenvectors = fresean.eigenmodes(corrMatrix, nWorkers=2, pool=pool)
+    np.testing.assert_allclose(eigenvalues, reference, atol=1e-12)
+    np.testing.assert_allclose(np.abs(np.einsum('kmi,kmi->km', eigenvectors, referenceVectors)), 1.0, atol=1e-10)
+
+def test_eigenmodes_raw_memmap(tmp_path):
+    filename = str(tmp_path / 'corr.bin')
+    corrMatrix = np.memmap(filename, mode='w+', dtype=np.float64, shape=(6, 8, 8))
+    corrMatrix[:] = _corr_matrix()
+    reference, vectors = fresean.eigenmodes(np.array(corrMatrix))
+    eigenvalues, vectors = fresean.eigenmodes(corrMatrix, nWorkers=2, pool='process')
+    np.testing.assert_allclose(eigenvalues, reference, atol=1e-12)
+
+def test_eigenmodes_store_process(tmp_path):
+    corrMatrix = _corr_matrix()
+    out = store.corrStore(str(tmp_path / 'corr.npy'), *corrMatrix.shape[:2], packed=True)
+    iu = np.triu_indices(corrMatrix.shape[1])
+    out.data[:] = corrMatrix[:, iu[0], iu[1]]
+    out.flush()
+    reference, vectors = fresean.eigenmodes(corrMatrix)
+    eigenvalues, vectors = fresean.eigenmodes(out, nWorkers=2, pool='process')
+    np.testing.assert_allclose(eigenvalues, reference, atol=1e-12)
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_rewindow_matches_correlation_matrix(tmp_path, packed):
+    rng = np.random.default_rng(1)
+    velocities = rng.normal(size=(11, 200))
+    dt, sigma, nCorr = 0.01, 20.0, 30
+    corrTime = fresean.correlation_tensor(velocities, 40, transform='real',
+                                          out=store.corrStore(str(tmp_path / 'time.npy'), 40, 11, packed=packed))
+    freqs, winTime = fresean.gaussian_window(nCorr, dt, sigma)
+    reference = fresean.correlation_matrix(velocities, nCorr, winTime, transform='real')
+    freqs, corrMatrix = fresean.rewindow(corrTime, dt, sigma, nCorr=nCorr, blockSize=4)
+    np.testing.assert_allclose(corrMatrix, reference, rtol=1e-10, atol=1e-12)
+
+def test_correlation_matrix_empty_selection():
+    freqs, winTime = fresean.gaussian_window(10, 0.01, 20.0)
+    with pytest.raises(ValueError, match="no degrees of freedom"):
+        fresean.correlation_matrix(np.zeros((0, 50)), 10, winTime)
+
+def test_project_modes_match_notebook_loops(trajectory):
+    nCorr = 10
+    freqs, winTime = fresean.gaussian_window(nCorr, 0.01, 20.0)
+    corrMatrix = fresean.correlation_matrix(_velocities(trajectory), nCorr, winTime)
+    eigenvalues, eigenvectors = fresean.eigenmodes(corrMatrix)
+    modes = eigenvectors[3, :5]
+    # 1D-VDoS (Eq. 11) and mode-mode time correlation functions as in the notebooks
+    vdos = np.zeros((5, nCorr))
+    vcf = np.zeros((5, 5, nCorr))
+    tmp1 = np.zeros(2 * nCorr - 1)
+    for i in range(5):
+        for k in range(nCorr):
+            vdos[i, k] = np.dot(modes[i], np.dot(corrMatrix[k], modes[i]))
+        for j in range(5):
+            for k in range(nCorr):
+                tmp1[k] = np.dot(modes[i], np.dot(corrMatrix[k], modes[j]))
+            tmp1[nCorr:] = tmp1[nCorr-1:0:-1]
+            vcf[i, j] = np.real(ifft(tmp1))[:nCorr]
+    out = store.corrStore(None, nCorr, corrMatrix.shape[1])
+    out.data[:] = corrMatrix
+    for source in (corrMatrix, out):
+        np.testing.assert_allclose(fresean.mode_vdos(source, modes), vdos, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(np.moveaxis(fresean.project_modes(source, modes, timeDomain=True), 0, -1),
+                                   vcf, rtol=1e-10, atol=1e-12)
+    # modes at different frequencies (rectangular projection)
+    projected = fresean.project_modes(corrMatrix, modes, eigenvectors[0, :3])
+    reference = np.zeros((nCorr, 5, 3))
+    for k in range(nCorr):
+        for a in range(5):
+            for b in range(3):
+                reference[k, a, b] = np.dot(modes[a], np.dot(corrMatrix[k], eigenvectors[0, b]))
+    np.testing.assert_allclose(projected, reference, rtol=1e-10, atol=1e-12)
+
+@pytest.mark.parametrize('transform, dtype, tol', [('complex', np.float64, 1e-12),
+                                                   ('real', np.float64, 1e-12),
+                                                   ('real', np.float32, 1e-5)])
+def test_correlation_matrix_matches_notebook_loop(trajectory, transform, dtype, tol):
+    velocities = _velocities(trajectory)
+    freqs, winTime = fresean.gaussian_window(10, 0.01, 20.0)
+    reference = _notebook_corr_matrix(velocities, 10, winTime)
+    corrMatrix = fresean.correlation_matrix(velocities, 10, winTime, blockSize=16, transform=transform, dtype=dtype)
+    np.testing.assert_allclose(corrMatrix, reference, rtol=0, atol=tol * np.max(np.abs(reference)))
+    result = fresean.precision_check(velocities, 10, winTime, transform=transform, dtype=dtype, blockSize=16)
+    assert result['eigenvaluesRelative'] < tol
+    assert result['vdosRelative'] < tol
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+import MDAnalysis as mda
+import fresean
+import modes
+
+modeDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'harmonic-normal-modes')
+
+def _notebook_modes():
+    """harmonic normal modes and frequencies loaded as in the notebooks"""
+    harmonic = mda.Universe(os.path.join(modeDir, 'eigenvec.xyz'), os.path.join(modeDir, 'eigenvec.xyz'))
+    nDOF = 3 * harmonic.atoms.n_atoms
+    harmonicModes = np.zeros((nDOF, nDOF), dtype=np.float64)
+    for m in range(nDOF):
+        harmonicModes[m] = harmonic.trajectory[m].positions.flatten()
+    harmonicFreqs = np.loadtxt(os.path.join(modeDir, 'eigenfreq.dat'), comments='#')[:, 1]
+    return harmonicModes, harmonicFreqs
+
+def test_convert_xyz_roundtrip(tmp_path):
+    harmonicModes, harmonicFreqs = _notebook_modes()
+    filename = str(tmp_path / 'harmonic.modes')
+    library = modes.convert_xyz(os.path.join(modeDir, 'eigenvec.xyz'), os.path.join(modeDir, 'eigenfreq.dat'),
+                                filename, reference=os.path.join(modeDir, 'min.xyz'))
+    library = modes.modeLibrary(filename)
+    assert len(library) == len(harmonicModes)
+    np.testing.assert_allclose(library.vectors, harmonicModes, rtol=1e-6, atol=1e-6)
+    np.testing.assert_array_equal(library.frequencies, harmonicFreqs)
+    np.testing.assert_allclose(library['reference'], mda.Universe(os.path.join(modeDir, 'min.xyz')).atoms.positions,
+                               atol=1e-4)
+    assert library.meta['units'] == dict(frequencies='cm^-1')
+    selected = [m for m in range(len(harmonicFreqs)) if m >= 6 and harmonicFreqs[m] <= 200.0]
+    np.testing.assert_array_equal(library.select(fMax=200.0, skip=6), selected)
+    single = modes.convert_xyz(os.path.join(modeDir, 'eigenvec.xyz'), os.path.join(modeDir, 'eigenfreq.dat'),
+                               str(tmp_path / 'single.modes'), dtype=np.float32)
+    assert single.vectors.dtype == np.float32
+    np.testing.assert_allclose(single.vectors, library.vectors, rtol=1e-6, atol=1e-6)
+
+def test_overlap_and_vdos_match_notebook_loops(trajectory, tmp_path):
+    harmonicModes, harmonicFreqs = _notebook_modes()
+    library = modes.write(str(tmp_path / 'harmonic.modes'), harmonicModes, harmonicFreqs)
+    u = mda.Universe(*trajectory)
+    sqm = np.repeat(np.sqrt(u.atoms.masses), 3)
+    velocities = np.array([sqm * u.atoms.velocities.flatten() for ts in u.trajectory]).T
+    nCorr = 10
+    freqs, winTime = fresean.gaussian_window(nCorr, 0.01, 20.0)
+    corrMatrix = fresean.correlation_matrix(velocities, nCorr, winTime)
+    eigenvalues, eigenvectors = fresean.eigenmodes(corrMatrix)
+    nDOF = len(harmonicModes)
+    VDoSharmonicModes = np.zeros((nDOF, nCorr))
+    for m in range(nDOF):
+        for i in range(nCorr):
+            VDoSharmonicModes[m, i] = np.dot(harmonicModes[m], np.dot(corrMatrix[i], harmonicModes[m]))
+    compareMatrix = np.zeros((10, 7))
+    for i in range(10):
+        for j in range(7):
+            compareMatrix[i, j] = np.abs(np.dot(eigenvectors[2][i], harmonicModes[j + 6]))
+    np.testing.assert_allclose(modes.vdos(corrMatrix, library), VDoSharmonicModes, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(modes.overlap(eigenvectors, library)[2, :10, 6:13], compareMatrix, rtol=1e-10, atol=1e-12)
+    # all eigenpairs give the full 1D-VDoS
+    np.testing.assert_allclose(modes.vdos_from_eigenmodes(eigenvalues, eigenvectors, library), VDoSharmonicModes,
+                               rtol=1e-8, atol=1e-8 * np.max(np.abs(VDoSharmonicModes)))
@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+import signal
+import numpy as np
+import pytest
+import MDAnalysis as mda
+import pipeline
+import unwrap as pbc
+import align as fit
+
+def _serial_velocities(topology, trajectory, alignKwargs):
+    u = mda.Universe(topology, trajectory)
+    unwrap = pbc.unwrap(u)
+    align = fit.align(u, u.atoms, **alignKwargs)
+    sqm = np.repeat(np.sqrt(u.atoms.masses), 3)
+    velocities = []
+    for ts in u.trajectory:
+        unwrap.single_frame()
+        align.single_frame()
+        velocities.append(sqm * u.atoms.velocities.flatten())
+    return np.array(velocities).T
+
+def test_velocities_match_serial_loop(trajectory):
+    alignKwargs = dict(rotVel=1, placeCOMInBox=0)
+    velocities = pipeline.velocities(*trajectory, nWorkers=2, chunkSize=7, alignKwargs=alignKwargs)
+    np.testing.assert_allclose(velocities, _serial_velocities(*trajectory, alignKwargs), rtol=1e-6, atol=1e-6)
+
+def test_killed_worker_raises(trajectory):
+    # a single slot keeps the worker waiting until the consumer releases the first block
+    blocks = pipeline.iter_blocks(*trajectory, nWorkers=1, chunkSize=1, prefetch=0)
+    next(blocks)
+    for p in multiprocessing.active_children():
+        os.kill(p.pid, signal.SIGKILL)
+    with pytest.raises(RuntimeError, match="exited with code"):
+        for block in blocks:
+            pass
@@ -0,0 +1,59 @@
+import numpy as np
+import MDAnalysis as mda
+from MDAnalysis.analysis.dihedrals import Dihedral
+import segmentation
+import unwrap as pbc
+
+def _longest_consecutive_indices(array1, lim1, array2, lim2, lim1alt=None, lim2alt=None):
+    """longest segment of frames within the limits (loop of the notebooks, both alternative limits optional)"""
+    mask1 = (array1 >= lim1[0]) & (array1 <= lim1[1])
+    if lim1alt is not None:
+        mask1 |= (array1 >= lim1alt[0]) & (array1 <= lim1alt[1])
+    mask2 = (array2 >= lim2[0]) & (array2 <= lim2[1])
+    if lim2alt is not None:
+        mask2 |= (array2 >= lim2alt[0]) & (array2 <= lim2alt[1])
+    max_len = 0
+    max_start = -1
+    current_len = 0
+    current_start = -1
+    for i, val in enumerate(mask1 & mask2):
+        if val:
+            if current_len == 0:
+                current_start = i
+            current_len += 1
+            if current_len > max_len:
+                max_len = current_len
+                max_start = current_start
+        else:
+            current_len = 0
+    if max_len == 0:
+        return None
+    return list(range(max_start, max_start + max_len))
+
+def test_segments_match_notebook_loop(trajectory):
+    u = mda.Universe(*trajectory)
+    groups = [u.residues[1].phi_selection(), u.residues[1].psi_selection()]
+    phi, psi = Dihedral(groups).run().results.angles.T
+    # the fixture's molecules are broken across the box, dihedral_angles needs whole molecules
+    unwrap = pbc.unwrap(u)
+    indices = segmentation.dihedral_indices(groups)
+    angles = []
+    for ts in u.trajectory:
+        unwrap.single_frame()
+        angles.append(segmentation.dihedral_angles(u.atoms.positions, indices))
+    angles = np.array(angles)
+    np.testing.assert_allclose(angles, np.array([phi, psi]).T, atol=1e-3)
+    # psi limits wrap around +-180
+    basins = [[(-180, -145), (155, -170)], [(-145, 0), (-180, 180)]]
+    labels = segmentation.label_frames(angles, basins)
+    reference = _longest_consecutive_indices(angles[:, 0], [-180, -145], angles[:, 1], [155, 180], lim2alt=[-180, -170])
+    assert reference is not None and len(reference) < len(labels)
+    np.testing.assert_array_equal(segmentation.longest_segment(labels, label=0), reference)
+    mask = segmentation.in_range(angles[:, 0], (-180, -145)) & segmentation.in_range(angles[:, 1], (155, -170))
+    np.testing.assert_array_equal(segmentation.longest_segment(mask), reference)
+    # run-length encoding reproduces the labels, segments are the runs of assigned frames
+    starts, stops, values = segmentation.runs(labels)
+    np.testing.assert_array_equal(np.repeat(values, stops - starts), labels)
+    expected = [(start, stop, value) for start, stop, value in zip(starts, stops, values)
+                if stop - start >= 2 and value >= 0]
+    assert list(zip(*segmentation.segments(labels, minLength=2))) == expected
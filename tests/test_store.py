@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+import store
+
+def _frame_store(directory, frames):
+    frameStore = store.frameStore(str(directory), mode='w+', nFrames=len(frames), nAtoms=2)
+    frameStore['frames'][:] = frames
+    frameStore['positions'][:] = np.arange(len(frames))[:, None, None]
+    frameStore.finish(selection='all', indices=[0, 1], masses=[1.0, 1.0], inputs={})
+    return store.frameStore(str(directory))
+
+def test_rows_strided_frames(tmp_path):
+    frameStore = _frame_store(tmp_path, np.arange(100, 110, 2))
+    assert frameStore.rows(slice(None)) == slice(None)
+    assert len(frameStore.positions(slice(None))) == 5
+    np.testing.assert_array_equal(frameStore.positions(slice(102, 107))[:, 0, 0], [1, 2, 3])
+    np.testing.assert_array_equal(frameStore.positions(slice(None, None, 4))[:, 0, 0], [0, 2, 4])
+    # evenly spaced selections are views
+    assert np.shares_memory(frameStore.positions([102, 106]), frameStore['positions'])
+    np.testing.assert_array_equal(frameStore.positions([108, 100])[:, 0, 0], [4, 0])
+    with pytest.raises(ValueError):
+        frameStore.rows([101])
+
+def test_rows_irregular_frames(tmp_path):
+    frameStore = _frame_store(tmp_path, np.array([5, 7, 20, 21]))
+    np.testing.assert_array_equal(frameStore.positions(slice(6, 21))[:, 0, 0], [1, 2])
+    np.testing.assert_array_equal(frameStore.positions([21, 5])[:, 0, 0], [3, 0])
@@ -1,89 +1,127 @@
 import ctypes as ct
 import numpy as np
 import MDAnalysis as mda
-import time
-
-class t_branch(ct.Structure):
-    """recursive datatype to describe molecules as trees"""
-    pass
-t_branch._fields_ = (("node", ct.c_int32),
-                   ("links",ct.POINTER(t_branch)),
-                   ("nLinks",ct.c_int32))
+import backends
+import metrics
+import numpy_backend
 
 class t_trees(ct.Structure):
-    """array of molecule trees"""
-    _fields_ = (("trees",ct.POINTER(t_branch)),
-                 ("nTrees",ct.c_int32))
-
-#load the shared library with C routines
-clib = ct.cdll.LoadLibrary("ctypes/libunwrap.so")
-
-#define argument types of function 'buildTrees' in imported library 'clib'
-clib.buildTrees.argtypes = [
-    ct.POINTER(t_trees),
-    ct.c_int32,
-    np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
-    ct.c_int32,
-    np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
-    np.ctypeslib.ndpointer(dtype=np.int32, ndim=2, flags='C_CONTIGUOUS'),
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags='C_CONTIGUOUS')
-]
-#define return type of function 'buildTrees' in imported library 'clib'
-clib.buildTrees.restype = ct.c_int32
-
-#define argument types of function 'unwrap' in imported library 'clib'
-clib.unwrap.argtypes = [
-    t_trees,
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
-    np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags='C_CONTIGUOUS')
-]
-#define return type of function 'unwrap' in imported library 'clib'
-clib.unwrap.restype = ct.c_int32
+    """molecules as flat breadth-first trees (edge arrays)"""
+    _fields_ = (("nTrees",ct.c_int32),
+                ("nEdges",ct.c_int32),
+                ("root",ct.POINTER(ct.c_int32)),
+                ("edgeStart",ct.POINTER(ct.c_int32)),
+                ("parent",ct.POINTER(ct.c_int32)),
+                ("child",ct.POINTER(ct.c_int32)))
+
+#shared library with C routines, loaded (and compiled if needed) on first use
+clib = None
+
+def _load():
+    """load libunwrap (see backends.native) and define argument types of its functions"""
+    global clib
+    if clib is not None:
+        return clib
+    lib = backends.native('unwrap')
+
+    #define argument types of function 'buildTrees' in imported library 'clib'
+    lib.buildTrees.argtypes = [
+        ct.POINTER(t_trees),
+        ct.c_int32,
+        np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
+        np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
+        np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS'),
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags='C_CONTIGUOUS'),
+        ct.POINTER(metrics.t_error)
+    ]
+    #define return type of function 'buildTrees' in imported library 'clib'
+    lib.buildTrees.restype = ct.c_int32
+
+    #define argument types of function 'unwrap' in imported library 'clib'
+    lib.unwrap.argtypes = [
+        t_trees,
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS'),
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags='C_CONTIGUOUS')
+    ]
+    #define return type of function 'unwrap' in imported library 'clib'
+    lib.unwrap.restype = ct.c_int32
+
+    #define argument types of function 'unwrapFrames' in imported library 'clib'
+    lib.unwrapFrames.argtypes = [
+        t_trees,
+        ct.c_int32,
+        ct.c_int32,
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=3, flags='C_CONTIGUOUS'),
+        np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
+    ]
+    #define return type of function 'unwrapFrames' in imported library 'clib'
+    lib.unwrapFrames.restype = ct.c_int32
+
+    #define argument types of function 'freeTrees' in imported library 'clib'
+    lib.freeTrees.argtypes = [ct.POINTER(t_trees)]
+    lib.freeTrees.restype = None
+
+    clib = lib
+    return clib
 
 class unwrap:
-    """make molecules whole in PBC trajectories"""
-    def __init__(self,u):
+    """
+    make molecules whole in PBC trajectories
+    backend: 'native' (C kernels), 'numpy' (numpy_backend) or 'auto' (default: FRESEAN_BACKEND, see backends.select)
+    """
+    def __init__(self,u,backend=None):
         self.u = u
-        self.trees = self.buildTrees()
+        self.backend = backends.select(backend, 'unwrap')
+        self.clib = _load() if self.backend == 'native' else None
+        with metrics.timer('tree_setup'):
+            self.trees = self.buildTrees()
         self.warn = False
         
     def buildTrees(self):
-        """build recursive bond trees that define molecules"""
+        """build breadth-first bond trees that define molecules"""
         # print('building intra-molecular bond trees ...')
-        start=time.process_time()
         nAtoms=len(self.u.atoms)
         atomTags=np.zeros(nAtoms,dtype=np.int32)
 
-        bondList=self.u.bonds.indices
-        bondList.sort(axis=1)
-        nBonds=len(self.u.bonds)
-        p=np.zeros(nBonds,dtype=np.int64)
-        for i in range(nBonds):
-            #we calculate for each bond a priority for sorting
-            p[i]=bondList[i][0]*nAtoms+bondList[i][1]
-        order=np.argsort(p)
-        #now we have a sorted list of bonds
-        bondList=bondList[order]
-
-        bondTags=np.zeros(len(self.u.bonds),dtype=np.int32)
+        try:
+            #raw bond list of the topology avoids the (slow) construction
+            #of a TopologyGroup for all bonds in large systems
+            bondList=np.asarray(self.u._topology.bonds.values,dtype=np.int64).reshape(-1,2)
+        except AttributeError:
+            bondList=self.u.bonds.indices
+        if len(bondList)>0 and (bondList.min()<0 or bondList.max()>=nAtoms):
+            raise ValueError('unwrap: bond indices out of range')
+        #adjacency list in CSR format: both directions of each bond,
+        #sorted by atom and, for each atom, by bonded neighbor
+        pairs=np.concatenate((bondList,bondList[:,::-1])).astype(np.int64)
+        order=np.argsort(pairs[:,0]*nAtoms+pairs[:,1],kind='stable')
+        neighbors=np.ascontiguousarray(pairs[order,1],dtype=np.int32)
+        offsets=np.zeros(nAtoms+1,dtype=np.int32)
+        np.cumsum(np.bincount(pairs[:,0],minlength=nAtoms),out=offsets[1:])
 
         masses=self.u.atoms.masses.astype(np.float32)
 
+        details = metrics.t_error()
+        if self.backend == 'numpy':
+            with metrics.kernel('tree_setup'):
+                error, trees = numpy_backend.build_trees(offsets, neighbors, masses, details)
+            metrics.check('buildTrees', error, details)
+            return trees
         trees = t_trees()
-        error = clib.buildTrees(
-            ct.pointer(trees),
-            ct.c_int(nAtoms),
-            atomTags,
-            ct.c_int(nBonds),
-            bondTags,
-            bondList,
-            masses
-        )
+        with metrics.kernel('tree_setup'):
+            error = self.clib.buildTrees(
+                ct.pointer(trees),
+                ct.c_int(nAtoms),
+                atomTags,
+                offsets,
+                neighbors,
+                masses,
+                ct.byref(details)
+            )
         if error != 0:
-            print(f'ERROR reported by \'buildTrees\' function\nsee \'error.log\'\n')
-        stop=time.process_time()
+            self.clib.freeTrees(ct.byref(trees))
+        metrics.check('buildTrees', error, details)
         # print(f'unwrap -> detected {trees.nTrees} molecules')
-        # print(f'unwrap -> tree building time: {stop-start:.2f}s')
         # print(f'unwrap -> ready to unwrap')
         return trees
 
@@ -99,11 +137,62 @@ class unwrap:
                 print(' -> skipping unwrap!')
                 self.warn = True
             return
-        else:
-            error = clib.unwrap(
-                self.trees,
-                self.u.trajectory.ts._pos,
-                self.u.dimensions
-            )
-        if error != 0:
-            print(f'ERROR reported by \'unwrap\' function\nsee \'error.log\'\n')
+        elif self.trees is None:
+            raise ValueError("unwrap: bond trees have been freed by close()")
+        with metrics.timer('unwrap', frames=1):
+            dimensions = self.u.dimensions
+            with metrics.kernel('unwrap'):
+                if self.backend == 'numpy':
+                    error = numpy_backend.unwrap_frames(self.trees, self.u.trajectory.ts._pos[None], dimensions)
+                else:
+                    error = self.clib.unwrap(
+                        self.trees,
+                        self.u.trajectory.ts._pos,
+                        dimensions
+                    )
+        metrics.check('unwrap', error)
+
+    def frames(self, coords, boxes):
+        """
+        unwrap a block of frames in place with a single C call
+        coords: float32 array [nFrames, nAtoms, 3] (C-contiguous)
+        boxes: box dimensions [nFrames, 6] or [6] (same box for all frames)
+        """
+        if self.trees is None:
+            raise ValueError("unwrap: bond trees have been freed by close()")
+        if coords.dtype != np.float32 or coords.ndim != 3 or not coords.flags['C_CONTIGUOUS']:
+            raise ValueError("unwrap: coords must be a C-contiguous float32 array [nFrames, nAtoms, 3]")
+        nFrames, nAtoms = coords.shape[0], coords.shape[1]
+        if nAtoms != len(self.u.atoms):
+            raise ValueError(f"unwrap: coords contain {nAtoms} atoms, expected {len(self.u.atoms)}")
+        if boxes is None:
+            if not self.warn:
+                print('unwrap: WARNING:')
+                print(' -> no box dimensions available!')
+                print(' -> skipping unwrap!')
+                self.warn = True
+            return
+        with metrics.timer('unwrap', frames=nFrames):
+            boxes = np.ascontiguousarray(np.broadcast_to(boxes, (nFrames, 6)), dtype=np.float32)
+            with metrics.kernel('unwrap'):
+                if self.backend == 'numpy':
+                    error = numpy_backend.unwrap_frames(self.trees, coords, boxes)
+                else:
+                    error = self.clib.unwrapFrames(
+                        self.trees,
+                        ct.c_int(nFrames),
+                        ct.c_int(nAtoms),
+                        coords,
+                        boxes
+                    )
+        metrics.check('unwrapFrames', error)
+
+    def close(self):
+        """free the memory of the bond trees"""
+        if getattr(self, 'trees', None) is not None:
+            if getattr(self, 'clib', None) is not None:
+                self.clib.freeTrees(ct.byref(self.trees))
+            self.trees = None
+
+    def __del__(self):
+        self.close()